@@ -1,4 +1,10 @@
 from .base import *
 from .image import *
+from .surface import *
+from .dicom import *
+from .nifti import *
+from .cache import *
+from .index import *
 from .interface import *
+from .archive import *
 from .manager import *
\ No newline at end of file
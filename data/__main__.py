@@ -1,79 +1,42 @@
 #!/usr/bin/env python3
 
-''' this file is executed when image_util is invoked as a module, possibly from the command line using `python -m`.
-a simple ui is launch to allow various commonly used functions (resampling, conversion between different medical formats, etc.).
+''' this file is executed when this package is invoked as a module from the command line using `python -m`, e.g.
+    python -m data convert 'cases/**/*.CASS' -o nifti/ --to nifti --workers 4
+    python -m data convert --manifest tonight.txt -o bin/ --to bin
+which converts cases between CASS archives, AA bin files, NIfTI, and DICOM in a process pool, see convert.
 '''
 
-import os
-import sys
-import shutil
-import subprocess
-import SimpleITK as sitk
-import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 
-from .image import ImageFrame, SkullEngineMask, SkullEngineScan
-from .interface import DataManager
+from .convert import *
 
-RAR_PROG = 'C:\\Program Files\\WinRAR\\Rar.exe'
 
-def show(image_slice:np.array, mask_slice:np.array):
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m data')
+    commands = parser.add_subparsers(dest='command', required=True)
 
-    fig = plt.figure(frameon=False)
-    ax = fig.add_subplot()
-    ax.imshow(image_slice, cmap=plt.cm.gray)
-    masks_color = np.zeros(image_slice.shape)
-    masks_color[...] = np.nan
-    masks_color[mask_slice!=0] = 1
-    ax.imshow(masks_color, alpha=.5)
-    plt.show()
+    convert = commands.add_parser('convert', description='converts cases, skipping those whose output is up to date',
+                                  help='converts between CASS, AA bin, NIfTI, and DICOM')
+    convert.add_argument('inputs', nargs='*', help='cases or glob patterns, e.g. \'cases/**/*.CASS\', quoted so the shell leaves them alone')
+    convert.add_argument('--manifest', action='append', default=[], help='file listing one case per line, or csv with a path column, may be repeated')
+    convert.add_argument('-o', '--outdir', required=True)
+    convert.add_argument('--to', required=True, choices=CONVERT_FORMATS)
+    convert.add_argument('--force', action='store_true', help='converts cases even if their output is up to date')
+    convert.add_argument('--workers', type=int, default=None, help='processes, each holding one case in memory at a time')
+    convert.add_argument('--threads', type=int, default=None, help='threads of each process for nifti compression and dicom writing')
+    convert.add_argument('--max-tasks-per-child', type=int, default=None, help='restarts a process after this many cases, on python 3.11 or newer')
 
-    return None
-
-
-
-def test():
-    
-    os.chdir('C:\\data\\test')
-    man = DataManager.from_aa('pre.CASS')
-    i_slice = man.get_scan().frame.size[-1]//2
-    img = man.get_scan()
-    msk0 = man.get_mask(0)
-    msk1 = man.get_mask(1)
-    
-    show(
-        img.numpy_array()[i_slice,:,:],
-        msk0.numpy_array()[i_slice,:,:],
-    )
-
-    img.save('img_rewrite.nii.gz')
-    msk0.save('msk_rewrite0.nii.gz')
-    msk1.save('msk_rewrite1.nii.gz')
-
-    # view in itksnap
-
-    # read from nifti and write to bin
-
-    img_rewrite = SkullEngineScan.read('img_rewrite.nii.gz', has_phi=False)
-    msk_rewrite0 = SkullEngineMask.read('msk_rewrite0.nii.gz')
-    msk_rewrite1 = SkullEngineMask.read('msk_rewrite1.nii.gz')
-    
-    show(
-        img_rewrite.numpy_array()[i_slice,:,:],
-        msk_rewrite0.numpy_array()[i_slice,:,:],
-    )
-
-    img_rewrite.write_bin_aa('Patient_data_rewrite.bin')
-    msk_rewrite0.write_bin_aa('0_rewrite.bin')
-    msk_rewrite1.write_bin_aa('1_rewrite.bin')
-
-    assert np.all(np.fromfile('Patient_data.bin', dtype=np.int16)==np.fromfile('Patient_data_rewrite.bin', dtype=np.int16)) and \
-        np.all(np.fromfile('0.bin', dtype=np.int16)==np.fromfile('0_rewrite.bin', dtype=np.int16)) and \
-        np.all(np.fromfile('1.bin', dtype=np.int16)==np.fromfile('1_rewrite.bin', dtype=np.int16))
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        paths = expand_inputs(args.inputs, args.manifest)
+        if not paths:
+            parser.error('no cases given')
+        convert_cases(paths, args.outdir, args.to, force=args.force, max_workers=args.workers, threads=args.threads,
+                      max_tasks_per_child=args.max_tasks_per_child)
 
+    return None
 
 
 
 if __name__ == '__main__':
-    test()    
-
+    main()
@@ -0,0 +1,134 @@
+import os
+import io
+import sys
+import shutil
+import subprocess
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import numpy as np
+
+from .util import *
+
+
+RAR_PROG = 'C:\\Program Files\\WinRAR\\Rar.exe' if sys.platform == 'win32' else (shutil.which('unrar') or shutil.which('rar') or 'unrar')
+
+
+class Archive(ABC):
+    '''this is the protocol of archive backends, e.g. CASS files, which are rar archives
+    members are handed out as bytes or as readable binary streams, never as extracted files,
+    so decoding needs neither temporary directories nor changes of working directory'''
+
+    @abstractmethod
+    def namelist(self) -> list:
+        '''names of all members'''
+
+
+    @abstractmethod
+    @contextmanager
+    def open(self, name):
+        '''yields a readable binary stream of a member'''
+
+
+    def read(self, name) -> bytes:
+        '''reads a member into memory'''
+        with self.open(name) as f:
+            return f.read()
+
+
+    def read_text(self, name) -> str:
+        return self.read(name).decode(errors='replace')
+
+
+
+class RarArchive(Archive):
+    '''reads rar archives by piping members out of the rar/unrar executable
+    each member is streamed from the `p` (print) command, and different members can be read concurrently'''
+
+    def __init__(self, filepath, *, prog=RAR_PROG) -> None:
+        self.filepath = os.path.realpath(os.path.expanduser(filepath))
+        self.prog = prog
+        return None
+
+
+    def namelist(self) -> list:
+        proc = subprocess.run([self.prog, 'lb', self.filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode:
+            raise ValueError(f'cannot list {self.filepath}: {proc.stderr.decode(errors="replace").strip()}')
+        return proc.stdout.decode(errors='replace').splitlines()
+
+
+    @contextmanager
+    def open(self, name):
+        proc = subprocess.Popen([self.prog, 'p', '-inul', self.filepath, name], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode:
+            raise ValueError(f'cannot read {name} from {self.filepath}')
+
+
+
+class DirectoryArchive(Archive):
+    '''treats an already extracted archive, i.e. a directory, as an archive'''
+
+    def __init__(self, dirpath) -> None:
+        self.dirpath = os.path.realpath(os.path.expanduser(dirpath))
+        return None
+
+
+    def namelist(self) -> list:
+        return sorted(os.listdir(self.dirpath))
+
+
+    @contextmanager
+    def open(self, name):
+        with open(os.path.join(self.dirpath, name), 'rb') as f:
+            yield f
+
+
+
+class MemoryArchive(Archive):
+    '''keeps members in a dict of name -> bytes, which is mainly used as a fake archive for testing'''
+
+    def __init__(self, members:dict=None) -> None:
+        self.members = dict(members or {})
+        return None
+
+
+    def namelist(self) -> list:
+        return list(self.members)
+
+
+    @contextmanager
+    def open(self, name):
+        if name not in self.members:
+            raise ValueError(f'{name} not found in archive')
+        yield io.BytesIO(self.members[name])
+
+
+    @classmethod
+    def from_arrays(cls, scan:np.ndarray, masks:list, *, spacing=(1.,1.,1.), name='', studydate='', sex=''):
+        '''creates a fake CASS archive from a (+z, +y, +x) scan array and a list of boolean mask arrays of the same shape'''
+        sz, sy, sx = scan.shape
+        info = [name, studydate, sex, '', '', sz, sy, sx, *spacing, '', 0., 0., 0.]
+        members = {
+            'Patient_info.bin': ','.join(map(str, info)).encode(),
+            'Patient_data.bin': np.ascontiguousarray(scan[::-1,::-1,:], dtype=np.int16).tobytes(),
+            'Mask_Info.bin': f'{len(masks)};'.encode(),
+        }
+        for i, m in enumerate(masks):
+            members[f'{i}.bin'] = encode_runs_aa(np.asarray(m, dtype=bool))[0].tobytes()
+        return cls(members)
+
+
+
+def open_archive(filepath) -> Archive:
+    '''picks archive backend for filepath'''
+    if isinstance(filepath, Archive):
+        return filepath
+    elif os.path.isdir(filepath):
+        return DirectoryArchive(filepath)
+    else:
+        return RarArchive(filepath)
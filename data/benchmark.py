@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+''' this file collects timing comparisons between the optimized code paths and the original implementations they replaced.
+run it from the repository root with `python -m data.benchmark`.
+every benchmark works on synthetic volumes, so no patient data is needed.
+benchmarks only time, and test_benchmark.py checks on small volumes that each optimized path matches the reference it is timed against.
+'''
+
+import os
+from time import perf_counter
+from tempfile import TemporaryDirectory
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import zoom, gaussian_filter
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from .base import *
+from .image import *
+from .surface import *
+from .manager import *
+
+
+def phantom(shape, *, num_labels=1, porosity=.2, seed=0) -> np.ndarray:
+    '''creates a labeled volume of random ellipsoids, labels are 1 to num_labels
+    porosity is the fraction of voxels knocked out of each ellipsoid, which mimics the fragmented runs of real bone masks'''
+
+    rng = np.random.default_rng(seed)
+    arr = np.zeros(shape, dtype=np.int16)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for v in range(1, num_labels+1):
+        center = rng.uniform(.2, .8, 3) * shape
+        radius = rng.uniform(.1, .4, 3) * shape
+        dist = sum(((g-c)/r)**2 for g, c, r in zip(grid, center, radius))
+        arr[(dist <= 1) & (rng.random(shape) >= porosity)] = v
+
+    return arr
+
+
+def _read_bin_aa_loop(filepath, *, frame:ImageFrame) -> np.ndarray:
+    # original per-run decoder of SkullEngineMask.read_bin_aa, kept as reference
+    bytes = np.fromfile(filepath, dtype=np.int16)
+    arr = np.zeros(frame.size[::-1], dtype=bool)
+    for i in range(0,bytes.size,4):
+        arr[
+            bytes[i+3],
+            bytes[i],
+            bytes[i+1]:bytes[i+1]+bytes[i+2]
+            ] = True
+    return arr[::-1,::-1,:].astype(np.int8)
+
+
+def _write_bin_aa_loop(arr:np.ndarray, filepath):
+    # original per-row encoder of SkullEngineMask.write_bin_aa, kept as reference
+    arr = arr[::-1,::-1,:]
+    vals = np.unique(arr)
+    vals = vals[vals!=0]
+    for v in vals:
+        seg_list = []
+        arrv = arr==v
+        for i in range(arrv.shape[0]):
+            for j in range(arrv.shape[1]):
+                segs = np.diff(np.hstack((0, arrv[i,j], 0)))
+                for start, end in zip(np.nonzero(segs==1)[0], np.nonzero(segs==-1)[0]):
+                    seg_list += [ j,start,end-start,i ]
+        _d, _f = os.path.splitext(filepath)
+        np.array(seg_list, dtype=np.int16).tofile(_d + f"_{v}"+ _f)
+
+
+def bench_read_bin_aa(shape=(200,256,256)):
+    '''round trip a single roi mask through write_bin_aa and time both decoders'''
+
+    frame = ImageFrame(size=shape[::-1], spacing=(1.,1.,1.))
+    arr = (phantom(shape) > 0).astype(np.int8)
+    msk = SkullEngineMask(data=numpy_to_vtk(arr.flat, deep=0), reference_scan=SkullEngineScan.empty(frame=frame, dtype=np.int16), identifier=Identifier())
+
+    with TemporaryDirectory() as d:
+        filepath = os.path.join(d, '0.bin')
+        msk.write_bin_aa(filepath)
+        num_runs = os.path.getsize(filepath) // 8
+
+        t = perf_counter()
+        ref = _read_bin_aa_loop(filepath, frame=frame)
+        t_loop = perf_counter() - t
+
+        t = perf_counter()
+        out = vtk_to_numpy(SkullEngineMask.read_bin_aa(filepath, frame=frame).data).reshape(shape)
+        t_vec = perf_counter() - t
+
+    print(f'read_bin_aa {shape}, {num_runs} runs: loop {t_loop:.3f} s, vectorized {t_vec:.3f} s, {t_loop/t_vec:.1f}x')
+
+    return None
+
+
+def bench_write_bin_aa(shape=(100,256,256), *, num_labels=10, max_workers=None):
+    '''encodes a multi-label mask with both encoders'''
+
+    frame = ImageFrame(size=shape[::-1], spacing=(1.,1.,1.))
+    arr = phantom(shape, num_labels=num_labels)
+    msk = SkullEngineMask(data=numpy_to_vtk(arr.flat, deep=0), reference_scan=SkullEngineScan.empty(frame=frame, dtype=np.int16), identifier=Identifier())
+
+    with TemporaryDirectory() as d:
+        os.mkdir(os.path.join(d, 'loop'))
+        os.mkdir(os.path.join(d, 'vec'))
+
+        t = perf_counter()
+        _write_bin_aa_loop(arr, os.path.join(d, 'loop', 'm.bin'))
+        t_loop = perf_counter() - t
+
+        t = perf_counter()
+        msk.write_bin_aa(os.path.join(d, 'vec', 'm.bin'), max_workers=max_workers)
+        t_vec = perf_counter() - t
+
+        files = os.listdir(os.path.join(d, 'vec'))
+
+    print(f'write_bin_aa {shape}, {len(files)} labels: loop {t_loop:.3f} s, vectorized {t_vec:.3f} s, {t_loop/t_vec:.1f}x')
+
+    return None
+
+
+def _add_mask_loop(man:DataManager, arr:np.ndarray) -> None:
+    # original per-label import of DataManager.add_mask, kept as reference
+    _mask = man.get_mask()
+    for v in np.unique(arr):
+        if v != 0:
+            new_id = man.get_next_available_mask_id()
+            if new_id not in man.get_mask_ids():
+                man.get_mask_ids().append(new_id)
+            _mask.set_true(mask_id=new_id, voxel_index=arr==v)
+
+
+def bench_add_mask(shape=(100,256,256), *, num_labels=(1,10,30)):
+    '''imports labeled volumes with different numbers of labels, per label and with the lookup table of add_mask'''
+
+    frame = ImageFrame(size=shape[::-1], spacing=(1.,1.,1.))
+    for n in num_labels:
+        arr = phantom(shape, num_labels=n)
+        times = []
+        for f in (_add_mask_loop, lambda man, arr: man.add_mask(arr=arr)):
+            man = DataManager()
+            man.set_scan(SkullEngineScan.empty(frame=frame, dtype=np.int16))
+            t = perf_counter()
+            f(man, arr)
+            times.append(perf_counter() - t)
+        print(f'add_mask {shape}, {n} labels: loop {times[0]:.3f} s, lookup table {times[1]:.3f} s, {times[0]/times[1]:.1f}x')
+
+    return None
+
+
+def bench_resample(shape=(100,200,200), *, old_spacing=(.3,.3,.3), new_spacing=(.2,.2,.2), max_workers=None):
+    '''resamples a scan with a single zoom call and with the threaded slab resampler'''
+
+    arr = np.random.default_rng(0).integers(-1000, 2000, shape).astype(np.int16)
+    z = np.array(old_spacing)/np.array(new_spacing)
+
+    t = perf_counter()
+    ref = zoom(arr, zoom=z[::-1], grid_mode=True, mode='nearest').astype(arr.dtype)
+    t_zoom = perf_counter() - t
+
+    t = perf_counter()
+    out = resample(arr, old_spacing=old_spacing, new_spacing=new_spacing, max_workers=max_workers, mode='nearest')
+    t_slab = perf_counter() - t
+
+    print(f'resample {shape} -> {out.shape}, {max_workers or os.cpu_count()} threads: zoom {t_zoom:.3f} s, slabs {t_slab:.3f} s, {t_zoom/t_slab:.1f}x')
+
+    return None
+
+
+def bench_resample_mask(shape=(100,128,128), *, num_labels=20, new_spacing=(.5,.5,.5), max_workers=None):
+    '''upsamples a bitfield mask with linear interpolation, once per label over the whole volume, and once per bounding box'''
+
+    lab = phantom(shape, num_labels=num_labels, porosity=0.)
+    arr = np.zeros(shape, dtype=MASK_DTYPE)
+    for v in range(num_labels):
+        arr[lab == v+1] |= MASK_DTYPE(1) << MASK_DTYPE(v)
+    z = 1/np.array(new_spacing)
+
+    t = perf_counter()
+    ref = np.zeros(tuple(int(round(n*f)) for n, f in zip(shape, z[::-1])), dtype=MASK_DTYPE)
+    for v in range(num_labels):
+        f = zoom((arr >> MASK_DTYPE(v) & 1).astype(np.float32), zoom=z[::-1], grid_mode=True, mode='nearest', order=1)
+        ref[f >= .5] |= MASK_DTYPE(1) << MASK_DTYPE(v)
+    t_full = perf_counter() - t
+
+    t = perf_counter()
+    out = resample_bits(arr, old_spacing=(1.,1.,1.), new_spacing=new_spacing, order=1, max_workers=max_workers)
+    t_box = perf_counter() - t
+
+    print(f'resample_bits {shape} -> {out.shape}, {num_labels} labels: whole volume {t_full:.3f} s, bounding boxes {t_box:.3f} s, {t_full/t_box:.1f}x')
+
+    return None
+
+
+def bench_resample_backends(shape=(100,200,200), *, old_spacing=(.3,.3,.3), new_spacing=(.2,.2,.2), max_workers=None):
+    '''resamples a smooth scan and its mask with the scipy and sitk backends, and compares time and voxel agreement'''
+
+    lab = phantom(shape, num_labels=5)
+    scan = (gaussian_filter(lab.astype(np.float32)*300, 2) - 500).astype(np.int16)
+    mask = np.where(lab > 0, np.left_shift(MASK_DTYPE(1), lab.astype(MASK_DTYPE)), 0).astype(MASK_DTYPE)
+
+    for name, arr, kw in (('scan', scan, dict(mode='nearest')), ('mask', mask, dict(mode='grid-constant', order=0, cval=0))):
+        out, times = [], []
+        for backend in ('scipy', 'sitk'):
+            t = perf_counter()
+            out.append(RESAMPLE_BACKENDS[backend](arr, old_spacing=old_spacing, new_spacing=new_spacing, max_workers=max_workers, **kw))
+            times.append(perf_counter() - t)
+        diff = np.abs(out[0].astype(np.int64) - out[1].astype(np.int64))
+        print(f'resample {name} {shape} -> {out[0].shape}: scipy {times[0]:.3f} s, sitk {times[1]:.3f} s, '
+              f'{(diff == 0).mean()*100:.2f}% voxels identical, max difference {diff.max()}')
+
+    return None
+
+
+def bench_save_nifti(shape=(150,512,512), *, compression_levels=(1,6), max_workers=None):
+    '''saves a ct-like scan and a mask as nifti with sitk and with write_nifti, and prints throughput in MB of voxels per second'''
+
+    lab = phantom(shape, num_labels=5, porosity=0.)
+    rng = np.random.default_rng(0)
+    scan = (gaussian_filter(lab.astype(np.float32)*400, 1) - 1000 + rng.normal(0, 20, shape)).astype(np.int16)
+    mask = np.where(lab > 0, np.left_shift(MASK_DTYPE(1), lab.astype(MASK_DTYPE)), 0).astype(MASK_DTYPE)
+    frame = ImageFrame(size=shape[::-1], spacing=(.4,.4,.4))
+
+    with TemporaryDirectory() as d:
+        for name, arr in (('ct', scan), ('mask', mask)):
+            img = SkullEngineScan(data=numpy_to_vtk(arr.flat, deep=0), frame=frame, identifier=Identifier())
+            mb = arr.nbytes/2**20
+            cases = [('sitk .nii.gz', lambda p: sitk.WriteImage(img.itk(), p, imageIO='NiftiImageIO'), '.nii.gz')]
+            cases += [(f'level {l} .nii.gz', lambda p, l=l: img.save(p, compression_level=l, max_workers=max_workers), '.nii.gz') for l in compression_levels]
+            cases += [('.nii', lambda p: img.save(p), '.nii')]
+            for label, f, ext in cases:
+                filepath = os.path.join(d, name + ext)
+                t = perf_counter()
+                f(filepath)
+                t = perf_counter() - t
+                print(f'save_nifti {name} {shape} {arr.dtype}, {label}: {t:.3f} s, {mb/t:.0f} MB/s, {os.path.getsize(filepath)/2**20:.1f} MB on disk')
+                os.remove(filepath)
+
+    return None
+
+
+def bench_cache(shape=(150,512,512)):
+    '''opens a scan saved as .nii.gz, first through ImageCache, which reads the source and writes the cache entry, then again from cache,
+    and prints both times next to reading the source with sitk alone'''
+
+    lab = phantom(shape, num_labels=5, porosity=0.)
+    arr = (lab.astype(np.int16)*400 - 1000)
+    frame = ImageFrame(size=shape[::-1], spacing=(.4,.4,.4))
+
+    with TemporaryDirectory() as d:
+        source = os.path.join(d, 'ct.nii.gz')
+        SkullEngineScan(data=numpy_to_vtk(arr.flat, deep=0), frame=frame, identifier=Identifier()).save(source)
+        cache = ImageCache(os.path.join(d, 'cache'))
+
+        t = perf_counter()
+        saved = sitk.ReadImage(source)
+        print(f'cache {shape}, sitk read of source: {perf_counter()-t:.3f} s')
+        t = perf_counter()
+        img = cache.load(source, SkullEngineScan)
+        print(f'cache {shape}, first open, read and cache: {perf_counter()-t:.3f} s')
+        t = perf_counter()
+        img = cache.load(source, SkullEngineScan)
+        print(f'cache {shape}, second open, from cache: {perf_counter()-t:.4f} s')
+        t = perf_counter()
+        total = int(img.numpy_array().sum(dtype=np.int64))
+        print(f'cache {shape}, first pass over mapped voxels: {perf_counter()-t:.3f} s')
+        del img, saved
+
+    return None
+
+
+def bench_pyramid(shape=(300,512,512), *, levels=2, max_workers=None):
+    '''builds the viewing pyramid of a scan and prints time and memory of its levels relative to the scan'''
+
+    arr = np.random.default_rng(0).integers(-1000, 2000, shape, dtype=np.int16)
+    scan = SkullEngineScan(data=numpy_to_vtk(arr.flat, deep=0), frame=ImageFrame(size=shape[::-1], spacing=(.1,.1,.1)), identifier=Identifier())
+
+    t = perf_counter()
+    pyramid = scan.pyramid(levels=levels, max_workers=max_workers).result()
+    t = perf_counter() - t
+    overhead = sum(p.numpy_array().nbytes for p in pyramid)/arr.nbytes
+    print(f'pyramid {shape}, {levels} levels: {t:.3f} s, {overhead:.3f} of scan memory, {[p.frame.size for p in pyramid]}')
+
+    return None
+
+
+def bench_surfaces(shape=(150,256,256), *, num_labels=20, max_workers=None, brush_radius=5):
+    '''meshes every roi of a mask with SurfaceExtractor, in bricks, against extract_surface on the whole volume per roi,
+    then again after a brush stroke in one roi, which meshes only the bricks around the stroke, and after erasing half of one roi'''
+
+    lab = phantom(shape, num_labels=num_labels, porosity=0.)
+    scan = SkullEngineScan.empty(frame=ImageFrame(size=shape[::-1], spacing=(.4,.4,.4)), dtype=np.int16)
+    mask = SkullEngineMultiRoiMask.empty(ref_scan=scan)
+    mask.set_labels(lab, mask_ids={v: v-1 for v in range(1, num_labels+1)})
+    ids = mask.mask_ids_in_use()
+
+    t = perf_counter()
+    for i in ids:
+        extract_surface(mask.test(mask_id=i), frame=mask.frame)
+    t_full = perf_counter() - t
+
+    extractor = SurfaceExtractor(max_workers=max_workers)
+    t = perf_counter()
+    meshes = {i: f.result() for i, f in extractor.surfaces(mask).items()}
+    t_bricks = perf_counter() - t
+    t = perf_counter()
+    extractor.surfaces(mask)
+    t_cached = perf_counter() - t
+
+    # a spherical brush stroke centered on a voxel of the first roi
+    center = np.array([c[len(c)//2] for c in np.nonzero(lab == ids[0]+1)])
+    ball = np.argwhere(np.sum(np.mgrid[(slice(-brush_radius, brush_radius+1),)*3]**2, axis=0) <= brush_radius**2) - brush_radius + center
+    ball = ball[np.all((ball >= 0) & (ball < shape), axis=1)]
+    mask.set_true(mask_id=ids[0], voxel_index=tuple(ball.T))
+    t = perf_counter()
+    {i: f.result() for i, f in extractor.surfaces(mask).items()}
+    t_stroke = perf_counter() - t
+
+    mask.set_false(mask_id=ids[0], voxel_index=np.nonzero(lab[:shape[0]//2] == ids[0]+1))
+    t = perf_counter()
+    {i: f.result() for i, f in extractor.surfaces(mask).items()}
+    t_edit = perf_counter() - t
+    extractor.shutdown()
+
+    triangles = sum(m.GetNumberOfCells() for m in meshes.values())
+    print(f'surfaces {shape}, {len(ids)} rois, {triangles} triangles: whole volume per roi {t_full:.3f} s, bricks {t_bricks:.3f} s, '
+          f'unchanged {t_cached:.3f} s, brush stroke {t_stroke:.3f} s, half of one roi erased {t_edit:.3f} s')
+
+    return None
+
+
+
+if __name__ == '__main__':
+    bench_read_bin_aa()
+    bench_write_bin_aa()
+    bench_write_bin_aa(max_workers=4)
+    bench_add_mask()
+    bench_resample()
+    bench_resample_mask()
+    bench_resample_backends()
+    bench_save_nifti()
+    bench_cache()
+    bench_pyramid()
+    bench_surfaces()
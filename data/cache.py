@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import dataclasses
+import numpy as np
+
+from .base import *
+
+
+CACHE_MAGIC = b'SECACHE1'
+CACHE_EXT = '.cache'
+_ALIGN = 4096 # arrays start at page boundaries, so they can be memory mapped
+
+
+def source_key(filepath, *, hash=False) -> dict:
+    '''identifies the current version of a source file by size and modification time, and optionally sha256 of its content'''
+    st = os.stat(filepath)
+    key = dict(path=os.path.abspath(filepath), size=st.st_size, mtime_ns=st.st_mtime_ns)
+    if hash:
+        h = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1<<22), b''):
+                h.update(block)
+        key['sha256'] = h.hexdigest()
+    return key
+
+
+def is_stale(header:dict, source) -> bool:
+    '''whether a cache header was written from another version of source, which is a file path or a source_key'''
+    cached = header.get('source') or {}
+    if not isinstance(source, dict):
+        source = source_key(source, hash='sha256' in cached)
+    return any(cached.get(k) != v for k, v in source.items() if k != 'path')
+
+
+def _json_default(obj):
+    # actions and metadata may hold frames, dtypes, numpy scalars, etc., which are kept for provenance only
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def write_cache(filepath, header:dict, arrays:dict, *, chunk_slices=16) -> None:
+    '''writes arrays, a dict of name -> (+z, +y, +x) array, and a json header into a single cache file
+    layout is magic, header length, json header, then each array as raw little-endian chunks of chunk_slices slices,
+    so each array is contiguous, starts at a page boundary, and can be memory mapped
+    the file is written to a temporary name first and renamed, so readers never see a partial file'''
+
+    arrays = {k: np.ascontiguousarray(a, dtype=np.dtype(a.dtype).newbyteorder('<')) for k, a in arrays.items()}
+    header = dict(header, chunk_slices=chunk_slices, arrays={})
+    offset = 0 # from the first page after the header
+    for k, a in arrays.items():
+        header['arrays'][k] = dict(dtype=a.dtype.str, shape=list(a.shape), offset=offset)
+        offset += _aligned(a.nbytes)
+    text = json.dumps(header, default=_json_default).encode()
+    start = _aligned(len(CACHE_MAGIC) + 8 + len(text))
+
+    tmp = str(filepath) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(len(text).to_bytes(8, 'little'))
+        f.write(text)
+        for k, a in arrays.items():
+            f.seek(start + header['arrays'][k]['offset'])
+            if a.size:
+                flat = a.reshape(len(a) if a.ndim else 1, -1)
+                for i in range(0, flat.shape[0], chunk_slices):
+                    f.write(memoryview(flat[i:i+chunk_slices]).cast('B'))
+        f.truncate(start + offset)
+    os.replace(tmp, filepath)
+
+    return None
+
+
+def _aligned(n) -> int:
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _read_header(filepath) -> tuple[dict, int]:
+    # json header and where arrays start
+    with open(filepath, 'rb') as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise ValueError(f'{filepath} is not a cache file')
+        n = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(n)), _aligned(len(CACHE_MAGIC) + 8 + n)
+
+
+def read_cache_header(filepath) -> dict:
+    '''reads only the json header of a cache file'''
+    return _read_header(filepath)[0]
+
+
+def read_cache(filepath, *, mmap_mode='c') -> tuple[dict, dict]:
+    '''reads header and arrays of a cache file, arrays are memory mapped with mmap_mode ('c' is copy-on-write,
+    'r' read-only, 'r+' writes through to the file), or read into memory if mmap_mode is None'''
+    header, start = _read_header(filepath)
+    arrays = {}
+    for k, a in header['arrays'].items():
+        dtype, shape, offset = np.dtype(a['dtype']), tuple(a['shape']), start + a['offset']
+        if mmap_mode and dtype.itemsize * int(np.prod(shape)):
+            arrays[k] = np.memmap(filepath, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape)
+        else:
+            arrays[k] = np.fromfile(filepath, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return header, arrays
+
+
+
+class ImageCache:
+    '''this class keeps cache files of images read from slower formats, e.g. dicom or .nii.gz, in a directory
+    entries are named after the source path, and are stale once size or modification time of the source changes,
+    or its content if hash is True'''
+
+    def __init__(self, dirpath, *, hash=False) -> None:
+        self.dirpath = os.path.realpath(os.path.expanduser(dirpath))
+        self.hash = hash
+        os.makedirs(self.dirpath, exist_ok=True)
+        return None
+
+
+    def entry(self, source) -> str:
+        '''path of cache file of source'''
+        name = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()
+        return os.path.join(self.dirpath, name + CACHE_EXT)
+
+
+    def get(self, source, cls, **kw):
+        '''reopens image of source from cache, or returns None if it is not cached or stale, kw is passed to cls.read_cache'''
+        entry = self.entry(source)
+        if not os.path.isfile(entry):
+            return None
+        try:
+            header = read_cache_header(entry)
+        except (ValueError, OSError):
+            return None
+        if is_stale(header, source):
+            return None
+        return cls.read_cache(entry, **kw)
+
+
+    def put(self, source, img) -> str:
+        '''caches img as the current version of source, and returns path of cache file'''
+        entry = self.entry(source)
+        img.write_cache(entry, source=source_key(source, hash=self.hash))
+        return entry
+
+
+    def load(self, source, cls, *, read_kw=None, **kw):
+        '''reopens image of source from cache if possible, otherwise reads it with cls.read(source, **read_kw) and caches it
+        the returned image is always backed by the cache file, kw is passed to cls.read_cache'''
+        read_kw = read_kw or {}
+        img = self.get(source, cls, **kw)
+        if img is None:
+            self.put(source, cls.read(source, **read_kw))
+            img = cls.read_cache(self.entry(source), **kw)
+        return img
@@ -0,0 +1,149 @@
+''' this file finds, names, and reads cases, which data.convert and data.export share, so both see a case the same way.
+a case is one scan with its roi's, in one of these formats:
+    cass    a CASS archive
+    bin     a directory of the members of a CASS archive, Patient_info.bin, Patient_data.bin, Mask_Info.bin, 0.bin, ...
+    nifti   <case>.nii.gz, with roi's as a labelmap of mask id + 1 in <case>_mask.nii.gz next to it, if there are any,
+            and each roi the labelmap does not keep whole, since it shares voxels with a lower mask id, in <case>_mask_<id>.nii.gz
+    dicom   a directory of a ct series, or any file of one, which holds the scan only
+'''
+
+import os
+import re
+import csv
+import glob
+
+from .image import *
+from .manager import *
+
+
+MASK_SUFFIX = '_mask' # labelmap of a nifti case, <case>_mask.nii.gz
+_EXTS = ('.CASS', '.nii.gz', '.nii', '.dcm')
+
+
+def input_kind(path) -> str:
+    '''format of a case, one of cass, bin, nifti, or dicom'''
+    if os.path.isdir(path):
+        return 'bin' if os.path.isfile(os.path.join(path, 'Patient_info.bin')) else 'dicom'
+    if path.lower().endswith('.cass'):
+        return 'cass'
+    if path.lower().endswith(('.nii', '.nii.gz')):
+        return 'nifti'
+    return 'dicom'
+
+
+def case_name(path) -> str:
+    '''name of a case, its file or directory name without extension, or the directory name for a file of a dicom series'''
+    path = os.path.normpath(path)
+    if os.path.isfile(path) and input_kind(path) == 'dicom':
+        path = os.path.dirname(os.path.abspath(path))
+    name = os.path.basename(path)
+    for ext in _EXTS:
+        if name.lower().endswith(ext.lower()):
+            return name[:-len(ext)]
+    return name
+
+
+def mask_path(path) -> str:
+    '''labelmap next to nifti file path, see MASK_SUFFIX'''
+    for ext in ('.nii.gz', '.nii'):
+        if path.endswith(ext):
+            return path[:-len(ext)] + MASK_SUFFIX + ext
+    return path + MASK_SUFFIX
+
+
+def roi_path(path, mask_id) -> str:
+    '''binary nifti of roi mask_id next to nifti file path, for roi's overlapped in the labelmap, see mask_path'''
+    base, ext = _split_nifti(mask_path(path))
+    return f'{base}_{mask_id}{ext}'
+
+
+def roi_paths(path) -> dict:
+    '''{mask id: file} of the binary nifti of roi's next to nifti file path, see roi_path'''
+    base, ext = _split_nifti(os.path.basename(mask_path(path)))
+    d = os.path.dirname(path) or '.'
+    if not os.path.isdir(d):
+        return {}
+    pattern = re.compile(re.escape(base) + r'_(\d+)' + re.escape(ext))
+    found = ((pattern.fullmatch(e.name), e.path) for e in os.scandir(d) if e.is_file())
+    return {int(m.group(1)): p for m, p in found if m}
+
+
+def _split_nifti(path) -> tuple:
+    # path without and with its nifti extension
+    for ext in ('.nii.gz', '.nii'):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return path, ''
+
+
+def case_files(path) -> list:
+    '''files a case is read from, whose modification times decide if its output is up to date'''
+    kind = input_kind(path)
+    if os.path.isdir(path):
+        return [e.path for e in os.scandir(path) if e.is_file()]
+    if kind == 'dicom':
+        d = os.path.dirname(os.path.abspath(path))
+        return [e.path for e in os.scandir(d) if e.is_file()]
+    if kind == 'nifti':
+        return [path, *(p for p in [mask_path(path)] if os.path.isfile(p)), *roi_paths(path).values()]
+    return [path]
+
+
+def load_case(path) -> DataManager:
+    '''reads a case into a DataManager, with roi's of the labelmap of a nifti case, see mask_path, keeping mask id = label - 1,
+    and the voxels of overlapped roi's, see roi_path, on top'''
+    kind = input_kind(path)
+    if kind in ('cass', 'bin'):
+        return DataManager.from_aa(path)
+
+    if kind == 'dicom' and os.path.isdir(path):
+        path = min(e.path for e in os.scandir(path) if e.is_file())
+    man = DataManager()
+    man.set_scan(SkullEngineScan.read(path, has_phi=kind == 'dicom'))
+    if kind == 'nifti' and os.path.isfile(mask_path(path)):
+        labels = SkullEngineScan.read(mask_path(path), has_phi=False).numpy_array()
+        lookup = label_lookup(labels)
+        mask_ids = {v: v-1 for v in lookup[0].tolist() if v > 0}
+        man.get_mask_ids().extend(mask_ids.values())
+        man.get_mask().set_labels(labels, mask_ids=mask_ids, lookup=lookup)
+        for i, p in sorted(roi_paths(path).items()):
+            if i not in man.get_mask_ids():
+                man.get_mask_ids().append(i)
+            man.get_mask().set_true(mask_id=i, voxel_index=SkullEngineScan.read(p, has_phi=False).numpy_array() > 0)
+    return man
+
+
+def expand_inputs(patterns=(), manifests=()) -> list:
+    '''paths of cases from glob patterns, and from manifest files listing one path per line, or csv files with a path column,
+    e.g. the output of data.crawler; relative paths of a manifest are relative to the manifest
+    labelmaps and roi's of nifti cases, see mask_path and roi_path, are dropped, and so are paths of the same case, e.g. files of one dicom series'''
+
+    paths = []
+    for pattern in patterns:
+        paths += sorted(glob.glob(pattern, recursive=True)) or [pattern]
+    for manifest in manifests:
+        root = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, newline='', encoding='utf-8') as f:
+            lines = [l.strip() for l in f]
+        if lines and 'path' in next(csv.reader(lines[:1])):
+            entries = [row['path'] for row in csv.DictReader(lines) if row['path'] and not row.get('error')]
+        else:
+            entries = [l for l in lines if l and not l.startswith('#')]
+        paths += [os.path.join(root, p) for p in entries]
+
+    out, seen = [], set()
+    for p in paths:
+        if input_kind(p) == 'nifti' and MASK_SUFFIX in p and any(os.path.isfile(s) for s in _scan_paths(p)):
+            continue
+        key = (os.path.dirname(os.path.abspath(p)) if input_kind(p) == 'dicom' and os.path.isfile(p) else os.path.abspath(p))
+        if key not in seen:
+            seen.add(key)
+            out.append(p)
+    return out
+
+
+def _scan_paths(path) -> list:
+    # nifti files whose labelmap or roi could be path
+    base, ext = _split_nifti(path)
+    m = re.fullmatch(r'(.*)' + re.escape(MASK_SUFFIX) + r'(_\d+)?', base)
+    return [m.group(1) + ext] if ext and m else []
@@ -0,0 +1,148 @@
+''' this file converts cases between CASS archives, AA bin files, NIfTI, and DICOM, see `python -m data convert --help`.
+a case is read into a DataManager with load_case and written in the target format, see case for the formats, of which cass is read only,
+since writing one needs rar.
+cases are converted in a process pool, one case at a time per worker, so memory is bounded by the number of workers.
+outputs are written under a temporary name and renamed when complete, and outputs newer than all files of their case
+are skipped, so an interrupted run picks up where it stopped.
+'''
+
+import os
+import sys
+import shutil
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+from .image import *
+from .dicom import *
+from .nifti import *
+from .manager import *
+from .case import *
+
+
+CONVERT_FORMATS = ['bin', 'nifti', 'dicom'] # output formats, cass is read only
+
+
+def output_path(path, outdir, fmt) -> str:
+    '''where case path goes in format fmt, a file for nifti and a directory otherwise'''
+    if fmt not in CONVERT_FORMATS:
+        raise ValueError(f'format must be one of {CONVERT_FORMATS}')
+    name = case_name(path)
+    return os.path.join(outdir, name + '.nii.gz' if fmt == 'nifti' else name)
+
+
+def is_up_to_date(path, output) -> bool:
+    '''whether output exists and all its files are newer than all files of case path'''
+    if not os.path.exists(output) or not os.path.exists(path):
+        return False
+    outputs = [e.path for e in os.scandir(output) if e.is_file()] if os.path.isdir(output) else [output]
+    if not outputs:
+        return False
+    return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in case_files(path))
+
+
+def write_case(man:DataManager, output, fmt, *, max_workers=None) -> None:
+    '''writes the case of man to output in format fmt, see output_path, replacing what is there only once it is complete
+    max_workers is the number of threads compressing nifti or writing dicom slices'''
+
+    d, name = os.path.split(output)
+    tmp = os.path.join(d, '.tmp.' + name) # same directory, so the rename is atomic, and same extension, which picks the writer
+    scan = man.get_scan()
+
+    if fmt == 'nifti':
+        mask = man.get_mask()
+        geometry = dict(spacing=scan.frame.spacing, origin=scan.frame.origin, direction=np.ravel(scan.frame.direction), max_workers=max_workers)
+        for p in [mask_path(output), *roi_paths(output).values()]: # left from an earlier conversion of the case
+            if os.path.isfile(p):
+                os.remove(p)
+        if mask.mask_ids_in_use():
+            write_nifti(mask.to_labelmap(), mask_path(tmp), **geometry)
+            os.replace(mask_path(tmp), mask_path(output))
+            # the labelmap keeps the lowest id of a voxel, so the roi's it overlaps go whole into files of their own
+            for i in mask.overlapped_ids():
+                write_nifti(mask.test(mask_id=i).astype(np.uint8), roi_path(tmp, i), **geometry)
+                os.replace(roi_path(tmp, i), roi_path(output, i))
+        scan.save(tmp, max_workers=max_workers)
+        os.replace(tmp, output) # last, so output is newer than its labelmap
+        return None
+
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    if fmt == 'bin':
+        man.write_aa(tmp)
+    elif fmt == 'dicom':
+        write_dicom_series(scan.numpy_array(), tmp, frame=scan.frame, metadata=scan.identifier.metadata, max_workers=max_workers)
+    else:
+        raise ValueError(f'format must be one of {CONVERT_FORMATS}')
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    os.replace(tmp, output)
+    return None
+
+
+def convert_case(path, outdir, fmt, *, max_workers=None) -> dict:
+    '''converts case path into outdir in format fmt, see load_case and write_case
+    returns a dict of source, output, bytes read, seconds, and error, if any'''
+
+    output = output_path(path, outdir, fmt)
+    num_bytes = 0
+    t = perf_counter()
+    try:
+        num_bytes = sum(os.path.getsize(f) for f in case_files(path))
+        write_case(load_case(path), output, fmt, max_workers=max_workers)
+    except Exception as e:
+        return dict(source=path, output=output, bytes=num_bytes, seconds=perf_counter()-t, error=f'{type(e).__name__}: {e}')
+    return dict(source=path, output=output, bytes=num_bytes, seconds=perf_counter()-t, error='')
+
+
+def convert_cases(paths, outdir, fmt, *, force=False, max_workers=None, threads=None, max_tasks_per_child=None) -> dict:
+    '''converts cases of paths into outdir in format fmt with convert_case in a process pool of max_workers, one case per worker at a time
+    cases whose output is up to date are skipped unless force, see is_up_to_date, and each case prints its throughput as it finishes
+    threads is the number of threads of each worker, see write_case, and max_tasks_per_child, if given, restarts workers
+    after that many cases, which returns their memory to the system on long runs, and needs python 3.11, so older ones ignore it
+    returns counts, bytes read, and seconds of this run'''
+
+    if fmt not in CONVERT_FORMATS:
+        raise ValueError(f'format must be one of {CONVERT_FORMATS}')
+    os.makedirs(outdir, exist_ok=True)
+
+    num_converted = num_skipped = num_errors = num_bytes = 0
+    t0 = perf_counter()
+    pool_kw = {}
+    if max_tasks_per_child is not None:
+        if sys.version_info >= (3, 11):
+            pool_kw['max_tasks_per_child'] = max_tasks_per_child
+        else:
+            print('max_tasks_per_child needs python 3.11 or newer, workers are not restarted')
+    with ProcessPoolExecutor(max_workers=max_workers, **pool_kw) as executor:
+        paths = iter(paths)
+        pending = set()
+        max_pending = 2 * (max_workers or os.cpu_count() or 1) # bounded, so a long list of cases is not queued all at once
+        while True:
+            while len(pending) < max_pending:
+                path = next(paths, None)
+                if path is None:
+                    break
+                if not force and is_up_to_date(path, output_path(path, outdir, fmt)):
+                    num_skipped += 1
+                    print(f'{path}: up to date')
+                    continue
+                pending.add(executor.submit(convert_case, path, outdir, fmt, max_workers=threads))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                r = future.result()
+                if r['error']:
+                    num_errors += 1
+                    print(f'{r["source"]}: {r["error"]}')
+                else:
+                    num_converted += 1
+                    num_bytes += r['bytes']
+                    print(f'{r["source"]} -> {r["output"]}: {r["bytes"]/2**20:.1f} MB in {r["seconds"]:.2f} s, {r["bytes"]/2**20/max(r["seconds"], 1e-9):.1f} MB/s')
+
+    elapsed = perf_counter() - t0
+    print(f'done, {num_converted} converted, {num_skipped} up to date, {num_errors} errors, {num_bytes/2**20/max(elapsed, 1e-9):.1f} MB/s overall')
+
+    return dict(converted=num_converted, skipped=num_skipped, errors=num_errors, bytes=num_bytes, seconds=elapsed)
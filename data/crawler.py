@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+''' this file crawls a directory tree for dicom headers and streams one csv row per file, e.g.
+    python -m data.crawler X:\\ headers.csv --pattern 0000.dcm --tags PatientName EthnicGroup
+headers are read in a process pool, stopping before pixel data, and rows are appended to the output in walk order.
+a checkpoint is saved next to the output every so often, so a killed crawl resumes where it left off when run again.
+'''
+
+import os
+import csv
+import json
+import argparse
+from itertools import islice
+from time import perf_counter
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pydicom
+
+
+CRAWL_TAGS = ['PatientID', 'PatientName', 'EthnicGroup', 'StudyInstanceUID', 'StudyDate', 'SeriesInstanceUID', 'Modality', 'InstanceNumber']
+
+
+def walk_files(root, *, pattern='*'):
+    '''lazily yields paths of regular files under root whose name matches pattern, in sorted order, so every walk is the same'''
+    for d, dirs, names in os.walk(root):
+        dirs.sort() # os.walk descends in the order of dirs
+        for name in sorted(names):
+            if fnmatch(name, pattern):
+                yield os.path.join(d, name)
+
+
+def _crawl_chunk(paths, tags) -> list:
+    # rows of (path, error, *tag values), errors are recorded instead of swallowed
+    rows = []
+    for p in paths:
+        try:
+            ds = pydicom.dcmread(p, stop_before_pixels=True, specific_tags=tags)
+        except Exception as e:
+            rows.append([p, f'{type(e).__name__}: {e}'] + ['']*len(tags))
+        else:
+            rows.append([p, ''] + [str(ds.get(k, '')).strip() for k in tags])
+    return rows
+
+
+def _save_checkpoint(filepath, **kw) -> None:
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump(kw, f)
+    os.replace(filepath + '.tmp', filepath)
+    return None
+
+
+def crawl(root, output, *, pattern='*', tags=CRAWL_TAGS, max_workers=None, chunksize=64, checkpoint_every=10000, report_every=10.) -> dict:
+    '''crawls dicom headers of files under root into csv output, with columns path, error, and tags
+    output is append-only, with one row per walked file in walk order, see walk_files; a checkpoint file (output + '.ckpt')
+    records how much of it is complete as a byte offset and a number of files, and a rerun truncates anything written after
+    the last checkpoint and skips that many files of the walk, so resuming costs no memory however many files were crawled
+    files added to or removed from the part of the tree already crawled are missed or crawled twice on resume
+    returns counts and throughput of this run'''
+
+    checkpoint = output + '.ckpt'
+    num_done = 0
+    if os.path.isfile(checkpoint) and os.path.isfile(output):
+        with open(checkpoint) as f:
+            ckpt = json.load(f)
+        if 'files' not in ckpt:
+            raise ValueError(f'{checkpoint} does not record where the walk stopped, delete it and {output} to crawl again')
+        num_done = ckpt['files']
+        with open(output, 'r+', newline='', encoding='utf-8') as f:
+            f.truncate(ckpt['offset']) # drop rows written after the last checkpoint, possibly incomplete
+            f.seek(0)
+            if next(csv.reader([f.readline()]), None) != ['path', 'error', *tags]:
+                raise ValueError(f'{output} was written with different tags')
+        print(f'resuming, {num_done} files already crawled')
+    else:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(['path', 'error', *tags])
+
+    def _chunks():
+        paths = islice(walk_files(root, pattern=pattern), num_done, None)
+        while True:
+            chunk = list(islice(paths, chunksize))
+            if not chunk:
+                break
+            yield chunk
+
+    num_files = num_errors = since_checkpoint = 0
+    t0 = t_report = perf_counter()
+    with open(output, 'a', newline='', encoding='utf-8') as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        writer = csv.writer(f)
+        chunks = enumerate(_chunks())
+        pending = {} # future -> number of its chunk in the walk
+        finished_rows = {} # chunks finished ahead of an earlier one, by their number in the walk, written once it is their turn
+        num_written = 0 # chunks written so far
+        max_pending = 4 * (max_workers or os.cpu_count() or 1) # bounded, so the walk never runs far ahead of the workers
+        while True:
+            while len(pending) + len(finished_rows) < max_pending:
+                k, chunk = next(chunks, (None, None))
+                if chunk is None:
+                    break
+                pending[executor.submit(_crawl_chunk, chunk, tags)] = k
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                finished_rows[pending.pop(future)] = future.result()
+            while num_written in finished_rows:
+                rows = finished_rows.pop(num_written)
+                num_written += 1
+                writer.writerows(rows)
+                num_files += len(rows)
+                num_errors += sum(1 for r in rows if r[1])
+                since_checkpoint += len(rows)
+
+            if since_checkpoint >= checkpoint_every:
+                f.flush()
+                os.fsync(f.fileno())
+                _save_checkpoint(checkpoint, offset=os.path.getsize(output), files=num_done+num_files)
+                since_checkpoint = 0
+
+            if perf_counter() - t_report >= report_every:
+                t_report = perf_counter()
+                print(f'{num_files} files, {num_errors} errors, {num_files/(t_report-t0):.1f} files per second')
+
+        f.flush()
+        os.fsync(f.fileno())
+        _save_checkpoint(checkpoint, offset=os.path.getsize(output), files=num_done+num_files)
+
+    elapsed = perf_counter() - t0
+    print(f'done, {num_files} files, {num_errors} errors, {num_files/max(elapsed, 1e-9):.1f} files per second')
+
+    return dict(files=num_files, errors=num_errors, skipped=num_done, seconds=elapsed)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m data.crawler', description='crawls dicom headers into csv, resumable')
+    parser.add_argument('root')
+    parser.add_argument('output')
+    parser.add_argument('--pattern', default='*', help='file name pattern, e.g. 0000.dcm')
+    parser.add_argument('--tags', nargs='+', default=CRAWL_TAGS, help='dicom keywords to record')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=64)
+    parser.add_argument('--checkpoint-every', type=int, default=10000)
+    args = parser.parse_args()
+    crawl(args.root, args.output, pattern=args.pattern, tags=args.tags, max_workers=args.workers, chunksize=args.chunksize, checkpoint_every=args.checkpoint_every)
@@ -0,0 +1,314 @@
+import os
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.datadict import tag_for_keyword, dictionary_description
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+from .base import *
+from .util import *
+
+
+# tags needed to group, sort, and decode slices of a series
+SERIES_TAGS = [
+    'SeriesInstanceUID',
+    'InstanceNumber',
+    'ImagePositionPatient',
+    'ImageOrientationPatient',
+    'PixelSpacing',
+    'SliceThickness',
+    'Rows',
+    'Columns',
+    'BitsAllocated',
+    'BitsStored',
+    'PixelRepresentation',
+    'RescaleSlope',
+    'RescaleIntercept',
+]
+
+
+# patient and study tags copied from metadata by write_dicom_series, the rest of the header describes the volume itself
+WRITE_TAGS = [
+    'PatientName',
+    'PatientID',
+    'PatientBirthDate',
+    'PatientSex',
+    'EthnicGroup',
+    'StudyInstanceUID',
+    'StudyDate',
+    'StudyTime',
+    'StudyID',
+    'StudyDescription',
+    'AccessionNumber',
+    'SeriesDescription',
+]
+
+
+def read_header(filepath, *, specific_tags=SERIES_TAGS):
+    '''reads dicom header without pixel data, or returns None if filepath is not a readable dicom file'''
+    try:
+        return pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=specific_tags)
+    except Exception: # anything unreadable is simply not part of a series
+        return None
+
+
+def header_metadata(ds) -> dict:
+    '''converts pydicom header to metadata dict keyed like sitk, e.g. '0020|000e', skipping sequences and binary values'''
+    return {
+        f'{e.tag.group:04x}|{e.tag.element:04x}': str(e.value)
+        for e in ds.iterall()
+        if e.VR not in ('SQ', 'OB', 'OW', 'OF', 'OD', 'OL', 'UN') and e.tag != 0x7fe00010
+    }
+
+
+def _slice_normal(ds) -> np.ndarray:
+    if 'ImageOrientationPatient' in ds:
+        iop = np.array(ds.ImageOrientationPatient, dtype=float)
+        return np.cross(iop[:3], iop[3:])
+    return np.array([0.,0.,1.])
+
+
+def scan_series(filepath, *, max_workers=None, index=None) -> list:
+    '''finds all files in the same series and same directory as filepath from their headers only
+    with a DicomIndex, only files the index lists in the series are read, instead of every file in the directory
+    returns list of (filepath, header) sorted along the slice normal, or by instance number if position is missing'''
+
+    series_instance_uid = pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=['SeriesInstanceUID']).get('SeriesInstanceUID', '')
+    if index is not None:
+        files = index.series_of(filepath)
+    else:
+        files = sorted(e.path for e in os.scandir(os.path.dirname(os.path.abspath(filepath))) if e.is_file())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = executor.map(read_header, files)
+        series = [(f, h) for f, h in zip(files, headers) if h is not None and 'Rows' in h and h.get('SeriesInstanceUID', '') == series_instance_uid]
+
+    if not series:
+        raise ValueError(f'no image found in series of {filepath}')
+
+    normal = _slice_normal(series[0][1])
+    if all('ImagePositionPatient' in h for _, h in series):
+        series.sort(key=lambda x: float(np.dot(np.array(x[1].ImagePositionPatient, dtype=float), normal)))
+    else:
+        series.sort(key=lambda x: int(x[1].get('InstanceNumber', 0) or 0))
+
+    return series
+
+
+def _output_dtype(headers, *, rescale) -> np.dtype:
+    # smallest type that holds every slice after rescale, similar to what gdcm chooses
+    h = headers[0]
+    bits_allocated, bits_stored, signed = int(h.get('BitsAllocated', 16)), int(h.get('BitsStored', 16)), int(h.get('PixelRepresentation', 0))
+    if not rescale:
+        return np.dtype(f'{"i" if signed else "u"}{bits_allocated//8}')
+
+    slopes = {float(h.get('RescaleSlope', 1.) or 1.) for h in headers}
+    intercepts = {float(h.get('RescaleIntercept', 0.) or 0.) for h in headers}
+    if slopes != {1.} or not all(b.is_integer() for b in intercepts):
+        return np.dtype(np.float32)
+
+    lo, hi = (-(1 << bits_stored-1), (1 << bits_stored-1)-1) if signed else (0, (1 << bits_stored)-1)
+    lo, hi = lo + min(intercepts), hi + max(intercepts)
+    for dtype in (np.int16, np.int32):
+        if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+def _read_pixels(filepath) -> np.ndarray:
+    return pydicom.dcmread(filepath).pixel_array
+
+
+def middle_out(n) -> list:
+    '''slice indices from the middle outwards, e.g. 2, 1, 3, 0, 4 for n = 5, so the slices a viewer opens on come first'''
+    order = [n//2]
+    for d in range(1, n//2 + 1):
+        order += [k for k in (n//2 - d, n//2 + d) if 0 <= k < n]
+    return order
+
+
+def read_dicom_series(filepath, *, rescale=False, max_workers=None, use_processes=False, index=None,
+                      on_allocate=None, on_slice=None, cancel=None, **kw) -> tuple[np.ndarray, ImageFrame, dict, dict]:
+    '''reads the dicom series that filepath belongs to into a single preallocated (+z, +y, +x) array
+    headers are read once, without pixel data, to find, sort, and size the series, then slices are decoded concurrently
+    by a thread pool, or a process pool if use_processes, and written straight into the volume, from the middle slice outwards
+    rescale applies rescale slope and intercept of each slice, and index is an optional DicomIndex passed to scan_series
+    for progressive display, on_allocate(arr, frame, metadata) is called once the still empty volume is allocated, which is after
+    the middle slice is decoded, so a series pydicom cannot decode fails before anything is handed out, and on_slice(k) is called
+    after slice k is written, possibly from a worker thread; once cancel, e.g. a threading.Event, is set, remaining slices
+    are skipped and CancelledError is raised
+    returns array, frame, metadata of filepath, and seconds spent in each stage'''
+
+    timings = {}
+
+    t = perf_counter()
+    series = scan_series(filepath, max_workers=max_workers, index=index)
+    files, headers = zip(*series)
+    metadata = header_metadata(pydicom.dcmread(filepath, stop_before_pixels=True))
+    timings['scan'] = perf_counter() - t
+
+    t = perf_counter()
+    h = headers[0]
+    rows, cols = int(h.Rows), int(h.Columns)
+    dy, dx = map(float, h.get('PixelSpacing', (1., 1.)))
+    iop = np.array(h.get('ImageOrientationPatient', (1.,0.,0.,0.,1.,0.)), dtype=float)
+    normal = _slice_normal(h)
+    if len(headers) > 1 and all('ImagePositionPatient' in h for h in headers):
+        positions = np.array([h.ImagePositionPatient for h in headers], dtype=float)
+        dz = float(np.mean(np.diff(positions @ normal)))
+    else:
+        dz = float(h.get('SliceThickness', 1.) or 1.)
+    frame = ImageFrame(
+        size=(cols, rows, len(headers)),
+        spacing=(dx, dy, dz),
+        origin=tuple(map(float, h.get('ImagePositionPatient', (0.,0.,0.)))),
+        direction=tuple(map(tuple, np.stack((iop[:3], iop[3:], normal), axis=1).tolist())), # same as sitk, columns are axes
+    )
+    order = middle_out(len(files))
+    first = _read_pixels(files[order[0]]) # before anything is handed out, so a series pydicom cannot decode fails here
+    arr = itk_empty((len(headers), rows, cols), dtype=_output_dtype(headers, rescale=rescale)) # so Image.itk need not copy it
+    timings['allocate'] = perf_counter() - t
+    if on_allocate is not None:
+        on_allocate(arr, frame, metadata)
+
+    def _put(k, px):
+        if rescale:
+            slope, intercept = float(headers[k].get('RescaleSlope', 1.) or 1.), float(headers[k].get('RescaleIntercept', 0.) or 0.)
+            if slope != 1.:
+                px = px * slope
+            np.add(px, intercept, out=arr[k], casting='unsafe')
+        else:
+            arr[k] = px
+        if on_slice is not None:
+            on_slice(k)
+
+    def _cancelled():
+        return cancel is not None and cancel.is_set()
+
+    t = perf_counter()
+    _put(order[0], first)
+    order = order[1:]
+    if use_processes:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for k, px in zip(order, executor.map(_read_pixels, [files[k] for k in order], chunksize=8)):
+                if _cancelled():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+                _put(k, px)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda k: None if _cancelled() else _put(k, _read_pixels(files[k])), order))
+    timings['decode'] = perf_counter() - t
+    if _cancelled():
+        raise CancelledError(f'reading {filepath} was cancelled')
+
+    return arr, frame, metadata, timings
+
+
+def read_dicom(filepath, *, rescale=False, **kw) -> sitk.Image:
+    '''reads the dicom series that filepath belongs to with sitk, whose gdcm decodes transfer syntaxes pydicom cannot,
+    into the same values and type as read_dicom_series: stored values, or values after rescale slope and intercept if rescale
+    gdcm always applies rescale, so it is undone with slope and intercept of filepath, and metadata of filepath is attached'''
+
+    # get series id from the file
+    file_reader = sitk.ImageFileReader()
+    file_reader.SetFileName(filepath)
+    file_reader.SetImageIO("GDCMImageIO")
+    file_reader.LoadPrivateTagsOn()
+    file_reader.ReadImageInformation()
+    series_instance_uid = ''
+    if file_reader.HasMetaDataKey('0020|000e'):
+        series_instance_uid = file_reader.GetMetaData('0020|000e')
+
+    # find all the files in the same series and same directory
+    dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(os.path.dirname(filepath), series_instance_uid)
+
+    # read the series
+    reader = sitk.ImageSeriesReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileNames(dicom_names)
+    reader.SetOutputPixelType(sitk.sitkUnknown)
+    reader.LoadPrivateTagsOn()
+    img = reader.Execute()
+
+    # header of filepath keyed like pydicom, which is all _output_dtype needs
+    header = {}
+    for keyword in ('BitsAllocated', 'BitsStored', 'PixelRepresentation', 'RescaleSlope', 'RescaleIntercept'):
+        tag = tag_for_keyword(keyword)
+        key = f'{tag >> 16:04x}|{tag & 0xffff:04x}'
+        if file_reader.HasMetaDataKey(key) and file_reader.GetMetaData(key).strip():
+            header[keyword] = file_reader.GetMetaData(key).strip()
+    slope, intercept = float(header.get('RescaleSlope', 1.)), float(header.get('RescaleIntercept', 0.))
+
+    arr = sitk.GetArrayViewFromImage(img)
+    out = itk_empty(arr.shape, _output_dtype([header], rescale=rescale))
+    values = arr if rescale or (slope, intercept) == (1., 0.) else (arr - intercept) / slope
+    if values.dtype.kind == 'f' and out.dtype.kind != 'f':
+        values = np.rint(values)
+    np.copyto(out, values, casting='unsafe')
+    out = itk_image_of(out)
+    out.CopyInformation(img)
+    for key in file_reader.GetMetaDataKeys():
+        out.SetMetaData(key, file_reader.GetMetaData(key))
+
+    return out
+
+
+def write_dicom_series(arr:np.ndarray, dirpath, *, frame:ImageFrame, metadata:dict=None, max_workers=None) -> list:
+    '''writes (+z, +y, +x) arr of frame as a ct dicom series, one file per slice named 0000.dcm, 0001.dcm, ... in dirpath
+    voxels are stored as int16, rounded and clipped if needed, with rescale slope 1 and intercept 0, so values are kept as is
+    tags of WRITE_TAGS are copied from metadata, keyed like sitk, e.g. '0010|0010', or by name, e.g. "Patient's Name",
+    and a new series uid is generated, as is a study uid if metadata has none
+    slices are written by a thread pool of max_workers, and file paths are returned in slice order'''
+
+    if arr.dtype != np.int16:
+        arr = np.clip(np.rint(arr) if arr.dtype.kind == 'f' else arr, -32768, 32767).astype(np.int16)
+    os.makedirs(dirpath, exist_ok=True)
+    metadata = metadata or {}
+
+    common = Dataset()
+    for keyword in WRITE_TAGS:
+        tag = tag_for_keyword(keyword)
+        for key in (f'{tag >> 16:04x}|{tag & 0xffff:04x}', dictionary_description(tag)):
+            if key in metadata and str(metadata[key]).strip():
+                setattr(common, keyword, str(metadata[key]).strip())
+                break
+    common.StudyInstanceUID = common.get('StudyInstanceUID', None) or generate_uid()
+    common.SeriesInstanceUID = generate_uid()
+    common.FrameOfReferenceUID = generate_uid()
+    common.SOPClassUID = CTImageStorage
+    common.Modality = 'CT'
+    common.SeriesNumber = 1
+    direction = np.array(frame.direction, dtype=float) # columns are axes
+    common.ImageOrientationPatient = [float(v) for v in (*direction[:,0], *direction[:,1])]
+    common.PixelSpacing = [float(frame.spacing[1]), float(frame.spacing[0])]
+    common.SliceThickness = float(frame.spacing[2])
+    common.Rows, common.Columns = arr.shape[1:]
+    common.SamplesPerPixel = 1
+    common.PhotometricInterpretation = 'MONOCHROME2'
+    common.BitsAllocated = 16
+    common.BitsStored = 16
+    common.HighBit = 15
+    common.PixelRepresentation = 1
+    common.RescaleSlope = 1
+    common.RescaleIntercept = 0
+
+    def _write(k):
+        ds = Dataset()
+        ds.update(common)
+        ds.SOPInstanceUID = generate_uid()
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [float(v) for v in np.array(frame.origin) + direction[:,2] * frame.spacing[2] * k]
+        ds.PixelData = np.ascontiguousarray(arr[k]).astype('<i2', copy=False).tobytes()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        filepath = os.path.join(dirpath, f'{k:04d}.dcm')
+        ds.save_as(filepath, enforce_file_format=True)
+        return filepath
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_write, range(arr.shape[0])))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+''' this file exports every roi of every case as surface meshes, e.g.
+    python -m data.export cases/*.CASS nifti/*.nii.gz meshes --formats .stl .vtp --reduction .5
+a case is found and read with case.load_case, the same as data.convert does, so the nifti output of data.convert exports as is,
+with roi's from the labelmap <case>_mask.nii.gz next to the scan, and the label value of each roi in the manifest.
+cases are exported in a process pool, one case at a time per worker, so memory is bounded by the number of workers,
+and meshes go to outdir/<case>/<mask_id><format> while one manifest row per roi is appended as each case finishes.
+'''
+
+import os
+import csv
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtkmodules.vtkFiltersCore import vtkQuadricDecimation
+from vtkmodules.vtkIOGeometry import vtkSTLWriter
+from vtkmodules.vtkIOPLY import vtkPLYWriter
+from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
+from .image import *
+from .surface import *
+from .manager import *
+from .case import *
+
+
+MANIFEST_COLUMNS = ['case', 'mask_id', 'label', 'triangles_extracted', 'triangles', 'seconds_load', 'seconds_extract', 'seconds_decimate', 'seconds_write', 'paths', 'error']
+
+
+def _stl_writer():
+    writer = vtkSTLWriter()
+    writer.SetFileTypeToBinary()
+    return writer
+
+
+def _ply_writer():
+    writer = vtkPLYWriter()
+    writer.SetFileTypeToBinary()
+    return writer
+
+
+MESH_WRITERS = {
+    '.stl': _stl_writer,
+    '.ply': _ply_writer,
+    '.vtp': vtkXMLPolyDataWriter,
+}
+
+
+def write_mesh(mesh:vtkPolyData, filepath) -> None:
+    '''writes mesh in the format of the extension of filepath, one of MESH_WRITERS'''
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext not in MESH_WRITERS:
+        raise ValueError(f'mesh format must be one of {list(MESH_WRITERS)}')
+    writer = MESH_WRITERS[ext]()
+    writer.SetFileName(filepath)
+    writer.SetInputData(mesh)
+    if not writer.Write():
+        raise ValueError(f'cannot write {filepath}')
+    return None
+
+
+def decimate_surface(mesh:vtkPolyData, *, reduction=.5) -> vtkPolyData:
+    '''removes about reduction of the triangles of mesh with quadric decimation, which keeps the volume of closed surfaces'''
+    if not reduction or not mesh.GetNumberOfCells():
+        return mesh
+    decimate = vtkQuadricDecimation()
+    decimate.SetInputData(mesh)
+    decimate.SetTargetReduction(reduction)
+    decimate.VolumePreservationOn()
+    decimate.Update()
+    out = vtkPolyData()
+    out.ShallowCopy(decimate.GetOutput())
+    return out
+
+
+def export_case(source, outdir, *, formats=('.stl',), smoothing_iterations=15, pass_band=.1, reduction=.5) -> list:
+    '''exports every roi of case source to outdir/<case>/<mask_id><format>, see load_case of case
+    each roi is meshed on its bounding box with extract_surface, then decimated with decimate_surface
+    returns manifest rows, one per roi, and a last one for the case with mask_id '' and the totals
+    an error of a roi is recorded in its row, and an error loading the case in the case row'''
+
+    name = case_name(source)
+    rows = []
+    t = perf_counter()
+    try:
+        mask = load_case(source).get_mask()
+        labelmap = input_kind(source) == 'nifti' # mask id = label - 1, see case
+        boxes = mask.boxes()
+    except Exception as e:
+        return [dict(case=name, mask_id='', error=f'{type(e).__name__}: {e}')]
+    t_load = perf_counter() - t
+    os.makedirs(os.path.join(outdir, name), exist_ok=True)
+
+    for i, box in sorted(boxes.items()):
+        row = dict(case=name, mask_id=i, label=i+1 if labelmap else '')
+        try:
+            t = perf_counter()
+            mesh = extract_surface(mask.test(mask_id=i, voxel_index=box), offset=tuple(s.start for s in box), frame=mask.frame,
+                                   smoothing_iterations=smoothing_iterations, pass_band=pass_band)
+            row['triangles_extracted'] = mesh.GetNumberOfCells()
+            row['seconds_extract'] = perf_counter() - t
+
+            t = perf_counter()
+            mesh = decimate_surface(mesh, reduction=reduction)
+            row['triangles'] = mesh.GetNumberOfCells()
+            row['seconds_decimate'] = perf_counter() - t
+
+            t = perf_counter()
+            paths = [os.path.join(outdir, name, f'{i}{ext}') for ext in formats]
+            for p in paths:
+                write_mesh(mesh, p)
+            row['paths'] = ';'.join(paths)
+            row['seconds_write'] = perf_counter() - t
+        except Exception as e:
+            row['error'] = f'{type(e).__name__}: {e}'
+        rows.append(row)
+
+    rows.append(dict(
+        case=name,
+        mask_id='',
+        triangles_extracted=sum(r.get('triangles_extracted', 0) for r in rows),
+        triangles=sum(r.get('triangles', 0) for r in rows),
+        seconds_load=t_load,
+        **{k: sum(r.get(k, 0.) for r in rows) for k in ('seconds_extract', 'seconds_decimate', 'seconds_write')},
+        error=f'{sum(1 for r in rows if "error" in r)} roi errors' if any('error' in r for r in rows) else '',
+    ))
+
+    return rows
+
+
+def export_cases(sources, outdir, *, manifest=None, max_workers=None, **kw) -> dict:
+    '''exports cases of sources, an iterable of paths, with export_case in a process pool, see export_case for kw
+    manifest rows, with MANIFEST_COLUMNS, are appended to manifest (outdir/manifest.csv by default) as each case finishes
+    returns counts and throughput of this run'''
+
+    manifest = manifest or os.path.join(outdir, 'manifest.csv')
+    os.makedirs(outdir, exist_ok=True)
+    for ext in kw.get('formats', ()):
+        if ext.lower() not in MESH_WRITERS:
+            raise ValueError(f'mesh format must be one of {list(MESH_WRITERS)}')
+
+    num_cases = num_rois = num_triangles = num_errors = 0
+    t0 = perf_counter()
+    with open(manifest, 'w', newline='', encoding='utf-8') as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        sources = iter(sources)
+        pending = set()
+        max_pending = 2 * (max_workers or os.cpu_count() or 1) # bounded, so a long list of cases is not queued all at once
+        while True:
+            while len(pending) < max_pending:
+                source = next(sources, None)
+                if source is None:
+                    break
+                pending.add(executor.submit(export_case, source, outdir, **kw))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                rows = future.result()
+                writer.writerows(rows)
+                f.flush()
+                case = rows[-1]
+                num_cases += 1
+                num_rois += len(rows) - 1
+                num_triangles += case.get('triangles', 0)
+                num_errors += bool(case.get('error'))
+                print(f'{case["case"]}: {len(rows)-1} rois, {case.get("triangles", 0)} triangles, '
+                      f'{sum(case.get(k, 0.) for k in MANIFEST_COLUMNS if k.startswith("seconds")):.2f} s {case.get("error", "")}')
+
+    elapsed = perf_counter() - t0
+    print(f'done, {num_cases} cases, {num_rois} rois, {num_triangles} triangles, {num_errors} cases with errors, {num_cases/max(elapsed, 1e-9):.2f} cases per second')
+
+    return dict(cases=num_cases, rois=num_rois, triangles=num_triangles, errors=num_errors, seconds=elapsed)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m data.export', description='exports every roi of every case as surface meshes')
+    parser.add_argument('cases', nargs='+', help='CASS archives, directories of their members, or NIfTI scans with a <case>_mask labelmap, glob patterns are expanded')
+    parser.add_argument('outdir')
+    parser.add_argument('--formats', nargs='+', default=['.stl'], choices=list(MESH_WRITERS))
+    parser.add_argument('--smoothing-iterations', type=int, default=15)
+    parser.add_argument('--pass-band', type=float, default=.1)
+    parser.add_argument('--reduction', type=float, default=.5, help='fraction of triangles removed by decimation, 0 to keep all')
+    parser.add_argument('--manifest', default=None, help='csv of timings and triangle counts, outdir/manifest.csv by default')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    sources = expand_inputs(args.cases) # labelmaps of nifti cases are dropped
+    export_cases(sources, args.outdir, manifest=args.manifest, max_workers=args.workers, formats=args.formats,
+                 smoothing_iterations=args.smoothing_iterations, pass_band=args.pass_band, reduction=args.reduction)
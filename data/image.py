@@ -1,9 +1,11 @@
 import os
 from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, CancelledError, Future
 from typing import List, Dict
 import dataclasses
 from dataclasses import dataclass, fields, field
 from collections import namedtuple
+from itertools import count
 import SimpleITK as sitk
 from SimpleITK.SimpleITK import _SetImageFromArray
 import numpy as np
@@ -14,12 +16,19 @@ from vtkmodules.vtkCommonCore import vtkDataArray
 
 from .base import *
 from .util import *
+from .dicom import *
+from .nifti import *
+from .cache import *
 
 
 ALLOW_PHI = True
 CAN_ERASE_PHI_AT_INIT = True
 MASK_PIXEL_TYPE = sitk.sitkUInt32
 MASK_DTYPE = np.uint32
+PLANE_DTYPE = np.uint64 # extra planes of SkullEngineMultiRoiMask beyond the 32 bits of MASK_DTYPE
+_PYRAMID_EXECUTOR = ThreadPoolExecutor(max_workers=1) # builds pyramids of Image in the background
+_ROI_VERSIONS = count(1) # versions of roi's of SkullEngineMultiRoiMask, unique across masks
+_MAX_EDITS = 256 # edits remembered per roi by SkullEngineMultiRoiMask, see changes_since
 
 
 @dataclass(kw_only=True)
@@ -36,6 +45,8 @@ class Image(SkullEngineData):
     data: vtkDataArray
     frame: ImageFrame # override Frame to provide size and spacing
 
+    pyramid_reduce = 'mean' # how levels of pyramid are downsampled, not a field
+
     # @property
     # def data(self):
     #     return self.Get
@@ -50,8 +61,8 @@ class Image(SkullEngineData):
 
     @classmethod
     def empty(cls, *, frame:ImageFrame, dtype:np.dtype, **kw):
-        '''this method create an empty image'''
-        arr = np.empty(frame.size[::-1], dtype=dtype)
+        '''this method create an empty image, whose data lives in a sitk image, see itk'''
+        arr = itk_empty(frame.size[::-1], dtype=dtype)
         obj = cls(
             data=numpy_to_vtk(arr.flat, deep=0),
             frame=frame,
@@ -62,14 +73,49 @@ class Image(SkullEngineData):
 
 
     @classmethod
-    def read(cls, filepath, **kw):
+    def read(cls, filepath, *, on_open=None, on_slice=None, cancel=None, **kw):
         '''this method reads an image from file with some of the most common codec
         it always tries to read input file as dicom, and if it fails, it will use sitk.ReadImage with provided or inferred imageIO
+        dicom series are read by read_dicom_series first, which decodes slices concurrently and records stage timings in extra['timings'],
+        and by sitk if pydicom cannot decode them, which writes into the same array if it was already handed out to on_open
         filepath is always path to a regular file, e.g., a file in the dicom series, or NIFTI image file with .nii.gz extension
+        on_open(obj) is called with the returned object as soon as it exists, which for dicom series is once its middle slice is decoded,
+        so a viewer can show slices as on_slice(k) reports them, see read_dicom_series; other formats call it once fully read
+        cancel, e.g. a threading.Event, stops a dicom series between slices and raises CancelledError
         '''
         img = None
 
         if 'imageIO' not in kw or kw['imageIO'] == "GDCMImageIO":
+            if 'outputPixelType' not in kw:
+                opened = []
+                def _allocated(arr, frame, metadata):
+                    obj = cls(data=numpy_to_vtk(arr.flat, deep=0), frame=frame, identifier=Identifier(metadata=metadata))
+                    obj.actions.append(
+                        SkullEngineAction((cls.__name__, 'read', [filepath], kw))
+                    )
+                    opened.append(obj)
+                    if on_open is not None:
+                        on_open(obj)
+                try:
+                    arr, frame, metadata, timings = read_dicom_series(filepath, on_allocate=_allocated, on_slice=on_slice, cancel=cancel, **kw)
+                except CancelledError:
+                    raise
+                except Exception: # e.g. not dicom, or compressed transfer syntax pydicom cannot decode
+                    if opened: # a slice failed after the volume was handed out, so sitk fills the same array
+                        obj = opened[0]
+                        arr = obj.numpy_array()
+                        img = read_dicom(filepath, **kw)
+                        filled = sitk.GetArrayViewFromImage(img) # a view, which does not keep img alive
+                        if filled.shape != arr.shape or filled.dtype != arr.dtype:
+                            raise
+                        arr[...] = filled
+                        obj.data.Modified()
+                        return obj
+                else:
+                    obj = opened[0]
+                    obj.extra['timings'] = timings
+                    return obj
+
             try:
                 img = read_dicom(filepath, **kw)
                 if 'outputPixelType' in kw:
@@ -77,6 +123,9 @@ class Image(SkullEngineData):
             except:
                 pass
 
+        if cancel is not None and cancel.is_set():
+            raise CancelledError(f'reading {filepath} was cancelled')
+
         if img is None:
             img = sitk.ReadImage(filepath, 
                               kw['outputPixelType'] if 'outputPixelType' in kw else sitk.sitkUnknown, 
@@ -87,16 +136,67 @@ class Image(SkullEngineData):
         obj.actions.append(
             SkullEngineAction((cls.__name__, 'read', [filepath], kw))
         )
+        if on_open is not None:
+            on_open(obj)
 
         return obj
     
 
-    def save(self, filepath):
+    def save(self, filepath, *, compression_level=1, max_workers=None):
         '''this method writes the image to file
-        currently this program only writes image in NIFTI'''
-        sitk.WriteImage(self.itk(), filepath, imageIO='NiftiImageIO')
+        currently this program only writes image in NIFTI
+        .nii is written uncompressed, and .nii.gz is compressed at compression_level (1 fastest, 9 smallest) in parallel by
+        a thread pool of max_workers, see write_nifti; other extensions are written by sitk'''
+        if str(filepath).endswith(('.nii', '.nii.gz')):
+            write_nifti(self.numpy_array(), filepath, spacing=self.frame.spacing, origin=self.frame.origin, direction=np.ravel(self.frame.direction),
+                        compression_level=compression_level, max_workers=max_workers)
+        else:
+            sitk.WriteImage(self.itk(), filepath, imageIO='NiftiImageIO')
         return None
-    
+
+
+    def write_cache(self, filepath, *, source=None, chunk_slices=16):
+        '''writes the image to a native cache file, raw voxels plus a json header of frame, identifier, and actions, see write_cache of cache
+        extra planes of a multi-roi mask are stored alongside data, and source, a source_key, marks which version of the source file this is'''
+        header = dict(
+            version=1,
+            cls=type(self).__name__,
+            frame=dataclasses.asdict(self.frame),
+            identifier=dataclasses.asdict(self.identifier),
+            actions=self.actions,
+            source=source,
+        )
+        arrays = dict(data=self.numpy_array())
+        for k, plane in enumerate(getattr(self, 'planes', [])):
+            arrays[f'plane{k}'] = plane
+        write_cache(filepath, header, arrays, chunk_slices=chunk_slices)
+        return None
+
+
+    @classmethod
+    def read_cache(cls, filepath, *, mmap_mode='c', source=None, **kw):
+        '''reopens an image written by write_cache, which takes no time beyond reading the header since voxels are memory mapped,
+        so numpy_array views the file itself; the default mmap_mode 'c' keeps changes in memory and leaves the file intact
+        if source, a file path or source_key, is given, a cache written from another version of it raises ValueError
+        kw goes to the initializer, e.g. reference_scan of masks'''
+        header, arrays = read_cache(filepath, mmap_mode=mmap_mode)
+        if source is not None and is_stale(header, source):
+            raise ValueError(f'{filepath} is stale')
+        f = header['frame']
+        frame = ImageFrame(
+            size=tuple(f['size']),
+            spacing=tuple(f['spacing']),
+            origin=tuple(f['origin']),
+            direction=tuple(map(tuple, f['direction'])),
+        )
+        planes = [arrays[f'plane{k}'] for k in range(len(arrays) - 1)]
+        if planes:
+            kw['planes'] = planes
+        obj = cls(data=numpy_to_vtk(arrays['data'].reshape(-1), deep=0), frame=frame, identifier=Identifier(**header['identifier']), **kw)
+        obj.actions.extend(SkullEngineAction(tuple(a)) for a in header['actions'])
+        obj.actions.append(SkullEngineAction((cls.__name__, 'read_cache', [str(filepath)], dict(mmap_mode=mmap_mode))))
+        return obj
+
 
     @classmethod
     def from_vtk(cls, img:vtkImageData):
@@ -119,14 +219,16 @@ class Image(SkullEngineData):
     def from_itk(cls, img:sitk.Image):
         '''this method creates Image object from sitk Image instance
         image identifier/actions can be further modified on the returned object but not within the method
-        sitk.Image can contain metadata, therefore PHI'''
+        sitk.Image can contain metadata, therefore PHI
+        data of the returned object is a view of the pixel buffer of img, which is kept alive by data, so nothing is copied'''
 
-        arr = sitk.GetArrayFromImage(img)
+        arr = itk_view(img)
         arr = numpy_to_vtk(arr.flat, deep=0)
         frame = ImageFrame(
                         size=img.GetSize(),
                         spacing=img.GetSpacing(),
                         origin=img.GetOrigin(),
+                        direction=tuple(map(tuple, np.reshape(img.GetDirection(), (3,3)).tolist())),
                         )
 
         metadata = {}
@@ -141,14 +243,31 @@ class Image(SkullEngineData):
     def itk(self, *, with_metadata=False):
         '''this method creates sitk.Image instance, with metadata attached optionally
         the program mainly uses sitk for image io operations, and vtk for rendering
-        partly due to that fact, the returned sitk image does not share memory'''
-
-        img = sitk.GetImageFromArray(self.numpy_array())
-        img.SetOrigin(self.frame.origin)
-        img.SetSpacing(self.frame.spacing)
-        if with_metadata:
-            for k,v in self.identifier.metadata.items():
-                img.SetMetaData(k, v)
+        if data lives in a sitk image, e.g. it came from read, from_itk, or empty, that same image is returned with frame and metadata
+        set, which shares memory with data, and nothing is copied; otherwise the returned image is a copy
+        an image that was handed out is never changed afterwards, so a call asking for another frame or metadata gets a copy'''
+
+        origin, spacing = tuple(self.frame.origin), tuple(self.frame.spacing)
+        direction = tuple(np.ravel(self.frame.direction).tolist())
+        metadata = {k: str(v) for k, v in self.identifier.metadata.items()} if with_metadata else {}
+
+        img = itk_image_of(self.data)
+        if img is None or img.GetNumberOfComponentsPerPixel() != 1:
+            img = sitk.GetImageFromArray(self.numpy_array())
+        elif getattr(img, 'handed_out', False):
+            if (img.GetOrigin(), img.GetSpacing(), img.GetDirection()) == (origin, spacing, direction) and \
+                    {k: img.GetMetaData(k) for k in img.GetMetaDataKeys()} == metadata:
+                return img
+            img = sitk.Image(img) # sitk copies voxels once the copy is changed below, and the image handed out keeps its state
+        else:
+            img.handed_out = True
+            for k in img.GetMetaDataKeys(): # e.g. metadata of the image given to from_itk
+                img.EraseMetaData(k)
+        img.SetOrigin(origin)
+        img.SetSpacing(spacing)
+        img.SetDirection(direction)
+        for k, v in metadata.items():
+            img.SetMetaData(k, v)
 
         return img
     
@@ -165,30 +284,65 @@ class Image(SkullEngineData):
         return img
 
 
+    def pyramid(self, *, levels=2, max_workers=None) -> Future:
+        '''coarser copies of the image for interactive viewing, downsampled 2x, 4x, ... in every axis, see downsample
+        levels are built lazily, on a background thread, and the future of the list of them is kept until data is modified,
+        i.e. until the modified time of data changes, so calling this again is free and never blocks
+        each level is a plain Image with its own frame, aligned with this one in physical space
+        two levels take 1/8 + 1/64 of the memory of data, about 1/7'''
+
+        key = (levels, id(self.data), self.data.GetMTime())
+        if getattr(self, '_pyramid', (None,))[0] != key:
+            self._pyramid = key, _PYRAMID_EXECUTOR.submit(self._build_pyramid, levels=levels, max_workers=max_workers)
+        return self._pyramid[1]
+
+
+    def _build_pyramid(self, *, levels, max_workers):
+        # one level at a time, each from the previous one
+        pyramid = []
+        arr, frame = self.numpy_array(), self.frame
+        for _ in range(levels):
+            arr = downsample(arr, reduce=self.pyramid_reduce, max_workers=max_workers)
+            spacing = tuple(2*s for s in frame.spacing)
+            shift = np.array(frame.direction, dtype=float) @ (np.array(frame.spacing)/2) # center of the first 2x2x2 block
+            frame = ImageFrame(size=arr.shape[::-1], spacing=spacing, origin=tuple((np.array(frame.origin) + shift).tolist()), direction=frame.direction)
+            pyramid.append(Image(data=numpy_to_vtk(arr.ravel(), deep=0), frame=frame, identifier=Identifier()))
+        return pyramid
+
+
 
 @dataclass(kw_only=True)
 class SkullEngineScan(Image):
     '''this class reads and writes medical scans in common formats'''
 
     @classmethod
-    def read_bin_aa(cls, filepath, *, frame:ImageFrame):
-        '''reads medical scans saved in AnatomicAligner bin file'''
-        arr = np.fromfile(filepath, dtype=np.int16)
-        arr = arr.reshape(frame.size[::-1])[::-1,::-1,:]
-        t = perf_counter()
+    def read_bin_aa(cls, filepath, *, frame:ImageFrame, mmap=True):
+        '''reads medical scans saved in AnatomicAligner bin file
+        filepath can also be bytes or a readable binary stream, e.g. an archive member
+        the volume is held in memory exactly once, and the returned data is never a view of the caller's buffer:
+            a file path is memory-mapped copy-on-write (unless mmap is False) and flipped in place, so the file itself is not modified
+            a stream is read straight into a new array and flipped in place
+            bytes are copied once, since they are read-only'''
+
+        if mmap and isinstance(filepath, (str, os.PathLike)):
+            arr = np.memmap(filepath, dtype=np.int16, mode='c', shape=tuple(frame.size[::-1]))
+        else:
+            arr = read_int16(filepath, count=int(np.prod(frame.size)))
+            if not arr.flags.writeable or isinstance(filepath, (bytearray, memoryview)):
+                arr = arr.copy()
+            arr = arr.reshape(frame.size[::-1])
+        arr = flip_aa(arr) # contiguous, so vtk takes the buffer without copying
         arr = numpy_to_vtk(arr.flat, deep=0)
-        print(f'to vtk: {perf_counter()-t} seconds')
         img = cls(data=arr, frame=frame, identifier=Identifier())
         img.actions.append(
-            SkullEngineAction((cls.__name__, 'read_bin_aa', filepath, dict(frame=frame)))
+            SkullEngineAction((cls.__name__, 'read_bin_aa', filepath if isinstance(filepath, (str, os.PathLike)) else type(filepath).__name__, dict(frame=frame)))
         )
         return img
     
     def write_bin_aa(self, filepath):
         '''writes medical scans to AnatomicAligner bin file'''
-        arr = self.numpy_array()
-        bytes = np.ravel(arr[::-1,::-1,:].astype(np.int16), order='C') # possible loss of precision since AA always uses int16
-        return bytes.tofile(filepath)
+        arr = self.numpy_array().astype(np.int16) # possible loss of precision since AA always uses int16, always a copy so data is not flipped
+        return flip_aa(arr).tofile(filepath)
 
 
     @classmethod
@@ -213,6 +367,8 @@ class SkullEngineMask(Image):
     reference_scan: SkullEngineScan = None
     frame:ImageFrame = None
 
+    pyramid_reduce = 'or' # every roi bit survives downsampling
+
     @property
     def frame(self):
         return self.reference_scan.frame
@@ -232,49 +388,53 @@ class SkullEngineMask(Image):
         '''this is a convenience method that creates an empty mask to possibly represent multiple overlapping roi's, '''
         img = super().empty(frame=ref_scan.frame, dtype=MASK_DTYPE)
         img.reference_scan = ref_scan
+        img.numpy_array()[...] = 0 # no roi is set in an empty mask
         return img
 
 
     @classmethod
-    def read_bin_aa(cls, filepath, *, frame:ImageFrame):
-        # origin and spacing are optional for initializer but should be set later
-        bytes = np.fromfile(filepath, dtype=np.int16)
-        arr = np.zeros(frame.size[::-1], dtype=bool)
-        for i in range(0,bytes.size,4):
-            arr[
-                bytes[i+3],
-                bytes[i],
-                bytes[i+1]:bytes[i+1]+bytes[i+2]
-                ] = True
-        arr = arr[::-1,::-1,:].astype(np.int8) # this is a single roi mask, so we use a more efficient data type
+    def read_bin_aa(cls, filepath, *, frame:ImageFrame, ref_scan:SkullEngineScan=None):
+        '''reads mask saved in AnatomicAligner bin file, filepath can also be bytes or a readable binary stream
+        frame of the mask follows ref_scan, which is optional for initializer but should be set later'''
+        bytes = read_int16(filepath)
+        arr = decode_runs_aa(bytes, shape=frame.size[::-1]) # this is a single roi mask, so we use a more efficient data type
         arr = numpy_to_vtk(arr.flat, deep=0)
-        return cls(data=arr, frame=frame, identifier=Identifier())
+        return cls(data=arr, reference_scan=ref_scan, identifier=Identifier())
+
 
+    def write_bin_aa(self, filepath, split_if_multiple_found=True, *, max_workers=None):
+        '''writes mask to AnatomicAligner bin file, or one file per label suffixed with _{v} if multiple labels are found
+        runs of all labels are extracted in a single pass and grouped by label, so the volume is scanned only once
+        max_workers, if given, writes the per-label files from a thread pool
+        seconds spent encoding and writing are recorded in extra['timings']'''
 
-    def write_bin_aa(self, filepath, split_if_multiple_found=True):
-        arr = self.numpy_array()[::-1,::-1,:]
-        vals = np.unique(arr)
-        vals = vals[vals!=0]
+        t = perf_counter()
+        runs, values = encode_runs_aa(self.numpy_array())
+        order = np.argsort(values, kind='stable') # stable sort keeps AnatomicAligner run order within each label
+        vals, first = np.unique(values[order], return_index=True)
+        runs = np.split(runs[order], first[1:])
         multiple_found = len(vals) > 1
+        t_encode = perf_counter() - t
 
         if not split_if_multiple_found and multiple_found:
             raise ValueError('multiple masks found.')
 
-        for v in vals:
-            seg_list = []
-            arrv = arr==v
-            for i in range(arrv.shape[0]):
-                for j in range(arrv.shape[1]):
-                    segs = np.diff(np.hstack((0, arrv[i,j], 0)))
-                    for start, end in zip(np.nonzero(segs==1)[0], np.nonzero(segs==-1)[0]):
-                        seg_list += [ j,start,end-start,i ]
-            bytes = np.array(seg_list, dtype=np.int16)
-            if multiple_found:
-                _d, _f = os.path.splitext(filepath)
-                bytes.tofile(_d + f"_{v}"+ _f)
-            else:
-                bytes.tofile(filepath)
-            
+        if multiple_found:
+            _d, _f = os.path.splitext(filepath)
+            filepaths = [_d + f"_{v}"+ _f for v in vals]
+        else:
+            filepaths = [filepath]*len(vals)
+
+        t = perf_counter()
+        if max_workers:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(np.ndarray.tofile, runs, filepaths))
+        else:
+            for bytes, f in zip(runs, filepaths):
+                bytes.tofile(f)
+        t_io = perf_counter() - t
+
+        self.extra['timings'] = dict(encode=t_encode, write=t_io)
         return None
     
     
@@ -301,27 +461,229 @@ class SkullEngineMask(Image):
 
 @dataclass(kw_only=True)
 class SkullEngineMultiRoiMask(SkullEngineMask):
+    '''this class stores overlapping roi's as bits, roi i is bit i of data for i < 32, which is what viewers show,
+    and roi's from 32 on go to extra uint64 planes of the same shape, 64 roi's per plane, created only when first needed
+    so every roi takes one bit per voxel, and masks with fewer than 32 roi's cost nothing extra'''
+
+    planes: list = field(default_factory=list)
+    versions: dict = field(default_factory=dict, repr=False) # mask_id -> version, see version
+    edits: dict = field(default_factory=dict, repr=False) # mask_id -> (floor, [(version, box)]), see changes_since
 
     @classmethod
     def read(cls, filepath, **kw):
         return super().read(filepath, outputPixelType=MASK_PIXEL_TYPE, **kw) # rescale is for dicom
 
 
+    def save(self, filepath, **kw):
+        '''writes data, i.e. roi's below 32, see Image.save, and raises ValueError if any roi of planes is set,
+        since the file would silently lose it, such masks are written as a labelmap, see to_labelmap and write_case of convert'''
+        ids = self.plane_ids_in_use()
+        if ids:
+            raise ValueError(f"roi's {ids} are beyond the {np.iinfo(MASK_DTYPE).bits} bits of a mask file, write a labelmap instead")
+        return super().save(filepath, **kw)
+
+
+    def version(self, mask_id) -> int:
+        '''a number that changes whenever roi mask_id changes, and is never shared by two roi's or two masks,
+        so it keys caches of anything derived from a single roi, e.g. its surface'''
+        if mask_id not in self.versions:
+            self.versions[mask_id] = next(_ROI_VERSIONS)
+            self.edits[mask_id] = self.versions[mask_id], [] # nothing is known of changes before this version
+        return self.versions[mask_id]
+
+
+    def touch(self, mask_ids=None, *, box=None) -> None:
+        '''marks roi's as changed, all of them if mask_ids is None, within box, a tuple of slices, or anywhere if box is None
+        set_true, set_false, and set_labels do this themselves, so it is only needed after editing arrays directly'''
+        if mask_ids is None:
+            self.versions.clear()
+            self.edits.clear()
+        for i in mask_ids or ():
+            v = self.versions[i] = next(_ROI_VERSIONS)
+            floor, log = self.edits.get(i, (v, []))
+            log.append((v, box))
+            if len(log) > _MAX_EDITS:
+                floor = log[-_MAX_EDITS-1][0]
+                del log[:-_MAX_EDITS]
+            self.edits[i] = floor, log
+        return None
+
+
+    def changes_since(self, mask_id, version) -> list:
+        '''boxes, as tuples of slices, holding every voxel of roi mask_id changed after version, see version
+        returns None if that is unknown, i.e. the roi changed anywhere, or version is older than the edits remembered'''
+        floor, log = self.edits.get(mask_id, (None, []))
+        if floor is None or version < floor:
+            return None
+        boxes = [box for v, box in log if v > version]
+        return None if any(box is None for box in boxes) else boxes
+
+
+    def boxes(self, mask_ids=None) -> dict:
+        '''bounding boxes of roi's with at least one voxel set, as mask_id -> tuple of slices, see bit_boxes
+        only words holding one of mask_ids are scanned, or all of them if mask_ids is None'''
+        boxes = {}
+        words = None if mask_ids is None else {self._locate(i)[0] for i in mask_ids}
+        for k, arr in enumerate([self.numpy_array(), *self.planes]):
+            if words is not None and k not in words:
+                continue
+            offset = 0 if k == 0 else np.iinfo(MASK_DTYPE).bits + (k-1)*np.iinfo(PLANE_DTYPE).bits
+            for b, box in bit_boxes(arr).items():
+                if mask_ids is None or offset + b in mask_ids:
+                    boxes[offset + b] = box
+        return boxes
+
+
+    def _locate(self, mask_id) -> tuple[int, int]:
+        # word k holding roi mask_id, and its bit, word 0 is data and word k is planes[k-1]
+        if mask_id < 0:
+            raise ValueError('mask id must be non-negative')
+        num_bits = np.iinfo(MASK_DTYPE).bits
+        if mask_id < num_bits:
+            return 0, mask_id
+        k, bit = divmod(mask_id - num_bits, np.iinfo(PLANE_DTYPE).bits)
+        return k+1, bit
+
+
+    def _word(self, k, *, create=False) -> np.ndarray:
+        # array of word k, or None if the plane does not exist and create is False
+        if k == 0:
+            return self.numpy_array()
+        while create and len(self.planes) < k:
+            self.planes.append(np.zeros(self.frame.size[::-1], dtype=PLANE_DTYPE))
+        return self.planes[k-1] if k <= len(self.planes) else None
+
+
+    def _words(self, mask_ids) -> dict:
+        # groups roi's by word, as k -> bits of those roi's, skipping words that do not exist
+        groups = {}
+        for i in mask_ids:
+            k, bit = self._locate(i)
+            arr = self._word(k)
+            if arr is not None:
+                groups[k] = groups.get(k, arr.dtype.type(0)) | arr.dtype.type(1) << arr.dtype.type(bit)
+        return groups
+
+
+    def mask_ids_in_use(self) -> list:
+        '''ids of roi's with at least one voxel set'''
+        ids = []
+        for k, arr in enumerate([self.numpy_array(), *self.planes]):
+            bits = int(np.bitwise_or.reduce(arr, axis=None))
+            offset = 0 if k == 0 else np.iinfo(MASK_DTYPE).bits + (k-1)*np.iinfo(PLANE_DTYPE).bits
+            ids += [offset + b for b in range(arr.dtype.itemsize*8) if bits >> b & 1]
+        return ids
+
+
+    def plane_ids_in_use(self) -> list:
+        '''ids of roi's of planes with at least one voxel set, which surfaces show, but not data, nor the slices or files made from it'''
+        return [i for i in self.mask_ids_in_use() if i >= np.iinfo(MASK_DTYPE).bits] if self.planes else []
+
+
     def set_true(self, *, mask_id, voxel_index=None):
 
-        data = self.numpy_array()
-        bin_or = np.array(2**mask_id, dtype=MASK_DTYPE)
+        k, bit = self._locate(mask_id)
+        data = self._word(k, create=True)
+        bin_or = data.dtype.type(1) << data.dtype.type(bit)
         if voxel_index is None:
             data[...] |= bin_or
         else:
             data[voxel_index] |= bin_or
+        self.touch([mask_id], box=index_box(voxel_index, data.shape))
+
+
+    def set_labels(self, labels:np.ndarray, *, mask_ids:dict, lookup=None) -> None:
+        '''sets roi's of a labeled array all at once, mask_ids maps label values to mask ids, and unmapped labels are ignored
+        label values go through a lookup table of bits, so the volume is read once per 32 or 64 roi's, instead of once per label
+        lookup is the result of label_lookup(labels), if it is already at hand'''
+
+        values, slots, index = lookup or label_lookup(labels)
+        words = {}
+        for v, slot in zip(values.tolist(), slots):
+            if v in mask_ids:
+                k, bit = self._locate(mask_ids[v])
+                words.setdefault(k, []).append((slot, bit))
+
+        for k, pairs in words.items():
+            data = self._word(k, create=True)
+            slot, bit = map(list, zip(*pairs))
+            lut = np.zeros(slots[-1]+1, dtype=data.dtype)
+            lut[slot] = np.left_shift(data.dtype.type(1), np.array(bit, dtype=data.dtype))
+            np.bitwise_or(data, lut[index], out=data)
+        self.touch([mask_ids[v] for v in values.tolist() if v in mask_ids])
+
+        return None
 
 
     def set_false(self, *, mask_id, voxel_index=None):
         
-        data = self.numpy_array()
-        bin_and = np.bitwise_not(np.array(2**mask_id, dtype=MASK_DTYPE))
+        k, bit = self._locate(mask_id)
+        data = self._word(k)
+        if data is None:
+            return
+        bin_and = np.bitwise_not(data.dtype.type(1) << data.dtype.type(bit))
         if voxel_index is None:
             data[...] &= bin_and
         else:
             data[voxel_index] &= bin_and
+        self.touch([mask_id], box=index_box(voxel_index, data.shape))
+
+
+    def test(self, *, mask_id, voxel_index=None) -> np.ndarray:
+        '''whether voxels are in roi mask_id, for the whole volume if voxel_index is None'''
+        k, bit = self._locate(mask_id)
+        data = self._word(k)
+        if data is None:
+            return self.any_of(mask_ids=[], voxel_index=voxel_index)
+        if voxel_index is not None:
+            data = data[voxel_index]
+        return (data & (data.dtype.type(1) << data.dtype.type(bit))) != 0
+
+
+    def any_of(self, *, mask_ids, voxel_index=None) -> np.ndarray:
+        '''whether voxels are in any of the roi's, testing each array once with all its bits at the same time'''
+        out = None
+        for k, bits in self._words(mask_ids).items():
+            data = self._word(k)
+            if voxel_index is not None:
+                data = data[voxel_index]
+            hit = (data & bits) != 0
+            out = hit if out is None else np.logical_or(out, hit, out=out)
+        if out is None:
+            out = np.zeros(self.frame.size[::-1], dtype=bool)
+            out = out if voxel_index is None else out[voxel_index]
+        return out
+
+
+    def to_labelmap(self) -> np.ndarray:
+        '''converts to a labelmap of mask id + 1, with 0 for background, in the smallest unsigned type that fits
+        where roi's overlap, the lowest mask id wins'''
+
+        arrays = [self.numpy_array(), *self.planes]
+        offsets = [0] + [np.iinfo(MASK_DTYPE).bits + k*np.iinfo(PLANE_DTYPE).bits for k in range(len(self.planes))]
+        num_labels = offsets[-1] + arrays[-1].dtype.itemsize*8
+        out = np.zeros(self.frame.size[::-1], dtype=np.uint8 if num_labels < 256 else np.uint16)
+        for arr, offset in reversed(list(zip(arrays, offsets))): # lower words last, so lower ids overwrite
+            nz = np.nonzero(arr)
+            words = arr[nz]
+            lowest = words & (~words + arr.dtype.type(1)) # isolates lowest set bit
+            out[nz] = np.log2(lowest).astype(out.dtype) + (offset + 1) # exact, since lowest is a power of 2
+        return out
+
+
+    def overlapped_ids(self) -> list:
+        '''ids of roi's sharing a voxel with a lower mask id, i.e. roi's that to_labelmap does not keep whole'''
+
+        arrays = [self.numpy_array(), *self.planes]
+        count = sum(bit_count(arr) for arr in arrays)
+        shared = np.nonzero(count > 1)
+        ids = []
+        lower = np.zeros(len(shared[0]), dtype=bool) # a lower word already has a bit at the voxel
+        for k, arr in enumerate(arrays):
+            words = arr[shared]
+            lowest = np.where(lower, 0, words & (~words + arr.dtype.type(1)))
+            bits = int(np.bitwise_or.reduce(words & ~lowest, axis=None)) if words.size else 0
+            offset = 0 if k == 0 else np.iinfo(MASK_DTYPE).bits + (k-1)*np.iinfo(PLANE_DTYPE).bits
+            ids += [offset + b for b in range(arr.dtype.itemsize*8) if bits >> b & 1]
+            lower |= words != 0
+        return ids
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+from .dicom import *
+
+
+# header columns kept for each file, as (column, pydicom keyword)
+INDEX_TAGS = [
+    ('patient_id', 'PatientID'),
+    ('patient_name', 'PatientName'),
+    ('ethnic_group', 'EthnicGroup'),
+    ('study_uid', 'StudyInstanceUID'),
+    ('study_date', 'StudyDate'),
+    ('series_uid', 'SeriesInstanceUID'),
+    ('modality', 'Modality'),
+    ('instance_number', 'InstanceNumber'),
+]
+
+_SCHEMA = f'''
+create table if not exists files (
+    path text primary key,
+    mtime_ns integer,
+    size integer,
+    is_dicom integer,
+    {', '.join(c + (' integer' if c == 'instance_number' else ' text') for c, _ in INDEX_TAGS)}
+);
+create index if not exists files_series on files (series_uid);
+create index if not exists files_patient on files (patient_id);
+'''
+
+
+def _index_row(filepath) -> tuple:
+    # header columns of a file, or None's if it is not dicom
+    ds = read_header(filepath, specific_tags=[k for _, k in INDEX_TAGS])
+    if ds is None:
+        return (0,) + (None,)*len(INDEX_TAGS)
+    values = []
+    for c, k in INDEX_TAGS:
+        v = ds.get(k, None)
+        if c == 'instance_number':
+            v = int(v) if v not in (None, '') else None
+        elif v is not None:
+            v = str(v).strip()
+        values.append(v)
+    return (1, *values)
+
+
+class DicomIndex:
+    '''this class keeps a sqlite catalog of dicom headers, file -> (patient, study, series, instance number, ...)
+    update() only re-reads files whose mtime or size changed since the last update, and forgets files that are gone,
+    so series lookup and cohort queries do not need to crawl the file system again'''
+
+    def __init__(self, dbpath=':memory:') -> None:
+        self.dbpath = dbpath
+        self.connection = sqlite3.connect(dbpath)
+        self.connection.executescript(_SCHEMA)
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self) -> None:
+        self.connection.close()
+        return None
+
+
+    def update(self, root, *, pattern='*', recursive=True, max_workers=None, batch_size=1000) -> dict:
+        '''brings entries of files under root, whose name matches pattern, up to date
+        returns counts of files seen, (re-)read, and removed'''
+
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, '')
+        known = dict(
+            (p, (m, s)) for p, m, s in self.connection.execute(
+                'select path, mtime_ns, size from files where path >= ? and path < ?', (prefix, prefix + '\uffff'))
+            if (recursive or os.path.dirname(p) == root) and fnmatch(os.path.basename(p), pattern)
+        )
+
+        stale = []
+        seen = 0
+        for d, _, names in (os.walk(root) if recursive else [(root, None, os.listdir(root))]):
+            for name in names:
+                if not fnmatch(name, pattern):
+                    continue
+                p = os.path.join(d, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                if not os.path.isfile(p):
+                    continue
+                seen += 1
+                if known.pop(p, None) != (st.st_mtime_ns, st.st_size):
+                    stale.append((p, st.st_mtime_ns, st.st_size))
+
+        columns = ['path', 'mtime_ns', 'size', 'is_dicom', *(c for c, _ in INDEX_TAGS)]
+        sql = f'insert or replace into files ({", ".join(columns)}) values ({", ".join("?"*len(columns))})'
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i in range(0, len(stale), batch_size):
+                batch = stale[i:i+batch_size]
+                rows = executor.map(_index_row, [p for p, *_ in batch])
+                with self.connection:
+                    self.connection.executemany(sql, [(*f, *r) for f, r in zip(batch, rows)])
+
+        with self.connection:
+            self.connection.executemany('delete from files where path = ?', [(p,) for p in known])
+
+        return dict(seen=seen, read=len(stale), removed=len(known))
+
+
+    def query(self, sql, params=()) -> list:
+        '''runs a read-only query on table files, e.g. for cohort selection'''
+        return self.connection.execute(sql, params).fetchall()
+
+
+    def series_files(self, series_uid, *, dirpath=None) -> list:
+        '''files of a series ordered by instance number, optionally only those directly in dirpath'''
+        rows = self.query('select path from files where series_uid = ? order by instance_number, path', (series_uid,))
+        files = [p for p, in rows]
+        if dirpath is not None:
+            dirpath = os.path.abspath(dirpath)
+            files = [p for p in files if os.path.dirname(p) == dirpath]
+        return files
+
+
+    def series_of(self, filepath) -> list:
+        '''files in the same series and same directory as filepath, after bringing that directory up to date'''
+        filepath = os.path.abspath(filepath)
+        self.update(os.path.dirname(filepath), recursive=False)
+        row = self.query('select series_uid from files where path = ? and is_dicom', (filepath,))
+        if not row:
+            raise ValueError(f'{filepath} is not a dicom file')
+        return self.series_files(row[0][0], dirpath=os.path.dirname(filepath))
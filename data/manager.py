@@ -1,6 +1,5 @@
 import os
-import subprocess
-from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import SimpleITK as sitk
 from PySide6.QtCore import Qt, Signal, Slot, QEvent, QObject
@@ -8,8 +7,7 @@ from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 from .base import *
 from .image import *
 from .util import *
-
-_RAR_EXE = 'C:\\Program Files\\WinRAR\\Rar.exe'
+from .archive import *
 
 
 class DataManager(QObject):
@@ -37,45 +35,88 @@ class DataManager(QObject):
 
 
 
-    # def reset(self) -> None:
-    #     self.get_object_list().clear()
+    def reset(self) -> None:
+        '''forgets scan, masks, and objects, e.g. a scan whose loading was cancelled, so another scan can be loaded
+        views reload and find no scan'''
+
+        self.data_stack.clear()
+        self.get_mask_ids().clear()
+        self.get_object_list().clear()
+        self.scanLoaded.emit()
 
-    #     return None
+        return None
     
 
     @classmethod
-    def from_aa(cls, filepath, **kw):
-        filepath = os.path.realpath(os.path.expanduser(filepath))
+    def from_aa(cls, filepath, *, max_workers=None, **kw):
+        '''loads a CASS archive, or any Archive instance, e.g. a DirectoryArchive or MemoryArchive
+        members are decoded straight from archive streams, without temporary files or changing working directory
+        max_workers, if given, decodes masks concurrently in a thread pool'''
+
+        archive = open_archive(filepath)
         man = cls()
-        cwd = os.getcwd()
-        with TemporaryDirectory() as d:
-            os.chdir(d)
-            subprocess.run([_RAR_EXE, 'x', '-idq', filepath, 'Patient_info.bin', 'Patient_data.bin', 'Mask_Info.bin'],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            with open('Patient_info.bin') as f:
-                info = f.read().split(',')
-            name, studydate, sex, _, _, sz, sy, sx, rx, ry, rz, _, cx, cy, cz, *_ = info
-            frame = ImageFrame(size=[int(sx),int(sy),int(sz)], spacing=[float(rx),float(ry),float(rz)], origin=[0.,0.,0.])
-            scan = SkullEngineScan.read_bin_aa('Patient_data.bin', frame=frame)
-            scan.identifier.metadata["Patient's Name"] = name
-            scan.identifier.metadata["Study Date"] = studydate
-            scan.identifier.metadata["Patient's Sex"] = sex
-            man.set_scan(scan)
-
-            with open('Patient_info.bin') as f:
-                info = f.read().strip(';').split(';')
-            num_masks = int(info[0])
-            subprocess.run([_RAR_EXE, 'x', '-idq', filepath, *[f'{i}.bin' for i in range(num_masks)]],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        info = archive.read_text('Patient_info.bin').split(',')
+        name, studydate, sex, _, _, sz, sy, sx, rx, ry, rz, _, cx, cy, cz, *_ = info
+        frame = ImageFrame(size=(int(sx),int(sy),int(sz)), spacing=(float(rx),float(ry),float(rz)), origin=(0.,0.,0.))
+        with archive.open('Patient_data.bin') as f:
+            scan = SkullEngineScan.read_bin_aa(f, frame=frame)
+        scan.identifier.metadata["Patient's Name"] = name
+        scan.identifier.metadata["Study Date"] = studydate
+        scan.identifier.metadata["Patient's Sex"] = sex
+        man.set_scan(scan)
+
+        info = archive.read_text('Mask_Info.bin').strip(';').split(';')
+        num_masks = int(info[0])
+
+        def _read_mask(i):
+            with archive.open(f'{i}.bin') as f:
+                return SkullEngineMultiRoiMask.read_bin_aa(f, frame=frame, ref_scan=scan)
+
+        if max_workers:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                masks = executor.map(_read_mask, range(num_masks))
+                for i, msk in enumerate(masks):
+                    man.add_mask(mask_id=i, arr=msk.numpy_array()>0)
+        else:
             for i in range(num_masks):
-                msk = SkullEngineMultiRoiMask.read_bin_aa(f'{i}.bin', frame=frame)
+                msk = _read_mask(i)
                 man.add_mask(mask_id=i, arr=msk.numpy_array()>0)
 
-            os.chdir(cwd)
-
         return man
 
 
+    def write_aa(self, dirpath) -> None:
+        '''writes scan and mask as the members of a CASS archive into directory dirpath, which from_aa reads back
+        roi i goes to {i}.bin for every i up to the largest mask id in use, so mask ids are kept, and the frame keeps only its spacing'''
+
+        if not self.scan_is_loaded():
+            raise ValueError('scan is not loaded')
+        _img = self.get_scan()
+        _mask = self.get_mask()
+        os.makedirs(dirpath, exist_ok=True)
+
+        # patient info as set by from_aa, or as read from dicom, without commas, which separate fields
+        meta = _img.identifier.metadata
+        name, studydate, sex = (str(meta.get(k, meta.get(tag, ''))).replace(',', ' ') for k, tag in
+                                (("Patient's Name", '0010|0010'), ('Study Date', '0008|0020'), ("Patient's Sex", '0010|0040')))
+        sx, sy, sz = _img.frame.size
+        spacing = (f'{s:.7g}' for s in _img.frame.spacing) # vtk holds spacing in float32, whose noise is dropped, e.g. 0.30000001192092896
+        info = [name, studydate, sex, '', '', sz, sy, sx, *spacing, '', 0., 0., 0.]
+        with open(os.path.join(dirpath, 'Patient_info.bin'), 'w') as f:
+            f.write(','.join(map(str, info)))
+        _img.write_bin_aa(os.path.join(dirpath, 'Patient_data.bin'))
+
+        ids = _mask.mask_ids_in_use()
+        num_masks = max(ids) + 1 if ids else 0
+        with open(os.path.join(dirpath, 'Mask_Info.bin'), 'w') as f:
+            f.write(f'{num_masks};')
+        for i in range(num_masks):
+            encode_runs_aa(_mask.test(mask_id=i))[0].tofile(os.path.join(dirpath, f'{i}.bin'))
+
+        return None
+
+
     def set_scan(self, _img:SkullEngineScan, *, action_if_exists='reset') -> None:
         '''this method loads scan. this is usually the first step.
         action_if_exists can choose from reset|confirm|error '''
@@ -98,6 +139,13 @@ class DataManager(QObject):
         return None
 
 
+    def scan_modified(self) -> None:
+        '''tells views that voxels of the scan changed in place, e.g. more slices arrived while it is still loading'''
+        if self.scan_is_loaded():
+            self.dataUpdated.emit(self.get_scan())
+        return None
+
+
     def get_next_available_mask_id(self) -> int:
         ids = self.get_mask_ids()
         if not len(ids):
@@ -137,12 +185,16 @@ class DataManager(QObject):
                 _mask.set_true(mask_id=new_id, voxel_index=arr)
 
             else:
-                for v in np.unique(arr):
+                # ids are handed out in label order, then all labels are written in one pass
+                mask_ids = {}
+                lookup = label_lookup(arr)
+                for v in lookup[0].tolist():
                     if v != 0:
                         new_id = mask_id or self.get_next_available_mask_id()
                         if new_id not in self.get_mask_ids():
                             self.get_mask_ids().append(new_id)
-                        _mask.set_true(mask_id=new_id, voxel_index=arr==v)
+                        mask_ids[v] = new_id
+                _mask.set_labels(arr, mask_ids=mask_ids, lookup=lookup)
 
         self.dataReloaded.emit(self.get_mask())
 
@@ -198,21 +250,29 @@ class DataManager(QObject):
         return self.object_list
 
 
-    def resample(self, *, new_spacing):
+    def resample(self, *, new_spacing, backend='scipy', max_workers=None, mask_order=0, mask_sigma=0.):
+        '''resamples scan and mask to new_spacing, with any function of RESAMPLE_BACKENDS, e.g. 'scipy' or 'sitk', on the same grid
+        max_workers is the number of threads of the backend
+        mask is resampled with nearest neighbor by default, or one roi at a time with a spline of mask_order
+        after smoothing with a gaussian of mask_sigma voxels, which gives smooth instead of blocky upsampled roi's'''
 
         _img = self.get_scan()
         _mask = self.get_mask()
         
         if not _img:
             raise ValueError('scan is not loaded')
+        if backend not in RESAMPLE_BACKENDS:
+            raise ValueError(f'backend must be one of {list(RESAMPLE_BACKENDS)}')
+        _resample = RESAMPLE_BACKENDS[backend]
 
         # resample image
-        img_arr = resample(_img.numpy_array(), old_spacing=_img.frame.spacing, new_spacing=new_spacing, mode='nearest')
+        img_arr = _resample(_img.numpy_array(), old_spacing=_img.frame.spacing, new_spacing=new_spacing, max_workers=max_workers, mode='nearest')
         _img.actions.append(SkullEngineAction(('self', 'resample', [], {})))
         _img1 = SkullEngineScan(
             data=numpy_to_vtk(img_arr.flat, deep=0),
             frame=ImageFrame(
                 origin=_img.frame.origin,
+                direction=_img.frame.direction,
                 size=img_arr.shape[::-1],
                 spacing=new_spacing,
             ),
@@ -221,7 +281,20 @@ class DataManager(QObject):
         )
 
         # resample mask
-        mask_arr = resample(_mask.numpy_array(), old_spacing=_img.frame.spacing, new_spacing=new_spacing, mode='grid-constant', order=0, cval=0)
+        if mask_order or mask_sigma:
+            def _resample_mask(arr):
+                return resample_bits(arr, old_spacing=_img.frame.spacing, new_spacing=new_spacing, order=mask_order, sigma=mask_sigma, max_workers=max_workers)
+        else:
+            def _resample_word(arr):
+                return _resample(arr, old_spacing=_img.frame.spacing, new_spacing=new_spacing, max_workers=max_workers, mode='grid-constant', order=0, cval=0)
+            def _resample_mask(arr):
+                if arr.dtype.itemsize <= 4:
+                    return _resample_word(arr)
+                # every backend interpolates in float64, which holds 53 bits, so uint64 planes go as two uint32 halves
+                low = _resample_word((arr & np.uint64(0xffffffff)).astype(np.uint32))
+                high = _resample_word((arr >> np.uint64(32)).astype(np.uint32))
+                return high.astype(np.uint64) << np.uint64(32) | low
+        mask_arr = _resample_mask(_mask.numpy_array())
         _mask.actions.append(SkullEngineAction(('self', 'resample', [], {})))
 
         _mask1 = SkullEngineMultiRoiMask(
@@ -229,6 +302,7 @@ class DataManager(QObject):
             reference_scan=_img1,
             identifier=_mask.identifier,
             actions=_mask.actions,
+            planes=[_resample_mask(p) for p in _mask.planes],
         )
 
         # replace old data with new data
@@ -0,0 +1,116 @@
+import os
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# nifti-1 datatype codes of numpy dtypes
+NIFTI_DATATYPES = {
+    np.dtype(np.uint8): 2,
+    np.dtype(np.int16): 4,
+    np.dtype(np.int32): 8,
+    np.dtype(np.float32): 16,
+    np.dtype(np.float64): 64,
+    np.dtype(np.int8): 256,
+    np.dtype(np.uint16): 512,
+    np.dtype(np.uint32): 768,
+    np.dtype(np.int64): 1024,
+    np.dtype(np.uint64): 1280,
+}
+
+_HEADER_FORMAT = '<i10s18sihcb8h3f4h8f3fh2b4f2i80s24s2h6f12f16s4s'
+_VOX_OFFSET = 352 # 348 bytes of header, then 4 bytes saying there is no extension
+
+
+def _quaternion(rotation:np.ndarray) -> tuple[tuple, float]:
+    # quaternion (b, c, d) and qfac of a 3x3 orthonormal matrix, same as nifti_mat44_to_quatern of nifti1_io
+    r = np.array(rotation, dtype=float)
+    qfac = 1.
+    if np.linalg.det(r) < 0:
+        qfac = -1.
+        r[:,2] = -r[:,2]
+    a = r[0,0] + r[1,1] + r[2,2] + 1.
+    if a > .5:
+        a = .5*np.sqrt(a)
+        b, c, d = .25*(r[2,1]-r[1,2])/a, .25*(r[0,2]-r[2,0])/a, .25*(r[1,0]-r[0,1])/a
+    else:
+        xd, yd, zd = 1.+r[0,0]-(r[1,1]+r[2,2]), 1.+r[1,1]-(r[0,0]+r[2,2]), 1.+r[2,2]-(r[0,0]+r[1,1])
+        if xd > 1.:
+            b = .5*np.sqrt(xd)
+            c, d, a = .25*(r[0,1]+r[1,0])/b, .25*(r[0,2]+r[2,0])/b, .25*(r[2,1]-r[1,2])/b
+        elif yd > 1.:
+            c = .5*np.sqrt(yd)
+            b, d, a = .25*(r[0,1]+r[1,0])/c, .25*(r[1,2]+r[2,1])/c, .25*(r[0,2]-r[2,0])/c
+        else:
+            d = .5*np.sqrt(zd)
+            b, c, a = .25*(r[0,2]+r[2,0])/d, .25*(r[1,2]+r[2,1])/d, .25*(r[1,0]-r[0,1])/d
+        if a < 0.:
+            b, c, d = -b, -c, -d
+    return (b, c, d), qfac
+
+
+def nifti_header(*, shape, dtype, spacing, origin, direction) -> bytes:
+    '''creates nifti-1 header, followed by an empty extension, for a (+z, +y, +x) array of shape and dtype
+    spacing, origin, and direction are in itk convention (lps, columns of direction are axes), same as ImageFrame,
+    and are written to both qform and sform in ras, the way itk does'''
+
+    dtype = np.dtype(dtype)
+    if dtype.newbyteorder('=') not in NIFTI_DATATYPES:
+        raise ValueError(f'nifti cannot store {dtype}')
+
+    lps_to_ras = np.diag([-1., -1., 1.])
+    rotation = lps_to_ras @ np.array(direction, dtype=float).reshape(3,3)
+    offset = lps_to_ras @ np.array(origin, dtype=float)
+    affine = rotation * np.array(spacing, dtype=float)
+    (b, c, d), qfac = _quaternion(rotation)
+
+    nz, ny, nx = shape
+    header = struct.pack(
+        _HEADER_FORMAT,
+        348, b'', b'', 0, 0, b'r', 0, # sizeof_hdr, data_type, db_name, extents, session_error, regular, dim_info
+        3, nx, ny, nz, 1, 1, 1, 1, # dim
+        0., 0., 0., 0, # intent_p1, p2, p3, intent_code
+        NIFTI_DATATYPES[dtype.newbyteorder('=')], dtype.itemsize*8, 0, # datatype, bitpix, slice_start
+        qfac, *map(float, spacing), 0., 0., 0., 0., # pixdim
+        float(_VOX_OFFSET), 1., 0., # vox_offset, scl_slope, scl_inter
+        0, 0, 10, # slice_end, slice_code, xyzt_units (mm and s)
+        0., 0., 0., 0., 0, 0, # cal_max, cal_min, slice_duration, toffset, glmax, glmin
+        b'', b'', # descrip, aux_file
+        1, 1, # qform_code, sform_code (scanner)
+        b, c, d, *offset, # quatern_b, c, d, qoffset_x, y, z
+        *affine[0], offset[0], *affine[1], offset[1], *affine[2], offset[2], # srow_x, y, z
+        b'', b'n+1\0', # intent_name, magic
+    )
+    return header + b'\0'*4
+
+
+def _gzip_member(block, level) -> bytes:
+    # compresses one block into a complete gzip member, zlib releases the gil while doing so
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return z.compress(block) + z.flush()
+
+
+def write_nifti(arr:np.ndarray, filepath, *, spacing, origin=(0.,0.,0.), direction=(1.,0.,0.,0.,1.,0.,0.,0.,1.),
+                compression_level=1, max_workers=None, block_size=1<<22) -> int:
+    '''writes (+z, +y, +x) arr to nifti-1 file, uncompressed for .nii, or gzip compressed at compression_level for .nii.gz
+    voxels are split into blocks of block_size bytes, which a thread pool compresses into separate gzip members,
+    and the members are concatenated in order, which is still a valid gzip stream for zlib, itk, nibabel, and gzip tools
+    returns number of bytes written'''
+
+    arr = np.ascontiguousarray(arr, dtype=np.dtype(arr.dtype).newbyteorder('<'))
+    header = nifti_header(shape=arr.shape, dtype=arr.dtype, spacing=spacing, origin=origin, direction=direction)
+    data = memoryview(arr.reshape(-1)).cast('B')
+
+    with open(filepath, 'wb') as f:
+        if not str(filepath).endswith('.gz'):
+            f.write(header)
+            f.write(data)
+        else:
+            blocks = [header] + [data[k:k+block_size] for k in range(0, len(data), block_size)]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for member in executor.map(_gzip_member, blocks, [compression_level]*len(blocks)):
+                    f.write(member)
+        size = f.tell()
+
+    return size
@@ -0,0 +1,202 @@
+import weakref
+from itertools import product
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import numpy as np
+from vtkmodules.vtkCommonDataModel import vtkImageData, vtkPolyData
+from vtkmodules.vtkFiltersGeneral import vtkDiscreteFlyingEdges3D
+from vtkmodules.vtkFiltersCore import vtkWindowedSincPolyDataFilter, vtkAppendPolyData
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from .base import *
+from .image import *
+
+
+def extract_surface(block:np.ndarray, *, offset=(0,0,0), frame:ImageFrame, smoothing_iterations=15, pass_band=.1, pad=True) -> vtkPolyData:
+    '''extracts the surface of a (+z, +y, +x) bool block, whose first voxel is voxel offset (z, y, x) of an image of frame,
+    with discrete flying edges, smoothed by a windowed sinc filter unless smoothing_iterations is 0
+    the block is padded by one voxel if pad, so surfaces are closed where a roi touches the box, and points are in physical
+    coordinates of frame, including its direction, so meshes of different boxes of the same image line up
+    boundary points are never smoothed, so meshes of blocks sharing a face of voxels join, to within float rounding'''
+
+    padded = (np.pad(block, 1) if pad else block).astype(np.uint8)
+    img = vtkImageData()
+    img.SetDimensions(padded.shape[::-1])
+    img.SetSpacing(frame.spacing)
+    img.GetPointData().SetScalars(numpy_to_vtk(padded.ravel(), deep=0))
+
+    fe = vtkDiscreteFlyingEdges3D()
+    fe.SetInputData(img)
+    fe.SetValue(0, 1)
+    fe.ComputeNormalsOff()
+    fe.ComputeGradientsOff()
+    fe.ComputeScalarsOff()
+    fe.Update()
+    output = fe
+
+    if smoothing_iterations and fe.GetOutput().GetNumberOfCells(): # a block inside a roi has no surface
+        smoother = vtkWindowedSincPolyDataFilter()
+        smoother.SetInputData(fe.GetOutput())
+        smoother.SetNumberOfIterations(smoothing_iterations)
+        smoother.SetPassBand(pass_band)
+        smoother.BoundarySmoothingOff()
+        smoother.FeatureEdgeSmoothingOff()
+        smoother.NonManifoldSmoothingOn()
+        smoother.NormalizeCoordinatesOn()
+        output = smoother
+
+    output.Update()
+    mesh = vtkPolyData()
+    mesh.ShallowCopy(output.GetOutput())
+
+    # from spacing-scaled index of the padded block to physical, p = origin + direction @ (spacing * index)
+    if mesh.GetNumberOfPoints():
+        points = vtk_to_numpy(mesh.GetPoints().GetData())
+        shift = (np.array(offset[::-1], dtype=float) - bool(pad)) * np.array(frame.spacing)
+        points[...] = (points + shift) @ np.array(frame.direction, dtype=float).T + np.array(frame.origin)
+        mesh.GetPoints().Modified()
+
+    return mesh
+
+
+
+def append_surfaces(meshes) -> vtkPolyData:
+    '''appends meshes into one vtkPolyData, points shared by two meshes are not merged'''
+    mesh = vtkPolyData()
+    meshes = list(meshes)
+    if meshes:
+        append = vtkAppendPolyData()
+        for m in meshes:
+            append.AddInputData(m)
+        append.Update()
+        mesh.ShallowCopy(append.GetOutput())
+    return mesh
+
+
+
+@dataclass(eq=False)
+class _Surface:
+    # mesh of one roi as of version, kept as bricks, see SurfaceExtractor
+    frame: ImageFrame
+    version: int
+    future: Future = None
+    bricks: dict = field(default_factory=dict) # brick index -> mesh, filled in when future is done
+
+
+
+class SurfaceExtractor:
+    '''this class turns roi's of a SkullEngineMultiRoiMask into smoothed surface meshes, one vtkPolyData per roi
+    meshes are built by a thread pool (vtk filters release the gil) out of bricks of brick_size cells of the padded volume,
+    a brick is meshed only where a roi has voxels, and bricks sharing a face join because their boundary points stay put
+    meshes are kept by roi version, see SkullEngineMultiRoiMask.version, and when a roi changes, only bricks that hold
+    a changed voxel, see SkullEngineMultiRoiMask.changes_since, are meshed again, so a brush stroke costs a few bricks'''
+
+    def __init__(self, *, max_workers=None, smoothing_iterations=15, pass_band=.1, brick_size=64) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.smoothing_iterations = smoothing_iterations
+        self.pass_band = pass_band
+        self.brick_size = brick_size
+        self.cache = {} # mask_id -> _Surface
+        self.mask = None # weak reference to the mask of cache
+        return None
+
+
+    def surfaces(self, mask:SkullEngineMultiRoiMask, mask_ids=None) -> dict:
+        '''returns mask_id -> future of mesh for roi's of mask with at least one voxel set, all of them if mask_ids is None
+        roi's whose version and frame are unchanged get their cached future, changed roi's get bricks of changed voxels
+        meshed again, and the others are meshed from scratch
+        with mask_ids None, roi's are found by scanning mask only the first time, and after that by their versions,
+        so a roi emptied by an edit keeps an empty mesh until it is meshed from scratch'''
+
+        if self.mask is None or self.mask() is not mask:
+            self.cache.clear()
+            self.mask = weakref.ref(mask)
+
+        if mask_ids is not None:
+            ids = list(mask_ids)
+        elif self.cache:
+            ids = sorted(set(self.cache) | {i for i, v in mask.versions.items() if i not in self.cache or self.cache[i].version != v})
+        else:
+            ids = mask.mask_ids_in_use()
+
+        full = []
+        for i in ids:
+            previous = self.cache.get(i)
+            version = mask.version(i)
+            if previous is not None and previous.version == version and previous.frame == mask.frame:
+                continue
+            changes = None if previous is None or previous.frame != mask.frame else mask.changes_since(i, previous.version)
+            if changes is None:
+                full.append(i)
+            else:
+                surface = self.cache[i] = _Surface(mask.frame, version)
+                surface.future = self.executor.submit(self._build, mask, i, surface, previous, changes)
+
+        boxes = mask.boxes(full) if full else {}
+        for i in full:
+            if i in boxes:
+                surface = self.cache[i] = _Surface(mask.frame, mask.version(i))
+                surface.future = self.executor.submit(self._build, mask, i, surface, None, [boxes[i]])
+            else: # empty roi
+                self.cache.pop(i, None)
+
+        return {i: self.cache[i].future for i in ids if i in self.cache}
+
+
+    def _bricks_of(self, boxes, shape) -> set:
+        # indices of bricks with a cell touching a voxel of boxes
+        # voxel v is point v+1 of the volume padded by one, touching cells v and v+1 of the padded volume
+        out = set()
+        for box in boxes:
+            if any(s.stop <= s.start for s in box):
+                continue
+            ranges = [range(s.start//self.brick_size, min(s.stop, n)//self.brick_size + 1) for s, n in zip(box, shape)]
+            out.update(product(*ranges))
+        return out
+
+
+    def _extract_brick(self, mask, mask_id, brick):
+        # cells [c0, c1) of the padded volume need its points [c0, c1], which are voxels [c0-1, c1-1]
+        shape = mask.frame.size[::-1]
+        box, pad = [], []
+        for b, n in zip(brick, shape):
+            start, stop = b*self.brick_size - 1, min((b+1)*self.brick_size, n+1)
+            box.append(slice(max(start, 0), min(stop, n)))
+            pad.append((int(start < 0), int(stop > n)))
+        block = np.pad(mask.test(mask_id=mask_id, voxel_index=tuple(box)), pad)
+        if not block.any():
+            return None
+        return extract_surface(block, offset=tuple(s.start - p[0] for s, p in zip(box, pad)), frame=mask.frame, pad=False,
+                               smoothing_iterations=self.smoothing_iterations, pass_band=self.pass_band)
+
+
+    def _build(self, mask, mask_id, surface, previous, boxes):
+        bricks = {}
+        if previous is not None:
+            wait([previous.future]) # submitted earlier, so it is running or done
+            if previous.future.cancelled() or previous.future.exception() is not None:
+                boxes = list(mask.boxes([mask_id]).values())
+            else:
+                bricks.update(previous.bricks)
+
+        for brick in self._bricks_of(boxes, mask.frame.size[::-1]):
+            mesh = self._extract_brick(mask, mask_id, brick)
+            if mesh is None or not mesh.GetNumberOfCells():
+                bricks.pop(brick, None)
+            else:
+                bricks[brick] = mesh
+
+        surface.bricks = bricks
+        return append_surfaces(bricks[b] for b in sorted(bricks))
+
+
+    def discard(self, mask_ids=None) -> None:
+        '''forgets meshes of mask_ids, or all of them'''
+        for i in (list(self.cache) if mask_ids is None else mask_ids):
+            self.cache.pop(i, None)
+        return None
+
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        return None
@@ -1,55 +1,399 @@
 
 import os
+import re
 import numpy as np
+import scipy
 from .base import *
-from scipy.ndimage import zoom
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import zoom, spline_filter1d, affine_transform, gaussian_filter
+
+# private scipy api, used to interpolate part of the output exactly as zoom would,
+# only for the scipy versions it was tested with, any other version resamples with the public zoom
+_SCIPY_TESTED = ((1, 6), (1, 18))
+_zoom_shift = None
+if _SCIPY_TESTED[0] <= tuple(int(v) for v in re.findall(r'\d+', scipy.__version__)[:2]) < _SCIPY_TESTED[1]:
+    try:
+        from scipy.ndimage._nd_image import zoom_shift as _zoom_shift
+        from scipy.ndimage._interpolation import _prepad_for_spline_filter
+        from scipy.ndimage._ni_support import _extend_mode_to_code
+    except (ImportError, AttributeError):
+        _zoom_shift = None
 from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 
-def read_dicom(filepath, *, rescale=False, **kw):
-    # get series id from the file
-    file_reader = sitk.ImageFileReader()
-    file_reader.SetFileName(filepath)
-    file_reader.SetImageIO("GDCMImageIO")
-    file_reader.LoadPrivateTagsOn()
-    file_reader.ReadImageInformation()
-    series_instance_uid = ''
-    if file_reader.HasMetaDataKey('0020|000e'):
-        series_instance_uid = file_reader.GetMetaData('0020|000e')
-
-    # find all the files in the same series and same directory
-    dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(os.path.dirname(filepath), series_instance_uid)
-
-    # read the series
-    reader = sitk.ImageSeriesReader()
-    reader.SetImageIO("GDCMImageIO")
-    reader.SetFileNames(dicom_names)
-    reader.SetOutputPixelType()
-    reader.LoadPrivateTagsOn()
-    img = reader.Execute()
-
-    if rescale:
-        if img.HasMetaDataKey('0028|1052') and img.HasMetaDataKey('0028|1053'):
-            b,m = float(img.GetMetaData('0028|1052')), float(img.GetMetaData('0028|1053')) # Rescale Intercept, Rescale Slope
+# numpy dtypes that sitk images can hold as scalar pixels
+_SITK_PIXEL_TYPES = {
+    np.dtype(np.uint8): sitk.sitkUInt8,
+    np.dtype(np.int8): sitk.sitkInt8,
+    np.dtype(np.uint16): sitk.sitkUInt16,
+    np.dtype(np.int16): sitk.sitkInt16,
+    np.dtype(np.uint32): sitk.sitkUInt32,
+    np.dtype(np.int32): sitk.sitkInt32,
+    np.dtype(np.uint64): sitk.sitkUInt64,
+    np.dtype(np.int64): sitk.sitkInt64,
+    np.dtype(np.float32): sitk.sitkFloat32,
+    np.dtype(np.float64): sitk.sitkFloat64,
+}
+
+
+class _ItkBuffer:
+    # exposes the pixel buffer of a sitk image to numpy, and keeps the image alive as long as any array views it
+    # the image is made unique first, since writing through the view bypasses copy-on-write of sitk
+
+    def __init__(self, img:sitk.Image) -> None:
+        img.MakeUnique()
+        view = sitk.GetArrayViewFromImage(img)
+        self.image = img
+        self.nbytes = view.nbytes
+        self.__array_interface__ = dict(view.__array_interface__, data=(view.__array_interface__['data'][0], False))
+        return None
+
+
+def itk_view(img:sitk.Image) -> np.ndarray:
+    '''creates a writable (+z, +y, +x) numpy view of the pixel buffer of img, which stays alive as long as the view'''
+    return np.asarray(_ItkBuffer(img))
+
+
+def itk_empty(shape, dtype) -> np.ndarray:
+    '''allocates a zero-filled (+z, +y, +x) array inside a new sitk image, so it can be handed to itk later without a copy
+    falls back to a plain numpy array for types that sitk does not have, e.g. bool'''
+    if np.dtype(dtype) not in _SITK_PIXEL_TYPES:
+        return np.zeros(shape, dtype=dtype)
+    return itk_view(sitk.Image(tuple(int(s) for s in shape[::-1]), _SITK_PIXEL_TYPES[np.dtype(dtype)]))
+
+
+def itk_image_of(arr) -> sitk.Image:
+    '''finds the sitk image whose whole pixel buffer arr views, arr being a numpy or vtk array, or returns None'''
+    ptr = None
+    while arr is not None:
+        if isinstance(arr, _ItkBuffer):
+            if ptr is None or ptr == (arr.__array_interface__['data'][0], arr.nbytes):
+                return arr.image
+            return None
+        if isinstance(arr, np.ndarray):
+            if ptr is None:
+                ptr = (arr.__array_interface__['data'][0], arr.nbytes)
+            arr = arr.base
+        elif isinstance(arr, vtkDataArray):
+            buffer = arr.GetBuffer() if hasattr(arr, 'GetBuffer') else arr # numpy reference moved to the buffer in newer vtk
+            arr = getattr(buffer, '_numpy_reference', getattr(arr, '_numpy_reference', None))
         else:
-            b,m = -1024., 1. # this is a compramise for current situation
-        
-        img = (img-m) / m
+            return None
+    return None
 
-    return img
 
+def read_int16(src, *, count=-1) -> np.ndarray:
+    '''reads an int16 array from a file path, a bytes-like object, or a readable binary stream
+    a stream with known count is read straight into the returned array, otherwise the returned array may be read-only'''
+
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return np.frombuffer(src, dtype=np.int16, count=count)
+
+    elif hasattr(src, 'read'):
+        if count < 0:
+            return np.frombuffer(src.read(), dtype=np.int16)
+        arr = np.empty(count, dtype=np.int16)
+        buf = memoryview(arr).cast('B')
+        n = 0
+        while n < buf.nbytes:
+            k = src.readinto(buf[n:])
+            if not k:
+                raise ValueError(f'expected {count} int16 values but stream ended after {n//2}')
+            n += k
+        return arr
+
+    else:
+        return np.fromfile(src, dtype=np.int16, count=count)
+
+
+def flip_aa(arr:np.ndarray, *, chunk=4096) -> np.ndarray:
+    '''reverses axial and coronal axes of a C-contiguous (z, y, x) array in place, and returns it
+    this converts between AnatomicAligner (-z, -y, +x) order and (+z, +y, +x) order without a full copy,
+    since reversing both axes is reversing the order of x rows, rows are swapped in chunks with a small temporary'''
+
+    if not arr.flags.c_contiguous: # reshape would flip a copy, and leave arr as it was
+        raise ValueError('flip_aa needs a C-contiguous array')
+    rows = arr.reshape(-1, arr.shape[-1])
+    n = rows.shape[0]
+    for a in range(0, n//2, chunk):
+        b = min(a+chunk, n//2)
+        tmp = rows[a:b].copy()
+        rows[a:b] = rows[n-b:n-a][::-1]
+        rows[n-b:n-a] = tmp[::-1]
+
+    return arr
+
+
+def decode_runs_aa(runs:np.ndarray, *, shape) -> np.ndarray:
+    '''decodes AnatomicAligner run-length table into a flipped (+z, +y, +x) int8 volume
+    runs is the raw int16 stream of a mask bin file, every 4 values being (j, start, length, i) in (-z, -y, +x) order
+    runs are painted into a flat difference array and integrated in place, so no per-run python loop nor flip copy is needed
+    runs within a row must not overlap, which holds for every file written by AnatomicAligner or write_bin_aa'''
+
+    nz, ny, nx = shape
+    runs = np.asarray(runs).reshape(-1, 4).astype(np.int64)
+    j, start, length, i = runs.T
+    begin = ((nz-1-i)*ny + (ny-1-j))*nx + start # x axis is not flipped, so runs stay contiguous in the output
+    end = begin + length
+
+    arr = np.zeros(nz*ny*nx+1, dtype=np.int8) # one extra element for runs ending at the last voxel
+    arr[begin] += 1 # begins are unique, and so are ends, but a run may begin where the previous row's run ends
+    arr[end] -= 1
+    np.cumsum(arr, dtype=np.int8, out=arr)
+
+    return arr[:-1].reshape(shape)
+
+
+def encode_runs_aa(arr:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''encodes a (+z, +y, +x) label volume into AnatomicAligner run-length table
+    returns an (N,4) int16 table of (j, start, length, i) in (-z, -y, +x) order, and the label value of each run
+    runs of all labels are found at once from a single comparison along x, and are ordered by i, j, then start, same as AnatomicAligner'''
+
+    arr = arr[::-1,::-1,:]
+    neq = arr[...,1:] != arr[...,:-1]
+    first = arr != 0
+    last = first.copy()
+    first[...,1:] &= neq
+    last[...,:-1] &= neq
+    del neq
+
+    i, j, start = np.nonzero(first)
+    *_, end = np.nonzero(last) # every run has exactly one first and one last voxel in the same row
+    values = arr[i, j, start]
+    runs = np.stack((j, start, end-start+1, i), axis=1).astype(np.int16)
+
+    return runs, values
+
+
+def label_lookup(arr:np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''finds label values of arr, and an index array that points each voxel to a slot of a lookup table
+    returns sorted values, slot of each value, and index, so that any per-label table lut gives per-voxel values as lut[index]
+    small non-negative integer labels are their own slots, which takes a single bincount and no copy of arr'''
+
+    if arr.dtype.kind in 'ub' or (arr.dtype.kind == 'i' and arr.size and arr.min() >= 0):
+        arr = arr.view(np.uint8) if arr.dtype == bool else arr
+        if not arr.size or arr.max() < max(1 << 16, arr.size):
+            values = np.flatnonzero(np.bincount(arr.ravel()))
+            return values.astype(arr.dtype), values, arr
+
+    values, index = np.unique(arr, return_inverse=True)
+    return values, np.arange(values.size), index.reshape(arr.shape)
+
+
+def downsample(arr:np.ndarray, *, reduce='mean', max_workers=None) -> np.ndarray:
+    '''halves every axis of a (+z, +y, +x) array, each voxel of output is the mean of a 2x2x2 block of arr,
+    or its bitwise or if reduce is 'or', which keeps every roi of a bitfield mask visible however thin
+    odd sizes are padded by repeating the last slice, row, or column, so output shape is ceil(shape/2)
+    output slices are reduced by a thread pool, each from two slices of arr, so temporaries stay slice sized'''
+
+    if reduce not in ('mean', 'or'):
+        raise ValueError(f'cannot reduce by {reduce}')
+    nz, ny, nx = arr.shape
+    out = np.empty(((nz+1)//2, (ny+1)//2, (nx+1)//2), dtype=arr.dtype)
+
+    def _reduce(k):
+        block = arr[2*k:2*k+2]
+        block = np.pad(block, ((0, 2-block.shape[0]), (0, ny%2), (0, nx%2)), mode='edge')
+        block = block.reshape(2, out.shape[1], 2, out.shape[2], 2)
+        if reduce == 'or':
+            out[k] = np.bitwise_or.reduce(block, axis=(0,2,4))
+        elif arr.dtype.kind == 'f':
+            out[k] = block.mean(axis=(0,2,4), dtype=np.float64)
+        else:
+            out[k] = np.rint(block.sum(axis=(0,2,4), dtype=np.float64)/8)
 
-def resample(arr:np.ndarray, *, old_spacing, new_spacing, **kw) -> np.ndarray:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_reduce, range(out.shape[0])))
+
+    return out
+
+
+def resample(arr:np.ndarray, *, old_spacing, new_spacing, max_workers=None, slab_size=8, **kw) -> np.ndarray:
 
     # kw is passed to zoom method, and often contains
     #   mode='grid-constant' # controls behavior outside bounds
     #   order=0 
     #   cval=0
+    # the result is exactly that of a single zoom call with grid_mode=True, but output is split into slabs of slab_size along z,
+    # which a thread pool interpolates from the same (prefiltered) input, since scipy releases the gil,
+    # and writes straight into an output of the same dtype as arr, without a full-size copy at the end
+    # slabs need private scipy functions, without them, or if their signature is not the tested one, this is a single zoom call
 
     z = np.array(old_spacing)/np.array(new_spacing)
-    arr = zoom(arr, zoom=z[::-1], grid_mode=True, **kw).astype(arr.dtype)
+    if _zoom_shift is not None:
+        try:
+            return _resample_slabs(arr, z, max_workers=max_workers, slab_size=slab_size, **kw)
+        except TypeError: # bad arguments raise again in zoom
+            pass
+    return zoom(arr, zoom=z[::-1], grid_mode=True, **kw).astype(arr.dtype)
 
-    return arr
 
-    
+def _resample_slabs(arr, z, *, max_workers, slab_size, **kw):
+    '''resample on slabs of the output in a thread pool, with the private scipy zoom_shift'''
+
+    order, mode, cval, prefilter = kw.pop('order', 3), kw.pop('mode', 'constant'), kw.pop('cval', 0.), kw.pop('prefilter', True)
+    if kw:
+        raise ValueError(f'unsupported arguments {list(kw)}')
+    if order < 0 or order > 5:
+        raise ValueError('spline order not supported')
+
+    output_shape = tuple(int(round(n*f)) for n, f in zip(arr.shape, z[::-1]))
+    output = itk_empty(output_shape, dtype=arr.dtype)
+    if output_shape == arr.shape and all(f == 1 for f in z) and prefilter: # same as zoom, which returns a copy
+        output[...] = arr
+        return output
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # spline prefilter is separable, each 1d pass is split across lines, so its result is exactly that of spline_filter
+        if prefilter and order > 1:
+            filtered, npad = _prepad_for_spline_filter(arr, mode, cval)
+            filtered = filtered.astype(np.float64)
+            for axis in range(filtered.ndim):
+                other = 1 if axis == 0 else 0
+                chunks = [(slice(None),)*other + (slice(k, k+slab_size),) for k in range(0, filtered.shape[other], slab_size)]
+                list(executor.map(lambda c: spline_filter1d(filtered[c], order, axis, output=filtered[c], mode=mode), chunks))
+        else:
+            filtered, npad = arr, 0
+
+        # output index k of a slab starting at k0 maps to input exactly as k0+k in the whole output, same arithmetic as zoom
+        ratio = np.ascontiguousarray(np.divide(arr.shape, output_shape, out=np.ones(arr.ndim), where=np.array(output_shape) != 0))
+        mode_code = _extend_mode_to_code(mode)
+        def _slab(k0):
+            shift = np.zeros(arr.ndim)
+            shift[0] = k0
+            _zoom_shift(filtered, ratio, shift, output[k0:k0+slab_size], order, mode_code, cval, npad, True)
+        list(executor.map(_slab, range(0, output_shape[0], slab_size)))
+
+    return output
+
+
+
+def resample_sitk(arr:np.ndarray, *, old_spacing, new_spacing, max_workers=None, order=3, cval=0., **kw) -> np.ndarray:
+    '''resamples arr with sitk.ResampleImageFilter in max_workers threads, on the same grid as resample, i.e. zoom with grid_mode=True
+    output voxel k is centered at (k+.5)*ratio-.5 of the input, for ratio = input size/output size along each axis,
+    order picks nearest neighbor (0), linear (1), or b-spline interpolation, and points outside the input are cval
+    kw, e.g. mode, is accepted for compatibility with resample, and ignored, since itk extrapolates half a voxel beyond the border'''
+
+    z = np.array(old_spacing)/np.array(new_spacing)
+    output_shape = tuple(int(round(n*f)) for n, f in zip(arr.shape, z[::-1]))
+    ratio = np.divide(arr.shape, output_shape, out=np.ones(arr.ndim), where=np.array(output_shape) != 0)[::-1] # x, y, z
+
+    # grid is expressed relative to the input grid, whatever its geometry is, which is then also the geometry of the output
+    # if arr lives in a sitk image, that image is resampled directly, without a copy
+    img = itk_image_of(arr) if arr.flags.c_contiguous else None
+    img = sitk.GetImageFromArray(arr) if img is None else img
+    interpolator = {0: sitk.sitkNearestNeighbor, 1: sitk.sitkLinear}.get(order, getattr(sitk, f'sitkBSpline{order}', sitk.sitkBSpline))
+    f = sitk.ResampleImageFilter()
+    f.SetSize(output_shape[::-1])
+    f.SetOutputSpacing(tuple(np.multiply(img.GetSpacing(), ratio)))
+    f.SetOutputOrigin(img.TransformContinuousIndexToPhysicalPoint(tuple(.5*ratio - .5)))
+    f.SetOutputDirection(img.GetDirection())
+    f.SetInterpolator(interpolator)
+    f.SetDefaultPixelValue(float(cval))
+    f.SetOutputPixelType(img.GetPixelID())
+    f.SetNumberOfThreads(max_workers or os.cpu_count() or 1)
+
+    return itk_view(f.Execute(img))
+
+
+# resample functions that DataManager.resample can choose from by name
+RESAMPLE_BACKENDS = {
+    'scipy': resample,
+    'sitk': resample_sitk,
+}
+
+# number of set bits of each byte value, for bit_count on numpy without bitwise_count
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:,None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def bit_count(arr:np.ndarray) -> np.ndarray:
+    '''number of set bits of each element of an unsigned integer array, as uint8
+    this is np.bitwise_count, which numpy has from 2.0 on, or a lookup of each byte on older numpy'''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(arr)
+    arr = np.ascontiguousarray(arr)
+    return _BYTE_BITS[arr.view(np.uint8).reshape(*arr.shape, arr.dtype.itemsize)].sum(axis=-1, dtype=np.uint8)
+
+
+def bit_boxes(arr:np.ndarray) -> dict:
+    '''bounding boxes of the bits of a bitfield array, e.g. data or a plane of SkullEngineMultiRoiMask, as bit -> tuple of slices
+    all boxes come from one or-projection per axis, and bits that are never set are left out'''
+
+    # or of all voxels in each slice of each axis, bit b of proj[axis][k] tells whether roi b reaches slice k
+    proj = [np.bitwise_or.reduce(arr, axis=tuple(a for a in range(arr.ndim) if a != axis)) for axis in range(arr.ndim)]
+    present = int(np.bitwise_or.reduce(proj[0])) if arr.size else 0
+    boxes = {}
+    for b in range(arr.dtype.itemsize*8):
+        if present >> b & 1:
+            one = arr.dtype.type(1) << arr.dtype.type(b)
+            nz = [np.flatnonzero(p & one) for p in proj]
+            boxes[b] = tuple(slice(int(n[0]), int(n[-1])+1) for n in nz)
+    return boxes
+
+
+def index_box(voxel_index, shape) -> tuple:
+    '''bounding box, as a tuple of slices, of the voxels that voxel_index selects in an array of shape
+    voxel_index can be a bool array of shape, a tuple of slices, or a tuple of coordinate arrays as returned from np.nonzero
+    returns None for None (every voxel) or anything else, meaning the box is unknown, and an empty box if nothing is selected'''
+
+    if voxel_index is None:
+        return None
+    if isinstance(voxel_index, np.ndarray) and voxel_index.dtype == bool and voxel_index.shape == tuple(shape):
+        box = []
+        for axis in range(len(shape)):
+            nz = np.flatnonzero(np.any(voxel_index, axis=tuple(a for a in range(len(shape)) if a != axis)))
+            if not nz.size:
+                return tuple(slice(0, 0) for _ in shape)
+            box.append(slice(int(nz[0]), int(nz[-1])+1))
+        return tuple(box)
+    if isinstance(voxel_index, tuple) and len(voxel_index) == len(shape):
+        if all(isinstance(s, slice) for s in voxel_index):
+            return tuple(slice(*s.indices(n)[:2]) if s.step in (None, 1) else slice(0, n) for s, n in zip(voxel_index, shape))
+        coords = [np.asarray(c) for c in voxel_index]
+        if all(c.dtype.kind in 'iu' for c in coords):
+            if not all(c.size for c in coords):
+                return tuple(slice(0, 0) for _ in shape)
+            coords = [c % n for c, n in zip(coords, shape)] # negative indices count from the end
+            return tuple(slice(int(c.min()), int(c.max())+1) for c in coords)
+    return None
+
+
+def resample_bits(arr:np.ndarray, *, old_spacing, new_spacing, order=1, sigma=0., max_workers=None) -> np.ndarray:
+    '''resamples a bitfield mask, e.g. data or a plane of SkullEngineMultiRoiMask, one roi (bit) at a time
+    each roi is cropped to its bounding box plus a margin, optionally smoothed with a gaussian of sigma input voxels,
+    interpolated with a spline of order, and thresholded at .5, so upsampled roi's get smooth boundaries instead of staircases
+    bounding boxes of all bits come from three or-projections of arr, and roi's are interpolated concurrently by a thread pool'''
+
+    z = np.array(old_spacing)/np.array(new_spacing)
+    output_shape = tuple(int(round(n*f)) for n, f in zip(arr.shape, z[::-1]))
+    ratio = np.divide(arr.shape, output_shape, out=np.ones(arr.ndim), where=np.array(output_shape) != 0)
+    output = itk_empty(output_shape, dtype=arr.dtype)
+
+    boxes = bit_boxes(arr)
+    margin = int(np.ceil(3*sigma)) + max(order, 1) + 1
+
+    def _roi(b):
+        one = arr.dtype.type(1) << arr.dtype.type(b)
+        in_box, out_box, offset = [], [], []
+        for axis in range(arr.ndim):
+            box = boxes[b][axis]
+            a0, a1 = max(box.start - margin, 0), min(box.stop + margin, arr.shape[axis])
+            # output voxels k whose position (k+.5)*ratio-.5 falls within the cropped input
+            k0 = max(int(np.floor((a0 + .5)/ratio[axis] - .5)), 0)
+            k1 = min(int(np.ceil((a1 - .5)/ratio[axis] - .5)) + 1, output_shape[axis])
+            in_box.append(slice(a0, a1))
+            out_box.append(slice(k0, max(k0, k1)))
+            offset.append((k0 + .5)*ratio[axis] - .5 - a0)
+        block = ((arr[tuple(in_box)] & one) != 0).astype(np.float32)
+        if sigma:
+            block = gaussian_filter(block, sigma, mode='nearest')
+        shape = tuple(s.stop - s.start for s in out_box)
+        block = affine_transform(block, ratio, offset=offset, output_shape=shape, order=order, mode='nearest')
+        return tuple(out_box), block >= .5, one
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for box, hit, one in executor.map(_roi, boxes): # or is done here, since boxes of different roi's overlap
+            output[box] |= hit.astype(arr.dtype) * one
 
+    return output
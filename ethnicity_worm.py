@@ -1,40 +1,48 @@
-import sys
 import csv
-import SimpleITK as sitk
+import argparse
 import pathlib
+from data.index import DicomIndex
 
-result = {}
-p = pathlib.Path('X:')
-with open('temp.csv', 'w') as sys.stdout:
-    for file in p.glob('**/0000.dcm'):
-
-        try:
-            file_reader = sitk.ImageFileReader()
-            file_reader.SetImageIO('GDCMImageIO')
-            file_reader.SetFileName(str(file))
-            file_reader.LoadPrivateTagsOn()
-            file_reader.ReadImageInformation()
-            info = {k: file_reader.GetMetaData(k) for k in file_reader.GetMetaDataKeys()}
-        except:
-            continue
-
-        if '0010|0010' in info:
-            
-            name = info['0010|0010'].strip()
-            race = ''
-            if '0010|2160' in info:
-                race = info['0010|2160'].strip()
-
-            print(f'{name},{race},{file}')
+
+def ethnic_groups(index, names=None, *, listing='temp.csv') -> dict:
+    '''name -> ethnic group of patients in index, only those of names if given, and every indexed file goes to listing'''
+
+    result = {}
+    with open(listing, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for name, race, file in index.query('select patient_name, ethnic_group, path from files where is_dicom and patient_name is not null order by path'):
+
+            race = race or ''
+
+            writer.writerow([name, race, file])
 
             if name and race:
                 if name in result:
                     if race != result[name]:
                         print(f"* check {name}")
-                elif name in names:
+                elif names is None or name in names:
                     result[name] = race
 
+    return result
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='collects ethnic groups of patients from the first file of every dicom series')
+    parser.add_argument('root', nargs='?', default='X:')
+    parser.add_argument('--names', default=None, help='file of patient names to keep, one per line, all patients if not given')
+    parser.add_argument('--index', default='dicom_index.db', help='sqlite index, only files changed since the last run are read')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    names = None
+    if args.names:
+        with open(args.names, encoding='utf-8') as f:
+            names = {l.strip() for l in f if l.strip()}
 
-with open('result.csv', 'w', newline='') as f:
-    csv.writer(f).writerows(result.items())
+    with DicomIndex(args.index) as index:
+        index.update(pathlib.Path(args.root), pattern='0000.dcm', max_workers=args.workers) # a killed update keeps the batches it committed
+        result = ethnic_groups(index, names)
 
+    with open('result.csv', 'w', newline='') as f:
+        csv.writer(f).writerows(result.items())
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from scipy.ndimage import zoom
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+import data.util
+from data import *
+from data.benchmark import phantom, _read_bin_aa_loop, _write_bin_aa_loop, _add_mask_loop
+
+
+SHAPE = (20,32,28)
+
+
+def make_mask(arr):
+    frame = ImageFrame(size=arr.shape[::-1], spacing=(1.,1.,1.))
+    ref = SkullEngineScan.empty(frame=frame, dtype=np.int16)
+    return SkullEngineMask(data=numpy_to_vtk(arr.flat, deep=0), reference_scan=ref, identifier=Identifier())
+
+
+def test_read_bin_aa_matches_loop(tmp_path):
+    arr = (phantom(SHAPE) > 0).astype(np.int8)
+    frame = ImageFrame(size=SHAPE[::-1], spacing=(1.,1.,1.))
+    filepath = str(tmp_path / '0.bin')
+    make_mask(arr).write_bin_aa(filepath)
+
+    assert np.array_equal(_read_bin_aa_loop(filepath, frame=frame), arr)
+    assert np.array_equal(vtk_to_numpy(SkullEngineMask.read_bin_aa(filepath, frame=frame).data).reshape(SHAPE), arr)
+
+
+@pytest.mark.parametrize('max_workers', [None, 4])
+def test_write_bin_aa_matches_loop(tmp_path, max_workers):
+    arr = phantom(SHAPE, num_labels=6)
+    os.mkdir(tmp_path / 'loop')
+    os.mkdir(tmp_path / 'vec')
+
+    _write_bin_aa_loop(arr, str(tmp_path / 'loop' / 'm.bin'))
+    make_mask(arr).write_bin_aa(str(tmp_path / 'vec' / 'm.bin'), max_workers=max_workers)
+
+    files = sorted(os.listdir(tmp_path / 'loop'))
+    assert files == sorted(os.listdir(tmp_path / 'vec'))
+    for f in files:
+        assert (tmp_path / 'loop' / f).read_bytes() == (tmp_path / 'vec' / f).read_bytes(), f
+
+
+def test_add_mask_matches_loop():
+    arr = phantom(SHAPE, num_labels=12)
+    bits = []
+    for f in (_add_mask_loop, lambda man, arr: man.add_mask(arr=arr)):
+        man = DataManager()
+        man.set_scan(SkullEngineScan.empty(frame=ImageFrame(size=SHAPE[::-1], spacing=(1.,1.,1.)), dtype=np.int16))
+        f(man, arr)
+        bits.append(man.get_mask().numpy_array().copy())
+
+    assert np.array_equal(*bits)
+
+
+def test_resample_matches_zoom():
+    arr = np.random.default_rng(0).integers(-1000, 2000, SHAPE).astype(np.int16)
+    old_spacing, new_spacing = (.3,.3,.3), (.2,.2,.2)
+    z = np.array(old_spacing)/np.array(new_spacing)
+
+    ref = zoom(arr, zoom=z[::-1], grid_mode=True, mode='nearest').astype(arr.dtype)
+    out = resample(arr, old_spacing=old_spacing, new_spacing=new_spacing, max_workers=3, mode='nearest')
+
+    assert np.array_equal(ref, out)
+
+
+@pytest.mark.parametrize('zoom_shift', [None, lambda input, zoom, shift, output: None]) # scipy without it, or with another signature
+def test_resample_falls_back_to_zoom(monkeypatch, zoom_shift):
+    monkeypatch.setattr(data.util, '_zoom_shift', zoom_shift)
+    arr = np.random.default_rng(0).integers(-1000, 2000, SHAPE).astype(np.int16)
+
+    ref = zoom(arr, zoom=1.5, grid_mode=True, mode='nearest').astype(arr.dtype)
+    out = resample(arr, old_spacing=(.3,.3,.3), new_spacing=(.2,.2,.2), max_workers=3, mode='nearest')
+
+    assert np.array_equal(ref, out)
+
+
+def test_resample_bits_matches_zoom_per_label():
+    num_labels = 8
+    lab = phantom(SHAPE, num_labels=num_labels, porosity=0.)
+    arr = np.zeros(SHAPE, dtype=MASK_DTYPE)
+    for v in range(num_labels):
+        arr[lab == v+1] |= MASK_DTYPE(1) << MASK_DTYPE(v)
+    z = 2.
+
+    ref = np.zeros(tuple(int(round(n*z)) for n in SHAPE), dtype=MASK_DTYPE)
+    for v in range(num_labels):
+        f = zoom((arr >> MASK_DTYPE(v) & 1).astype(np.float32), zoom=z, grid_mode=True, mode='nearest', order=1)
+        ref[f >= .5] |= MASK_DTYPE(1) << MASK_DTYPE(v)
+    out = resample_bits(arr, old_spacing=(1.,1.,1.), new_spacing=(.5,.5,.5), order=1, max_workers=3)
+
+    assert np.array_equal(ref, out)
+
+
+@pytest.mark.parametrize('ext, level', [('.nii.gz', 1), ('.nii.gz', 6), ('.nii', 1)])
+@pytest.mark.parametrize('dtype', [np.int16, MASK_DTYPE])
+def test_save_nifti_reads_back_with_sitk(tmp_path, ext, level, dtype):
+    arr = phantom(SHAPE, num_labels=5).astype(dtype)
+    img = SkullEngineScan(data=numpy_to_vtk(arr.flat, deep=0), frame=ImageFrame(size=SHAPE[::-1], spacing=(.4,.4,.4)), identifier=Identifier())
+    filepath = str(tmp_path / ('a' + ext))
+
+    img.save(filepath, compression_level=level, max_workers=3)
+
+    assert np.array_equal(sitk.GetArrayViewFromImage(sitk.ReadImage(filepath)), arr)
+
+
+def test_cache_reopens_same_voxels(tmp_path):
+    arr = phantom(SHAPE, num_labels=5, porosity=0.)*400 - 1000
+    source = str(tmp_path / 'ct.nii.gz')
+    SkullEngineScan(data=numpy_to_vtk(arr.flat, deep=0), frame=ImageFrame(size=SHAPE[::-1], spacing=(.4,.4,.4)), identifier=Identifier()).save(source)
+    cache = ImageCache(tmp_path / 'cache')
+
+    first = cache.load(source, SkullEngineScan)
+    second = cache.load(source, SkullEngineScan)
+
+    assert np.array_equal(first.numpy_array(), arr) and np.array_equal(second.numpy_array(), arr)
@@ -0,0 +1,67 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+from data import *
+import data.convert
+from data.convert import *
+
+
+def make_manager(shape=(8,10,12), spacing=(.3,.3,1.2)):
+    man = DataManager()
+    man.set_scan(SkullEngineScan.empty(frame=ImageFrame(size=shape[::-1], spacing=spacing), dtype=np.int16))
+    return man
+
+
+def read_members(dirpath):
+    out = {}
+    for name in sorted(os.listdir(dirpath)):
+        with open(os.path.join(dirpath, name), 'rb') as f:
+            out[name] = f.read()
+    return out
+
+
+def test_overlapping_rois_survive_nifti(tmp_path):
+    man = make_manager()
+    mask = man.get_mask()
+    shape = mask.frame.size[::-1]
+    ids = [0, 1, 2, 40]
+    rng = np.random.default_rng(0)
+    for i in ids:
+        man.get_mask_ids().append(i)
+        mask.set_true(mask_id=i, voxel_index=rng.random(shape) < .4) # roi's overlap at random
+    man.write_aa(tmp_path / 'case')
+
+    os.makedirs(tmp_path / 'nifti')
+    os.makedirs(tmp_path / 'bin')
+    r = convert_case(str(tmp_path / 'case'), str(tmp_path / 'nifti'), 'nifti')
+    assert not r['error'], r['error']
+    nifti = r['output']
+    assert sorted(roi_paths(nifti)) == sorted(mask.overlapped_ids())
+    assert expand_inputs([str(tmp_path / 'nifti' / '*.nii.gz')]) == [nifti]
+
+    r = convert_case(nifti, str(tmp_path / 'bin'), 'bin')
+    assert not r['error'], r['error']
+
+    assert read_members(r['output']) == read_members(tmp_path / 'case')
+
+
+def test_spacing_is_written_without_float32_noise(tmp_path):
+    man = make_manager()
+    man.write_aa(tmp_path / 'case')
+
+    info = (tmp_path / 'case' / 'Patient_info.bin').read_text().split(',')
+    assert info[8:11] == ['0.3', '0.3', '1.2']
+
+
+@pytest.mark.parametrize('version_info', [None, (3, 10)]) # workers are restarted, or not on pythons without max_tasks_per_child
+def test_convert_cases_with_max_tasks_per_child(tmp_path, monkeypatch, version_info):
+    if version_info is not None:
+        monkeypatch.setattr(data.convert, 'sys', SimpleNamespace(version_info=version_info))
+    make_manager().write_aa(tmp_path / 'case')
+
+    r = convert_cases([str(tmp_path / 'case')], str(tmp_path / 'nifti'), 'nifti', max_workers=1, max_tasks_per_child=1)
+
+    assert os.path.isfile(output_path(str(tmp_path / 'case'), str(tmp_path / 'nifti'), 'nifti'))
+    assert (r['converted'], r['errors']) == (1, 0)
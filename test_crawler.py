@@ -0,0 +1,29 @@
+import os
+import json
+
+from data.crawler import *
+
+
+def test_crawl_resumes_from_checkpoint(tmp_path):
+    for d in ('b', 'a', 'a/c'):
+        os.makedirs(tmp_path / 'root' / d, exist_ok=True)
+        for i in range(5):
+            (tmp_path / 'root' / d / f'{i}.dcm').write_bytes(b'not dicom') # every file is a row, with an error
+    output = str(tmp_path / 'headers.csv')
+
+    r = crawl(str(tmp_path / 'root'), output, max_workers=2, chunksize=2, checkpoint_every=3)
+    assert (r['files'], r['errors'], r['skipped']) == (15, 15, 0)
+    with open(output, encoding='utf-8', newline='') as f:
+        lines = f.readlines()
+    assert [l.split(',')[0] for l in lines[1:]] == list(walk_files(str(tmp_path / 'root'))) # rows are in walk order
+
+    # as if killed after 7 files were checkpointed, and part of a later row was written
+    with open(output + '.ckpt', 'w') as f:
+        json.dump(dict(offset=len(''.join(lines[:8]).encode()), files=7), f)
+    with open(output, 'w', encoding='utf-8', newline='') as f:
+        f.write(''.join(lines[:10]) + lines[10][:5])
+
+    r = crawl(str(tmp_path / 'root'), output, max_workers=2, chunksize=2)
+    assert (r['files'], r['skipped']) == (8, 7)
+    with open(output, encoding='utf-8', newline='') as f:
+        assert f.readlines() == lines
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+import data.dicom
+from data import *
+
+
+def make_series(dirpath, *, shape=(6,16,12), slope=1., intercept=-1024.):
+    '''writes a small ct series of signed stored values and returns them'''
+    os.makedirs(dirpath, exist_ok=True)
+    vol = (np.arange(np.prod(shape)).reshape(shape) % 2000 - 500).astype(np.int16)
+    uid = generate_uid()
+    for k in range(shape[0]):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = ds.StudyInstanceUID = uid
+        ds.Modality = 'CT'
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [0., 0., 1.5*k]
+        ds.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+        ds.PixelSpacing = [.5, .5]
+        ds.SliceThickness = 1.5
+        ds.Rows, ds.Columns = shape[1:]
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+        ds.PixelData = vol[k].tobytes()
+        ds.save_as(os.path.join(dirpath, f'{k:04d}.dcm'), enforce_file_format=True)
+    return vol
+
+
+@pytest.mark.parametrize('slope', [1., 2.])
+@pytest.mark.parametrize('rescale', [False, True])
+def test_read_dicom_matches_read_dicom_series(tmp_path, slope, rescale):
+    vol = make_series(tmp_path, slope=slope)
+    filepath = str(tmp_path / '0002.dcm')
+    arr, frame, metadata, timings = read_dicom_series(filepath, rescale=rescale)
+    img = read_dicom(filepath, rescale=rescale)
+    expected = vol * slope - 1024. if rescale else vol
+
+    assert np.array_equal(arr, expected)
+    assert np.array_equal(sitk.GetArrayViewFromImage(img), arr)
+    assert sitk.GetArrayViewFromImage(img).dtype == arr.dtype
+    assert np.allclose(img.GetSpacing(), frame.spacing)
+    assert img.GetMetaData('0020|000e') == metadata['0020|000e']
+
+
+def test_read_falls_back_to_sitk_before_allocating(tmp_path, monkeypatch):
+    vol = make_series(tmp_path)
+    def _undecodable(filepath):
+        raise NotImplementedError('compressed transfer syntax')
+    monkeypatch.setattr(data.dicom, '_read_pixels', _undecodable)
+    opened = []
+
+    img = SkullEngineScan.read(str(tmp_path / '0000.dcm'), on_open=opened.append, has_phi=False)
+
+    assert opened == [img]
+    assert np.array_equal(img.numpy_array(), vol - 1024)
+
+
+def test_read_falls_back_to_sitk_after_allocating(tmp_path, monkeypatch):
+    vol = make_series(tmp_path)
+    read_pixels = data.dicom._read_pixels
+    def _middle_only(filepath):
+        if not filepath.endswith(f'{vol.shape[0]//2:04d}.dcm'):
+            raise NotImplementedError('compressed transfer syntax')
+        return read_pixels(filepath)
+    monkeypatch.setattr(data.dicom, '_read_pixels', _middle_only)
+    opened = []
+
+    img = SkullEngineScan.read(str(tmp_path / '0000.dcm'), on_open=opened.append, has_phi=False)
+
+    assert opened == [img] # the object handed out is the one filled by sitk
+    assert np.array_equal(img.numpy_array(), vol - 1024)
@@ -0,0 +1,24 @@
+import os
+import numpy as np
+
+from data import *
+from data.export import *
+
+
+def test_export_reads_nifti_cases_like_convert(tmp_path):
+    labels = np.zeros((12,14,16), dtype=np.uint16)
+    labels[2:6,3:9,4:10] = 7
+    labels[7:11,5:12,6:14] = 40
+    scan = np.random.default_rng(0).integers(-1000, 2000, size=labels.shape).astype(np.int16) # intensities are not roi's
+    geometry = dict(spacing=(.5,.5,1.), origin=(10.,-5.,2.))
+    write_nifti(scan, tmp_path / 'case.nii.gz', **geometry)
+    write_nifti(labels, tmp_path / 'case_mask.nii.gz', **geometry)
+
+    sources = expand_inputs([str(tmp_path / '*.nii.gz')])
+    assert sources == [str(tmp_path / 'case.nii.gz')]
+    rows = export_case(sources[0], str(tmp_path / 'meshes'), formats=('.stl',), reduction=0.)
+
+    assert [(r['mask_id'], r['label']) for r in rows[:-1]] == [(6, 7), (39, 40)]
+    assert all(r['triangles'] > 0 and not r.get('error') for r in rows[:-1])
+    assert all(os.path.isfile(p) for r in rows[:-1] for p in r['paths'].split(';'))
+    assert set(rows[-1]) <= set(MANIFEST_COLUMNS)
@@ -0,0 +1,135 @@
+import os
+import io
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from data import *
+
+
+def make_arrays(shape=(6,9,11), num_masks=3):
+    rng = np.random.default_rng(0)
+    scan = rng.integers(-1024, 3000, size=shape).astype(np.int16)
+    masks = [rng.random(shape) < .3 for _ in range(num_masks)]
+    return scan, masks
+
+
+def test_scan_bin_aa_round_trip_is_byte_identical(tmp_path):
+    scan, _ = make_arrays()
+    raw = np.ascontiguousarray(scan[::-1,::-1,:]).tobytes() # as AnatomicAligner writes it
+    (tmp_path / 'in.bin').write_bytes(raw)
+    frame = ImageFrame(size=scan.shape[::-1], spacing=(1.,1.,1.))
+
+    for src in (str(tmp_path / 'in.bin'), raw, io.BytesIO(raw)):
+        img = SkullEngineScan.read_bin_aa(src, frame=frame)
+        assert np.array_equal(img.numpy_array(), scan)
+        img.write_bin_aa(tmp_path / 'out.bin')
+        assert (tmp_path / 'out.bin').read_bytes() == raw
+
+
+def test_mask_bin_aa_round_trip_is_byte_identical(tmp_path, capsys):
+    scan, masks = make_arrays()
+    frame = ImageFrame(size=scan.shape[::-1], spacing=(1.,1.,1.))
+    raw = encode_runs_aa(masks[0])[0].tobytes()
+    ref = SkullEngineScan.empty(frame=frame, dtype=np.int16)
+
+    msk = SkullEngineMultiRoiMask.read_bin_aa(raw, frame=frame, ref_scan=ref)
+    assert np.array_equal(msk.numpy_array() > 0, masks[0])
+    msk.write_bin_aa(str(tmp_path / 'out.bin'))
+    assert (tmp_path / 'out.bin').read_bytes() == raw
+    assert set(msk.extra['timings']) == {'encode', 'write'}
+    assert capsys.readouterr().out == ''
+
+
+@pytest.mark.parametrize('max_workers', [None, 3])
+def test_from_aa_reads_memory_archive(max_workers):
+    scan, masks = make_arrays()
+    archive = MemoryArchive.from_arrays(scan, masks, spacing=(.5,.5,1.25), name='doe', studydate='20200101', sex='F')
+
+    man = DataManager.from_aa(archive, max_workers=max_workers)
+
+    img = man.get_scan()
+    assert np.array_equal(img.numpy_array(), scan)
+    assert np.allclose(img.frame.spacing, (.5,.5,1.25))
+    assert img.identifier.metadata["Patient's Name"] == 'doe'
+    assert man.get_mask().mask_ids_in_use() == [0, 1, 2]
+    for i, m in enumerate(masks):
+        assert np.array_equal(man.get_mask().test(mask_id=i), m), i
+
+
+def test_write_nifti_geometry_matches_sitk(tmp_path):
+    scan, _ = make_arrays()
+    spacing, origin = (.4, .7, 1.3), (-10., 25.5, 3.)
+    c, s = np.cos(.3), np.sin(.3)
+    direction = (c, -s, 0., s, c, 0., 0., 0., 1.)
+
+    for name in ('a.nii', 'a.nii.gz'):
+        write_nifti(scan, tmp_path / name, spacing=spacing, origin=origin, direction=direction, max_workers=2, block_size=100)
+        img = sitk.ReadImage(str(tmp_path / name))
+        assert np.array_equal(sitk.GetArrayFromImage(img), scan)
+        assert np.allclose(img.GetSpacing(), spacing)
+        assert np.allclose(img.GetOrigin(), origin, atol=1e-4)
+        assert np.allclose(img.GetDirection(), direction, atol=1e-6)
+
+
+def test_read_cache_and_is_stale(tmp_path):
+    scan, masks = make_arrays()
+    source = tmp_path / 'source.bin'
+    source.write_bytes(b'version 1')
+    img = SkullEngineScan.read_bin_aa(np.ascontiguousarray(scan[::-1,::-1,:]).tobytes(), frame=ImageFrame(size=scan.shape[::-1], spacing=(1.,1.,1.)))
+    img.write_cache(tmp_path / 'img.cache', source=source_key(source))
+
+    header, arrays = read_cache(tmp_path / 'img.cache')
+    assert np.array_equal(arrays['data'], scan)
+    assert header == read_cache_header(tmp_path / 'img.cache')
+    assert not is_stale(header, str(source))
+    assert np.array_equal(SkullEngineScan.read_cache(tmp_path / 'img.cache', source=str(source)).numpy_array(), scan)
+
+    source.write_bytes(b'version two')
+    assert is_stale(header, str(source))
+    with pytest.raises(ValueError):
+        SkullEngineScan.read_cache(tmp_path / 'img.cache', source=str(source))
+
+
+def test_image_cache_load_reads_once(tmp_path, monkeypatch):
+    scan, _ = make_arrays()
+    write_nifti(scan, tmp_path / 'a.nii.gz', spacing=(.5,.5,1.))
+    cache = ImageCache(tmp_path / 'cache')
+    reads = []
+    read = SkullEngineScan.read
+    monkeypatch.setattr(SkullEngineScan, 'read', classmethod(lambda cls, *a, **kw: reads.append(kw) or read.__func__(cls, *a, **kw)))
+
+    first = cache.load(str(tmp_path / 'a.nii.gz'), SkullEngineScan)
+    second = cache.load(str(tmp_path / 'a.nii.gz'), SkullEngineScan, read_kw=dict(has_phi=False))
+
+    assert reads == [{}]
+    assert np.array_equal(first.numpy_array(), scan) and np.array_equal(second.numpy_array(), scan)
+
+
+def test_itk_never_changes_an_image_handed_out():
+    scan, _ = make_arrays()
+    img = SkullEngineScan.empty(frame=ImageFrame(size=scan.shape[::-1], spacing=(.5,.5,1.)), dtype=np.int16)
+    img.numpy_array()[...] = scan
+    img.identifier.metadata['0010|0010'] = 'doe'
+
+    a = img.itk(with_metadata=True)
+    assert img.itk(with_metadata=True) is a # same frame and metadata, so the same image, which shares voxels
+    b = img.itk()
+
+    assert a.GetMetaDataKeys() == ('0010|0010',) and b.GetMetaDataKeys() == ()
+    img.frame = ImageFrame(size=scan.shape[::-1], spacing=(2.,2.,2.), origin=(1.,2.,3.))
+    c = img.itk(with_metadata=True)
+    assert a.GetSpacing() == (.5,.5,1.) and a.GetOrigin() == (0.,0.,0.)
+    assert c.GetSpacing() == (2.,2.,2.) and c.GetOrigin() == (1.,2.,3.)
+    for x in (a, b, c):
+        assert np.array_equal(sitk.GetArrayViewFromImage(x), scan)
+
+
+def test_flip_aa_is_in_place_or_raises():
+    scan, _ = make_arrays()
+    arr = scan.copy()
+
+    assert flip_aa(arr) is arr and np.array_equal(arr, scan[::-1,::-1,:])
+    with pytest.raises(ValueError):
+        flip_aa(arr.transpose())
+    assert np.array_equal(arr, scan[::-1,::-1,:])
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from data import *
+
+
+def make_manager(shape=(8,10,12), spacing=(1.,1.,1.)):
+    man = DataManager()
+    man.set_scan(SkullEngineScan.empty(frame=ImageFrame(size=shape[::-1], spacing=spacing), dtype=np.int16))
+    return man
+
+
+@pytest.mark.parametrize('backend', list(RESAMPLE_BACKENDS))
+def test_resample_keeps_high_bits_of_planes(backend):
+    man = make_manager()
+    mask = man.get_mask()
+    ids = [0, 31, 32, 32+52, 32+53, 32+63, 32+64+63] # both ends of data, and of the low and high halves of two planes
+    rng = np.random.default_rng(0)
+    truth = {i: rng.random(mask.frame.size[::-1]) < .5 for i in ids}
+    for i in ids:
+        mask.set_true(mask_id=i, voxel_index=truth[i])
+
+    man.resample(new_spacing=(.5,.5,.5), backend=backend)
+    man.resample(new_spacing=(1.,1.,1.), backend=backend)
+
+    mask = man.get_mask()
+    assert [p.dtype for p in mask.planes] == [PLANE_DTYPE, PLANE_DTYPE]
+    for i in ids:
+        assert np.array_equal(mask.test(mask_id=i), truth[i]), i
+
+
+def test_set_labels_beyond_32_ids():
+    man = make_manager()
+    mask = man.get_mask()
+    shape = mask.frame.size[::-1]
+    labels = np.random.default_rng(0).integers(0, 120, size=shape).astype(np.uint16)
+    mask_ids = {v: v*2 for v in range(1, 120)} # ids up to 238, in data and four planes
+
+    mask.set_labels(labels, mask_ids=mask_ids)
+
+    assert len(mask.planes) == 4
+    assert all(p.dtype == PLANE_DTYPE for p in mask.planes)
+    assert mask.mask_ids_in_use() == sorted(mask_ids[v] for v in np.unique(labels).tolist() if v)
+    for v, i in mask_ids.items():
+        assert np.array_equal(mask.test(mask_id=i), labels == v), i
+        assert not mask.test(mask_id=i+1).any()
+
+
+def test_add_mask_of_labeled_array_hands_out_ids_in_label_order():
+    man = make_manager()
+    shape = man.get_mask().frame.size[::-1]
+    labels = np.random.default_rng(1).choice(np.array([0, 7, 300, 5000]), size=shape).astype(np.int32)
+
+    man.add_mask(arr=labels)
+
+    assert man.get_mask_ids() == [0, 1, 2]
+    for i, v in enumerate([7, 300, 5000]):
+        assert np.array_equal(man.get_mask().test(mask_id=i), labels == v)
+
+
+def test_reset_lets_another_scan_be_loaded():
+    man = make_manager()
+    man.add_mask(arr=np.ones((8,10,12), dtype=bool))
+
+    man.reset()
+
+    assert not man.scan_is_loaded() and man.get_mask() is None and man.get_mask_ids() == []
+    man.set_scan(SkullEngineScan.empty(frame=ImageFrame(size=(5,6,7), spacing=(1.,1.,1.)), dtype=np.int16), action_if_exists='error')
+    assert man.get_mask().frame.size == (5,6,7)
+
+
+@pytest.mark.parametrize('dtype', [MASK_DTYPE, PLANE_DTYPE])
+def test_bit_count_without_bitwise_count(monkeypatch, dtype):
+    arr = np.random.default_rng(2).integers(0, np.iinfo(dtype).max, size=(5,6,7), dtype=dtype, endpoint=True)
+    ref = np.array([bin(v).count('1') for v in arr.ravel().tolist()]).reshape(arr.shape)
+    if hasattr(np, 'bitwise_count'):
+        assert np.array_equal(bit_count(arr), ref)
+        monkeypatch.delattr(np, 'bitwise_count') # as on numpy 1.x
+
+    assert bit_count(arr).dtype == np.uint8
+    assert np.array_equal(bit_count(arr[:,::2]), ref[:,::2])
+
+
+def test_save_raises_rather_than_drop_planes(tmp_path):
+    mask = make_manager().get_mask()
+    mask.set_true(mask_id=3)
+    mask.save(tmp_path / 'a.nii.gz')
+
+    mask.set_true(mask_id=40)
+    assert mask.plane_ids_in_use() == [40]
+    with pytest.raises(ValueError):
+        mask.save(tmp_path / 'b.nii.gz')
+    assert not (tmp_path / 'b.nii.gz').exists()
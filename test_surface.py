@@ -0,0 +1,56 @@
+import numpy as np
+
+from data import *
+
+
+def make_mask(shape=(20,24,28)):
+    scan = SkullEngineScan.empty(frame=ImageFrame(size=shape[::-1], spacing=(.5,.6,.7)), dtype=np.int16)
+    mask = SkullEngineMultiRoiMask.empty(ref_scan=scan)
+    z, y, x = np.indices(shape)
+    mask.set_true(mask_id=3, voxel_index=(z-10)**2 + (y-12)**2 + (x-14)**2 < 64)
+    return mask
+
+
+def test_edit_remeshes_only_touched_bricks():
+    mask = make_mask()
+    extractor = SurfaceExtractor(max_workers=2, brick_size=8)
+    try:
+        extractor.surfaces(mask)[3].result()
+        before = dict(extractor.cache[3].bricks)
+
+        box = (slice(2,5), slice(3,6), slice(4,7))
+        mask.set_true(mask_id=3, voxel_index=box)
+        mesh = extractor.surfaces(mask)[3].result()
+        after = extractor.cache[3].bricks
+
+        touched = extractor._bricks_of([box], mask.frame.size[::-1])
+        assert touched
+        assert all(after[b] is m for b, m in before.items() if b not in touched) # untouched bricks are reused
+        assert touched & set(after) # the new blob is meshed
+
+        fresh = SurfaceExtractor(brick_size=8)
+        try:
+            expected = fresh.surfaces(mask)[3].result()
+        finally:
+            fresh.shutdown()
+        assert mesh.GetNumberOfCells() == expected.GetNumberOfCells()
+        assert np.allclose(mesh.GetBounds(), expected.GetBounds())
+    finally:
+        extractor.shutdown()
+
+
+def test_unchanged_roi_keeps_its_future():
+    mask = make_mask()
+    extractor = SurfaceExtractor(brick_size=8)
+    try:
+        first = extractor.surfaces(mask)[3]
+        assert extractor.surfaces(mask)[3] is first
+        zmin = first.result().GetBounds()[4] # before editing, which the build would otherwise see
+        mask.set_false(mask_id=3, voxel_index=(slice(0,10),))
+        second = extractor.surfaces(mask)[3]
+        assert second is not first
+        assert second.result().GetBounds()[4] > zmin # lower half of the ball along z is gone
+        mask.set_false(mask_id=3) # changed anywhere, so meshed from scratch, and empty roi's have no mesh
+        assert 3 not in extractor.surfaces(mask)
+    finally:
+        extractor.shutdown()
@@ -19,7 +19,7 @@ from vtkmodules.vtkCommonCore import vtkPoints, reference, vtkPoints, vtkIdList
 from vtkmodules.vtkInteractionWidgets import vtkPointCloudRepresentation, vtkPointCloudWidget, vtkResliceCursorWidget, vtkResliceCursorLineRepresentation, vtkResliceCursor
 from vtkmodules.vtkCommonTransforms import vtkMatrixToLinearTransform, vtkTransform
 from vtkmodules.vtkFiltersGeneral import vtkTransformPolyDataFilter, vtkTransformFilter
-from vtkmodules.vtkRenderingCore import vtkBillboardTextActor3D
+from vtkmodules.vtkRenderingCore import vtkBillboardTextActor3D, vtkImageActor, vtkDiscretizableColorTransferFunction
 from vtkmodules.vtkImagingCore import vtkImageChangeInformation
 from vtkmodules.vtkRenderingCore import (
     vtkActor,
@@ -56,12 +56,14 @@ import vtkmodules.vtkInteractionStyle
 # noinspection PyUnresolvedReferences
 import vtkmodules.vtkRenderingOpenGL2
 from vtkmodules.vtkCommonCore import (
+    VTK_UNSIGNED_CHAR,
     VTK_VERSION_NUMBER,
     vtkVersion,
     vtkScalarsToColors,
     vtkLookupTable,
 )
 from vtkmodules.vtkCommonDataModel import (
+    vtkPiecewiseFunction,
     vtkDataObject,
     vtkDataSetAttributes
 )
@@ -85,7 +87,7 @@ from vtkmodules.vtkImagingMorphological import vtkImageOpenClose3D
 # PySide
 from PySide6.QtGui import QWindow, QKeyEvent
 from PySide6.QtCore import Qt
-from PySide6.QtCore import Qt, Signal, Slot, QEvent, QObject
+from PySide6.QtCore import Qt, Signal, Slot, QEvent, QObject, QTimer
 from PySide6.Qt3DInput import Qt3DInput 
 from PySide6.QtWidgets import QApplication, QMainWindow, QGridLayout, QVBoxLayout, QWidget, QMdiSubWindow, QMdiArea, QDockWidget, QTreeWidgetItem, QTreeWidget, QLabel
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
@@ -96,6 +98,11 @@ import asyncio
 
 from ..data.interface import DataManager, DataView
 from ..data.image import SkullEngineScan, SkullEngineMask
+from ..data.surface import SurfaceExtractor
+
+
+# colors of roi surfaces in the 3d view, by mask id, the first three match the mask overlay of slice views
+SURFACE_COLORS = ['Red', 'Lime', 'Blue', 'Yellow', 'Magenta', 'Cyan', 'Orange', 'MediumPurple', 'SpringGreen', 'DeepPink', 'Gold', 'DodgerBlue']
 
 
 # class KeyFilter(QObject):
@@ -155,6 +162,37 @@ class QVTKAxisAlignedWindow(QVTKRenderWindowInteractor):
         self.viewer.SetSliceOrientation(orientation)
         rep = vtk.vtkResliceCursorLineRepresentation.SafeDownCast( self.viewer.GetResliceCursorWidget().GetRepresentation())
         rep.GetResliceCursorActor().GetCursorAlgorithm().SetReslicePlaneNormal(orientation)
+
+        # overlay layer, e.g. for masks, drawn on top of the viewer with the same camera
+        # its actor maps only the displayed slice through its own lookup table
+        self.overlay_renderer = vtkRenderer()
+        self.overlay_renderer.SetLayer(1)
+        self.overlay_renderer.InteractiveOff()
+        self.overlay_renderer.SetActiveCamera(self.viewer.GetRenderer().GetActiveCamera())
+        self.GetRenderWindow().SetNumberOfLayers(2)
+        self.GetRenderWindow().AddRenderer(self.overlay_renderer)
+        self.overlay = vtkImageActor()
+        self.overlay.VisibilityOff()
+        self.overlay_renderer.AddViewProp(self.overlay)
+        return None
+
+
+    def set_overlay(self, img:vtkImageData=None, lut:vtkScalarsToColors=None) -> None:
+        if img is None:
+            self.overlay.VisibilityOff()
+            return None
+        self.overlay.GetMapper().SetInputData(img)
+        self.overlay.GetProperty().SetLookupTable(lut)
+        self.overlay.GetProperty().UseLookupTableScalarRangeOn()
+        self.overlay.GetProperty().SetInterpolationTypeToNearest()
+        self.overlay.VisibilityOn()
+        self.update_overlay()
+        return None
+
+
+    def update_overlay(self) -> None:
+        # follows the slice shown by the viewer
+        self.overlay.SetDisplayExtent(self.viewer.GetImageActor().GetDisplayExtent())
         return None
     
 
@@ -165,12 +203,27 @@ class FourPaneWindow(QWidget, DataView):
     # mode is controled by its parent on view hierarchy thru delegation
     # 
 
+    surfaceReady = Signal(int, object) # mask id, future of its mesh, emitted from worker threads
+
     def __init__(self, *initargs):
 
         super().__init__(*initargs)
 
         self.reslice_center = [0.,0.,0.]
 
+        # 'layers' keeps scan and mask in their own dtypes and colors only displayed slices, 'blend' shows a pre-blended rgb buffer
+        self.render_mode = 'layers'
+        self.img_pipeline_key = None
+
+        # in 'layers' mode, viewers show a pyramid level of scan and mask while the user pans, zooms, or changes window and level,
+        # and full resolution once interaction has been idle for a while; 0 is full resolution, 1 is 2x downsampled, etc.
+        self.interactive_level = 1
+        self.display_level = 0
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(300)
+        self.idle_timer.timeout.connect(lambda: self.set_display_level(0))
+
         self.image_picker = vtkCellPicker()
         self.image_picker.SetTolerance(.01)
         # three orthogonal views
@@ -200,6 +253,17 @@ class FourPaneWindow(QWidget, DataView):
         style.SetDefaultRenderer(self.renderer_3d)
         self.iren_3d.SetInteractorStyle(style)
 
+        # one surface per roi, meshed in the background and shown as each one is ready
+        self.surface_extractor = SurfaceExtractor()
+        self.surface_futures = {}
+        self.surface_actors = {}
+        self.surfaceReady.connect(self.show_surface)
+
+        for v in (self.iren_sagittal, self.iren_axial, self.iren_coronal):
+            v.viewer.AddObserver(vtkResliceImageViewer.SliceChangedEvent, self.slice_changed)
+            v.viewer.GetInteractorStyle().AddObserver('StartInteractionEvent', self.interaction_started)
+            v.viewer.GetInteractorStyle().AddObserver('EndInteractionEvent', self.interaction_ended)
+
         cursor = self.iren_axial.viewer.GetResliceCursor()
         self.iren_coronal.viewer.SetResliceCursor(cursor)
         self.iren_sagittal.viewer.SetResliceCursor(cursor)
@@ -235,19 +299,54 @@ class FourPaneWindow(QWidget, DataView):
 
 
     def get_image(self) -> vtkImageData:
-        # blend scan with masks
+        # builds the pipeline once per scan, and returns the image for viewers
+        # in 'layers' mode, viewers show the scan as is, and the mask is an overlay layer colored one displayed slice at a time
+        # in 'blend' mode, viewers show an rgb buffer of scan blended with masks, which is filled lazily, see recolor_slices
 
         dm = self.get_data_manager()
         if dm is None or not dm.scan_is_loaded():
+            self.img_pipeline_key = None
             return vtkImageData()
-        
-        img = dm.get_scan().vtk()
+
+        scan, mask = dm.get_scan(), dm.get_mask()
+        key = (self.render_mode, id(scan), scan.frame, id(scan.data), id(mask), id(mask.data))
+        if self.img_pipeline_key == key:
+            self.mask_modified()
+            return self.img_viewer_input
+
+        self.img_pipeline_key = key
+        self.display_level = 0
+        self.img_input = img = scan.vtk()
+        self.msk_input = msk = mask.vtk()
+        self.img_range = img.GetScalarRange()
+        self.img_output_filter = None
+
+        if self.render_mode == 'layers':
+
+            # transparent where no roi is set
+            msk_lut = vtkDiscretizableColorTransferFunction()
+            msk_lut.AddRGBPoint(0.,0.,0.,0.)
+            msk_lut.AddRGBPoint(1.,1.,0.,0.)
+            msk_lut.AddRGBPoint(2.,0.,1.,0.)
+            msk_lut.AddRGBPoint(4.,0.,0.,1.)
+            msk_opacity = vtkPiecewiseFunction()
+            msk_opacity.AddPoint(0., 0.)
+            msk_opacity.AddPoint(.5, 0.)
+            msk_opacity.AddPoint(1., .5)
+            msk_lut.SetScalarOpacityFunction(msk_opacity)
+            msk_lut.EnableOpacityMappingOn()
+            msk_lut.Build()
+            self.msk_lut = msk_lut
+
+            scan.pyramid() # built in the background by the time the user interacts
+            self.img_viewer_input = img
+            return self.img_viewer_input
 
         # img_lut = vtkScalarsToColors()
         # img_lut.SetRange(img.GetScalarRange())
 
         img_lut = vtkLookupTable()
-        img_lut.SetRange(img.GetScalarRange()) # image intensity range
+        img_lut.SetRange(self.img_range) # image intensity range
         img_lut.SetValueRange(0.0, 1.0) # from bkg to white
         img_lut.SetSaturationRange(0.0, 0.0) # no color saturation
         img_lut.SetRampToLinear()
@@ -257,9 +356,7 @@ class FourPaneWindow(QWidget, DataView):
         img_rgb.SetInputData(img)
         img_rgb.SetLookupTable(img_lut)
         img_rgb.SetOutputFormatToRGB()
-        img_rgb.Update()
 
-        msk = dm.get_mask().vtk()
         msk_lut = vtkColorTransferFunction()
         msk_lut.AddRGBPoint(0.,0.,0.,0.)
         msk_lut.AddRGBPoint(1.,1.,0.,0.)
@@ -272,28 +369,217 @@ class FourPaneWindow(QWidget, DataView):
         msk_rgb.SetLookupTable(msk_lut)
         msk_rgb.SetOutputFormatToRGB()
         msk_rgb.PassAlphaToOutputOn()
-        msk_rgb.Update()
 
         blender = vtkImageBlend()
         blender.AddInputConnection(img_rgb.GetOutputPort())
         blender.AddInputConnection(msk_rgb.GetOutputPort())
         blender.SetOpacity(0, 0.5)
         blender.SetOpacity(1, 0.5)
-        blender.Update()
         self.img_blender = blender
 
         self.img_output_filter = blender
 
-        img = img_rgb.GetOutput()
+        # viewers display this buffer, which is allocated once and never blended as a whole
+        self.img_output = vtkImageData()
+        self.img_output.SetOrigin(img.GetOrigin())
+        self.img_output.SetSpacing(img.GetSpacing())
+        self.img_output.SetDimensions(img.GetDimensions())
+        self.img_output.AllocateScalars(VTK_UNSIGNED_CHAR, 3)
+        vtk_to_numpy(self.img_output.GetPointData().GetScalars())[...] = 0
+
+        # version of mask each slice was last colored with, per axis x, y, z
+        self.mask_version = 1
+        self.img_slice_version = [np.zeros(n, dtype=int) for n in img.GetDimensions()]
+
+        self.img_viewer_input = self.img_output
+        return self.img_viewer_input
+
+
+    def mask_modified(self) -> None:
+        # mask voxels are edited in place through numpy, so vtk must be told
+        # nothing is recolored until it is displayed
+        if self.img_pipeline_key is not None:
+            self.msk_input.GetPointData().GetScalars().Modified()
+            self.msk_input.Modified()
+            if self.img_output_filter is not None:
+                self.mask_version += 1 # marks every slice stale
+        return None
 
-        return self.img_output_filter.GetOutput()
+
+    def scan_modified(self) -> None:
+        # scan voxels are written in place too, e.g. while a dicom series is still arriving slice by slice
+        # window and level follow the scalar range, until the user changes them
+        if self.img_pipeline_key is None:
+            return None
+        self.img_input.GetPointData().GetScalars().Modified()
+        self.img_input.Modified()
+        if self.img_output_filter is not None:
+            self.mask_version += 1 # blended slices are stale as well
+            return None
+
+        viewers = (self.iren_sagittal.viewer, self.iren_axial.viewer, self.iren_coronal.viewer)
+        lo, hi = self.img_range
+        follow = all(v.GetColorWindow() == hi-lo and v.GetColorLevel() == (hi+lo)/2 for v in viewers)
+        self.img_range = lo, hi = self.img_input.GetScalarRange()
+        if follow:
+            for v in viewers:
+                v.SetColorWindow(hi-lo)
+                v.SetColorLevel((hi+lo)/2)
+        return None
+
+
+    def recolor_slices(self, *args) -> None:
+        # blends stale slices on display into img_output, one slice at a time, in 'blend' mode
+        # or moves mask overlays to the slices on display, in 'layers' mode
+
+        if self.img_pipeline_key is None:
+            return None
+
+        if self.img_output_filter is None:
+            for v in (self.iren_sagittal, self.iren_coronal, self.iren_axial):
+                v.update_overlay()
+            return None
+
+        dims = self.img_output.GetDimensions()
+        out = vtk_to_numpy(self.img_output.GetPointData().GetScalars()).reshape(*dims[::-1], 3)
+        modified = False
+        for v in (self.iren_sagittal.viewer, self.iren_coronal.viewer, self.iren_axial.viewer):
+            axis = {
+                vtkResliceImageViewer.SLICE_ORIENTATION_YZ: 0,
+                vtkResliceImageViewer.SLICE_ORIENTATION_XZ: 1,
+                vtkResliceImageViewer.SLICE_ORIENTATION_XY: 2,
+            }[v.GetSliceOrientation()]
+            s = v.GetSlice()
+            if s < 0 or s >= dims[axis] or self.img_slice_version[axis][s] == self.mask_version:
+                continue
+
+            extent = list(self.img_input.GetExtent())
+            extent[2*axis:2*axis+2] = s, s
+            self.img_output_filter.UpdateExtent(extent)
+            rgb = self.img_output_filter.GetOutput()
+            e = rgb.GetExtent() # may still hold more than the requested slice, if it was up to date already
+            rgb = vtk_to_numpy(rgb.GetPointData().GetScalars()).reshape(e[5]-e[4]+1, e[3]-e[2]+1, e[1]-e[0]+1, 3)
+            index = [slice(None)]*3
+            index[2-axis] = slice(s, s+1)
+            out[tuple(index)] = rgb[tuple(index[:2-axis]) + (slice(s-e[2*axis], s-e[2*axis]+1),)]
+            self.img_slice_version[axis][s] = self.mask_version
+            modified = True
+
+        if modified:
+            self.img_output.GetPointData().GetScalars().Modified()
+            self.img_output.Modified()
+
+        return None
+
+
+    def set_display_level(self, level) -> None:
+        # swaps viewer inputs between full resolution and a pyramid level, keeping slices at the same physical position
+        # stays where it is if the pyramid is still being built, and in 'blend' mode, which has no pyramid
+        if level == self.display_level or self.img_pipeline_key is None or self.img_output_filter is not None:
+            return None
+
+        if level:
+            dm = self.get_data_manager()
+            levels = dm.get_scan().pyramid(), dm.get_mask().pyramid()
+            if not all(f.done() for f in levels):
+                return None
+            img, msk = (f.result()[level-1].vtk() for f in levels)
+        else:
+            img, msk = self.img_input, self.msk_input
+
+        current = self.iren_axial.viewer.GetInput()
+        index = self.iren_sagittal.viewer.GetSlice(), self.iren_coronal.viewer.GetSlice(), self.iren_axial.viewer.GetSlice()
+        point = [o + s*i for o, s, i in zip(current.GetOrigin(), current.GetSpacing(), index)]
+        for v in (self.iren_sagittal, self.iren_axial, self.iren_coronal):
+            camera = v.viewer.GetRenderer().GetActiveCamera()
+            view = camera.GetPosition(), camera.GetFocalPoint(), camera.GetParallelScale()
+            window = v.viewer.GetColorWindow(), v.viewer.GetColorLevel()
+            v.viewer.SetInputData(img) # resets window and level to the range of img
+            v.viewer.SetColorWindow(window[0])
+            v.viewer.SetColorLevel(window[1])
+            v.set_overlay(msk, self.msk_lut)
+            camera.SetPosition(view[0])
+            camera.SetFocalPoint(view[1])
+            camera.SetParallelScale(view[2])
+        self.display_level = level
+        self.reslice(*point)
+        return None
+
+
+    def interaction_started(self, obj:vtkInteractorStyleImage, event) -> None:
+        self.idle_timer.stop()
+        self.set_display_level(self.interactive_level)
+        return None
+
+
+    def interaction_ended(self, obj:vtkInteractorStyleImage, event) -> None:
+        self.idle_timer.start()
+        return None
+
+
+    def slice_changed(self, obj:vtkResliceImageViewer, event) -> None:
+        # scrolling reveals slices that may not have been colored yet
+        self.recolor_slices()
+        obj.Render()
+        return None
+
+
+    def update_surfaces(self) -> None:
+        # submits roi's that changed since they were last meshed, and removes surfaces of roi's that are gone
+        dm = self.get_data_manager()
+        if dm is None:
+            return None
+
+        futures = self.surface_extractor.surfaces(dm.get_mask()) if dm.scan_is_loaded() else {}
+        gone = set(self.surface_futures) - set(futures)
+        for i in gone:
+            self.surface_futures.pop(i)
+            if i in self.surface_actors:
+                self.renderer_3d.RemoveActor(self.surface_actors.pop(i))
+        for i, f in futures.items():
+            if self.surface_futures.get(i) is not f:
+                self.surface_futures[i] = f
+                f.add_done_callback(lambda f, i=i: self.surfaceReady.emit(i, f))
+        if gone:
+            self.iren_3d.GetRenderWindow().Render()
+        return None
+
+
+    @Slot(int, object)
+    def show_surface(self, mask_id, future) -> None:
+        # meshes that were superseded while being extracted are dropped
+        if self.surface_futures.get(mask_id) is not future:
+            return None
+        if future.exception() is not None:
+            print(f'surface of mask {mask_id} failed: {future.exception()}')
+            return None
+
+        first = not self.surface_actors
+        actor = self.surface_actors.get(mask_id)
+        if actor is None:
+            actor = vtkActor()
+            actor.SetMapper(vtkPolyDataMapper())
+            actor.GetMapper().ScalarVisibilityOff()
+            actor.GetProperty().SetColor(colors.GetColor3d(SURFACE_COLORS[mask_id % len(SURFACE_COLORS)]))
+            self.surface_actors[mask_id] = actor
+            self.renderer_3d.AddActor(actor)
+        actor.GetMapper().SetInputData(future.result())
+        if first:
+            self.renderer_3d.ResetCamera()
+        self.iren_3d.GetRenderWindow().Render()
+        return None
 
 
     def data_update(self, *args, **kw) -> None:
         # this class is responsible for updating all its subviews
 
-        if hasattr(self, 'img_output_filter'):
-            self.img_output_filter.Update() # must have, updates imagedata for viewers
+        if self.img_pipeline_key is not None:
+            if args and args[0] is self.get_data_manager().get_scan():
+                self.scan_modified()
+            else:
+                self.update_surfaces()
+            self.mask_modified()
+            self.recolor_slices()
             self.iren_sagittal.viewer.Render()
             self.iren_axial.viewer.Render()
             self.iren_coronal.viewer.Render()
@@ -303,12 +589,29 @@ class FourPaneWindow(QWidget, DataView):
         # this class is responsible for updating all its subviews
 
         vtk_img = self.get_image()
-        
-        self.iren_sagittal.viewer.SetInputData(vtk_img)
-        self.iren_axial.viewer.SetInputData(vtk_img)
-        self.iren_coronal.viewer.SetInputData(vtk_img)
+        self.set_display_level(0)
 
-        self.reslice(*vtk_img.GetCenter())
+        if self.iren_axial.viewer.GetInput() is not vtk_img:
+
+            for v in (self.iren_sagittal, self.iren_axial, self.iren_coronal):
+                v.viewer.SetInputData(vtk_img)
+                if self.img_pipeline_key is not None and self.img_output_filter is None:
+                    lo, hi = self.img_range
+                    v.viewer.SetColorWindow(hi-lo)
+                    v.viewer.SetColorLevel((hi+lo)/2)
+                    v.set_overlay(self.msk_input, self.msk_lut)
+                else:
+                    v.set_overlay(None)
+
+            self.reslice(*vtk_img.GetCenter())
+
+        else:
+            self.recolor_slices()
+            self.iren_sagittal.viewer.Render()
+            self.iren_axial.viewer.Render()
+            self.iren_coronal.viewer.Render()
+
+        self.update_surfaces()
 
         # self.iren_sagittal.viewer.Render()
         # self.iren_axial.viewer.Render()
@@ -348,5 +651,11 @@ class FourPaneWindow(QWidget, DataView):
             if k>=self.iren_axial.viewer.GetSliceMin() and k<=self.iren_axial.viewer.GetSliceMax():
                 self.iren_axial.viewer.SetSlice(int(round(k)))
 
+            if self.img_pipeline_key is not None:
+                self.recolor_slices()
+                self.iren_sagittal.viewer.Render()
+                self.iren_axial.viewer.Render()
+                self.iren_coronal.viewer.Render()
+
         return None
 
@@ -0,0 +1,78 @@
+import threading
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor, CancelledError, Future
+
+from PySide6.QtCore import Signal, QObject
+
+from ..data.image import SkullEngineScan
+
+
+class ImageLoader(QObject):
+    '''this class reads images on a worker thread, so the gui stays responsive, and reports through signals
+    every signal carries the tag given to load, e.g. 'scan' or 'mask', so one loader serves several kinds of requests
+    signals are emitted from the worker thread, and qt queues them to slots of objects living on the gui thread
+        opened(tag, img): img exists, for dicom series its buffer is allocated but slices are still arriving
+        progress(tag, done, total): done of total slices of a dicom series are in
+        finished(tag, img): img is fully read
+        failed(tag, message): reading raised an error
+        cancelled(tag): cancel was called before reading finished'''
+
+    opened = Signal(str, object)
+    progress = Signal(str, int, int)
+    finished = Signal(str, object)
+    failed = Signal(str, str)
+    cancelled = Signal(str)
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.executor = ThreadPoolExecutor(max_workers=1) # one image at a time, reading is itself concurrent
+        self.cancel_event = threading.Event()
+        self.future = None
+        return None
+
+
+    def is_busy(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+
+    def load(self, filepath, *, tag='scan', cls=SkullEngineScan, **kw) -> Future:
+        '''reads filepath with cls.read(filepath, **kw) on the worker thread, only one load may run at a time'''
+        if self.is_busy():
+            raise ValueError('another image is still loading')
+        self.cancel_event = threading.Event()
+        self.future = self.executor.submit(self._load, filepath, tag, cls, self.cancel_event, kw)
+        return self.future
+
+
+    def cancel(self) -> None:
+        '''stops the running load between slices'''
+        self.cancel_event.set()
+        return None
+
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=True)
+        return None
+
+
+    def _load(self, filepath, tag, cls, cancel, kw):
+        done = count(1)
+        total = []
+        def _on_open(img):
+            total.append(img.frame.size[2])
+            self.opened.emit(tag, img)
+        def _on_slice(k):
+            self.progress.emit(tag, next(done), total[0])
+
+        try:
+            img = cls.read(filepath, on_open=_on_open, on_slice=_on_slice, cancel=cancel, **kw)
+        except CancelledError:
+            self.cancelled.emit(tag)
+            return None
+        except Exception as e:
+            self.failed.emit(tag, f'{type(e).__name__}: {e}')
+            return None
+
+        self.finished.emit(tag, img)
+        return img
@@ -4,7 +4,7 @@ import os
 from datetime import datetime
 
 import numpy as np
-from PySide6.QtGui import QDragEnterEvent
+from PySide6.QtGui import QDragEnterEvent, QKeySequence, QShortcut
 from PySide6.QtWidgets import QApplication, QMainWindow
 
 # Important:
@@ -13,7 +13,7 @@ from PySide6.QtWidgets import QApplication, QMainWindow
 #     pyside2-uic form.ui -o ui_form.py
 from vtkmodules.vtkCommonDataModel import vtkImageData
 from vtkmodules.vtkIOImage import vtkNIFTIImageReader
-from PySide6.QtCore import Qt, Signal, Slot, QEvent, QObject
+from PySide6.QtCore import Qt, Signal, Slot, QEvent, QObject, QTimer
 from PySide6.QtWidgets import (
     QApplication,
     QCheckBox,
@@ -28,6 +28,7 @@ from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 from .mainwindow_ui import Ui_MainWindow
 from .fourpane import FourPaneWindow
+from .loader import ImageLoader
 from .dialogs import *
 from ..data import DataManager, DataView, SkullEngineMask, SkullEngineScan
 
@@ -47,6 +48,19 @@ class AppWindow(QMainWindow, DataView):
         dm = DataManager()
         self.set_data_manager(dm)
 
+        # images are read on a worker thread, a dicom series is shown while its slices arrive, escape cancels
+        self.loader = ImageLoader(self)
+        self.loader.opened.connect(self.image_opened)
+        self.loader.progress.connect(self.load_progress)
+        self.loader.finished.connect(self.image_loaded)
+        self.loader.failed.connect(self.load_failed)
+        self.loader.cancelled.connect(self.load_cancelled)
+        self.refresh_timer = QTimer(self) # views are refreshed at most this often while slices arrive
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(100)
+        self.refresh_timer.timeout.connect(self.get_data_manager().scan_modified)
+        QShortcut(QKeySequence(Qt.Key_Escape), self, self.loader.cancel)
+
         # other
         self.setCentralWidget(self.ui.fourpane)
         self.setAcceptDrops(True)
@@ -75,6 +89,94 @@ class AppWindow(QMainWindow, DataView):
         return None
 
 
+    def closeEvent(self, event):
+        self.loader.shutdown()
+        super().closeEvent(event)
+        return None
+
+
+    def open_image(self, file):
+        if not file:
+            return None
+        print(f'Open Image: {file}')
+        self.start_load(file, tag='scan', has_phi=False)
+        return None
+
+
+    def open_mask(self, file):
+        if not file:
+            return None
+        print(f'Open Mask: {file}')
+        self.start_load(file, tag='mask', has_phi=False) # read as a plain labeled volume, which add_mask splits into roi's
+        return None
+
+
+    def start_load(self, file, **kw):
+        # called from slots and drops, where an exception would only reach qt, so a busy loader is reported in the status bar
+        try:
+            self.loader.load(file, **kw)
+        except ValueError as e:
+            self.statusBar().showMessage(f'Cannot open {file}: {e}, press Esc to cancel', 5000)
+            return None
+        self.statusBar().showMessage(f'Loading {file} ...')
+        return None
+
+
+    @Slot(str, object)
+    def image_opened(self, tag, img):
+        # a scan is handed to the data manager as soon as its buffer exists, and views fill in as slices arrive
+        if tag == 'scan':
+            self.get_data_manager().set_scan(img)
+        return None
+
+
+    @Slot(str, int, int)
+    def load_progress(self, tag, done, total):
+        self.statusBar().showMessage(f'Loading {tag}: {done}/{total} slices, press Esc to cancel')
+        if tag == 'scan' and not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+        return None
+
+
+    @Slot(str, object)
+    def image_loaded(self, tag, img):
+        dm = self.get_data_manager()
+        if tag == 'scan':
+            self.refresh_timer.stop()
+            dm.scan_modified()
+        elif tag == 'mask':
+            dm.add_mask(arr=img.numpy_array())
+            self.data_update()
+            hidden = dm.get_mask().plane_ids_in_use() # slices overlay data only, so these would vanish without a word
+            if hidden:
+                self.statusBar().showMessage(f"Loaded {tag}, roi's {hidden} show as surfaces only, not in slices", 10000)
+                return None
+        self.statusBar().showMessage(f'Loaded {tag}', 5000)
+        return None
+
+
+    @Slot(str, str)
+    def load_failed(self, tag, message):
+        # a scan that was already opened is half decoded, so it is discarded, same as a cancelled one
+        if tag == 'scan':
+            self.refresh_timer.stop()
+            self.get_data_manager().reset()
+        print(f'Loading {tag} failed: {message}')
+        self.statusBar().showMessage(f'Loading {tag} failed: {message}')
+        return None
+
+
+    @Slot(str)
+    def load_cancelled(self, tag):
+        # a scan that was already opened is missing slices, so it is discarded rather than kept as the loaded scan
+        if tag == 'scan':
+            self.refresh_timer.stop()
+            self.get_data_manager().reset()
+        print(f'Loading {tag} cancelled')
+        self.statusBar().showMessage(f'Loading {tag} cancelled', 5000)
+        return None
+
+
     @Slot(bool)
     def on_actionOpenImage_triggered(self, checked):
 
@@ -83,9 +185,7 @@ class AppWindow(QMainWindow, DataView):
             raise ValueError('image is already loaded and cannot be changed')
         
         file, _ = QFileDialog.getOpenFileName(self, 'Open Image ...', '', "Image Files (*.nii.gz)")
-        print(f'Open Image: {file}')
-        img = SkullEngineScan.read(file, has_phi=False)
-        dm.set_scan(img)
+        self.open_image(file)
 
         return None
 
@@ -98,11 +198,7 @@ class AppWindow(QMainWindow, DataView):
             raise ValueError('load image first')
         
         file, _ = QFileDialog.getOpenFileName(self, 'Open Mask ...', '', "Image Files (*.nii.gz)")
-        print(f'Open Mask: {file}')
-        img = SkullEngineMask.read(file)
-        mask_arr = img.numpy_array()
-        dm.add_mask(arr=mask_arr)
-        self.data_update()
+        self.open_mask(file)
 
 
 
@@ -184,15 +280,9 @@ class AppWindow(QMainWindow, DataView):
         dm = self.get_data_manager()
         
         if not dm.scan_is_loaded():
-            print(f'Open Image: {file}')
-            img = SkullEngineScan.read(file, has_phi=False)
-            dm.set_scan(img)
-            
+            self.open_image(file)
         else:
-            print(f'Open Mask: {file}')
-            img = SkullEngineScan.read(file, has_phi=False)
-            mask_arr = img.numpy_array()
-            dm.add_mask(arr=mask_arr)
+            self.open_mask(file)
 
         event.acceptProposedAction()
 